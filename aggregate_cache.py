@@ -0,0 +1,118 @@
+"""
+Memoized dashboard aggregates (KPIs, quintiles, rankings, series, Sankey links...).
+
+Every click reruns the Streamlit script, and each module used to recompute its
+aggregates from df_filtered. They are now kept per process, keyed by
+
+    (tenant, data version, filter state, aggregate name)
+
+- the data version is stamped by app.load_enriched on every frame it builds (a new
+  one per cache miss), so a reload never serves aggregates of the previous data;
+- the filter state is the normalized widget values (date range, tipos, ...);
+- the name also carries the aggregate's own parameters (e.g. the resample rule).
+
+Least recently used entries are evicted once AGGREGATE_CACHE_MB is exceeded, so
+switching tabs or toggling a filter back and forth is a dictionary lookup.
+Results are shared between sessions: callers must not modify them.
+"""
+import os
+import sys
+import datetime
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+AGGREGATE_CACHE_MB = float(os.getenv("AGGREGATE_CACHE_MB", 256))
+
+
+def nbytes(value):
+    """Approximate memory held by an aggregate (frames, arrays and containers of them)."""
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(nbytes(k) + nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(str(v) for v in value))
+    if isinstance(value, (datetime.date, pd.Timestamp)):
+        return value.isoformat()
+    return value
+
+
+def filter_state(**filters):
+    """Hashable, order-independent form of the dashboard filter values."""
+    return tuple(sorted((name, _normalize(value)) for name, value in filters.items()))
+
+
+class AggregateCache:
+    """LRU of computed aggregates bounded by an approximate memory budget."""
+
+    def __init__(self, max_bytes=AGGREGATE_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, compute):
+        """The cached value of key, or compute() stored under it."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        # Computed outside the lock: two sessions missing the same key both compute it
+        value = compute()
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+            }
+
+
+# Imported once per process: shared by every session and rerun
+_shared = AggregateCache()
+
+
+def memoize(scope, name, compute):
+    """compute() cached under scope (tenant, data version, filter state) and the aggregate name."""
+    return _shared.get(tuple(scope) + (name,), compute)
+
+
+def stats():
+    return _shared.stats()
@@ -0,0 +1,262 @@
+"""
+Asynchronous alert e-mail: the pipeline queues alerts and never waits on SMTP.
+
+submit() returns at once. Charts are rendered to PNG bytes in memory on a small
+thread pool (matplotlib's object API, no pyplot state and no temp files), and a
+background sender thread collects the alerts queued within ALERT_DIGEST_SECONDS
+into one digest per recipient. Digests go out through one SMTP session that is
+kept open between batches, reconnected once if the server dropped it, and closed
+after SMTP_IDLE_SECONDS without alerts. Pending alerts are flushed at interpreter
+exit (or by close()).
+
+Recipients: ALERT_RECEIVER (comma-separated) for every tenant, or per tenant from
+ALERT_ROUTES, a JSON file {"company_id": ["a@x.mx", ...], "*": [...]}.
+
+Any SMTP server works, including a local stand-in without TLS or login:
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 ALERT_RECEIVER=ops@localhost
+Without SMTP_SERVER the digests are printed instead of sent.
+"""
+import io
+import os
+import ssl
+import json
+import time
+import queue
+import atexit
+import logging
+import smtplib
+import threading
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+DIGEST_SUBJECT = "Resumen de Alertas Forenses CFDI"
+ALERT_CLOSE_TIMEOUT = float(os.getenv("ALERT_CLOSE_TIMEOUT", 60))
+
+# A bar chart of a series indexed by period, attached to the alert as filename
+Chart = namedtuple('Chart', ['series', 'title', 'filename'])
+
+_CLOSE = object()
+
+
+def render_chart(chart):
+    """PNG bytes of the chart, drawn on its own Figure so renders can run in parallel threads."""
+    figure = Figure(figsize=(10, 6))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    positions = range(len(chart.series))
+    ax.bar(positions, chart.series.to_numpy(), color='#00f2ff', edgecolor='black')
+    ax.set_xticks(positions, [str(label) for label in chart.series.index], rotation=90)
+    ax.set_title(chart.title, fontsize=14, fontweight='bold', color='black')
+    ax.set_ylabel('Volumen', fontsize=12)
+    ax.set_xlabel('Periodo (Mes)', fontsize=12)
+    ax.grid(axis='y', linestyle='--', alpha=0.7)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def load_routes(path):
+    """{company_id: [recipients]} from a JSON file, {} without one."""
+    if not path:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        routes = json.load(f)
+    return {str(k): [v] if isinstance(v, str) else list(v) for k, v in routes.items()}
+
+
+def split_addresses(value):
+    return [a.strip() for a in (value or "").split(",") if a.strip()]
+
+
+class AlertDispatcher:
+    """
+    Queue of alerts drained by one sender thread. Settings default to the SMTP_* /
+    ALERT_* environment variables, read when the dispatcher is created.
+    """
+
+    def __init__(self, server=None, port=None, user=None, password=None, starttls=None, sender=None,
+                 receivers=None, routes=None, digest_seconds=None, render_workers=None, idle_seconds=None, timeout=None):
+        env = os.getenv
+        self.server = server if server is not None else env("SMTP_SERVER")
+        self.port = int(port if port is not None else env("SMTP_PORT", 587))
+        self.user = user if user is not None else env("SMTP_USER")
+        self.password = password if password is not None else env("SMTP_PASSWORD")
+        self.starttls = starttls if starttls is not None else env("SMTP_STARTTLS", "1").lower() not in ("0", "false", "no")
+        self.sender = sender or env("ALERT_SENDER") or self.user or "alertas-cfdi@localhost"
+        self.receivers = receivers if receivers is not None else split_addresses(env("ALERT_RECEIVER"))
+        self.routes = routes if routes is not None else load_routes(env("ALERT_ROUTES"))
+        self.digest_seconds = float(digest_seconds if digest_seconds is not None else env("ALERT_DIGEST_SECONDS", 2))
+        self.idle_seconds = float(idle_seconds if idle_seconds is not None else env("SMTP_IDLE_SECONDS", 60))
+        self.timeout = float(timeout if timeout is not None else env("SMTP_TIMEOUT", 30))
+        workers = int(render_workers if render_workers is not None else env("ALERT_RENDER_WORKERS", 2))
+
+        self.pid = os.getpid()
+        self.closed = False
+        self.stats = {"alerts": 0, "digests": 0, "connections": 0, "failed": 0}
+        self._smtp = None
+        self._queue = queue.Queue()
+        self._renderer = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="alert-chart")
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self._thread.start()
+
+    def recipients(self, company_id=None):
+        routed = self.routes.get(str(company_id)) if company_id is not None else None
+        return routed or self.routes.get("*") or self.receivers
+
+    def submit(self, subject, body, chart=None, company_id=None, recipients=None):
+        """Queues one alert and returns immediately; its chart (a Chart) renders in the background."""
+        if self.closed:
+            raise RuntimeError("Alert dispatcher is closed")
+        rendered = self._renderer.submit(render_chart, chart) if chart is not None else None
+        self._queue.put({
+            "subject": subject, "body": body, "company_id": company_id,
+            "chart": chart, "rendered": rendered,
+            "recipients": list(recipients) if recipients else self.recipients(company_id),
+        })
+        self.stats["alerts"] += 1
+
+    def close(self, timeout=ALERT_CLOSE_TIMEOUT):
+        """Sends whatever is queued and stops the sender thread. Safe to call twice."""
+        if self.closed or self.pid != os.getpid():
+            return
+        self.closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"Alert dispatcher: pending alerts not sent within {timeout:g}s")
+        self._renderer.shutdown(wait=False)
+
+    # --- Sender thread ---
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            closing = first is _CLOSE
+            batch = [] if closing else [first]
+            # Alerts queued within the digest window share one e-mail per recipient
+            deadline = time.monotonic() + self.digest_seconds
+            while not closing:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                else:
+                    batch.append(item)
+            try:
+                self._send_digests(batch)
+            except Exception as e:
+                logging.error(f"Alert dispatcher: digest failed: {e}")
+            if closing:
+                self._disconnect()
+                return
+
+    def _send_digests(self, batch):
+        digests = defaultdict(list)
+        unrouted = []
+        for alert in batch:
+            if not alert["recipients"]:
+                unrouted.append(alert)
+            for recipient in alert["recipients"]:
+                digests[recipient].append(alert)
+        if unrouted:
+            digests[None] = unrouted
+        for recipient, alerts in digests.items():
+            self._send(self._digest(recipient, alerts), recipient, alerts)
+
+    def _digest(self, recipient, alerts):
+        message = EmailMessage()
+        message['From'] = self.sender
+        if recipient:
+            message['To'] = recipient
+        tenant = lambda alert: f" [{alert['company_id']}]" if alert["company_id"] is not None else ""
+        if len(alerts) == 1:
+            message['Subject'] = alerts[0]["subject"] + tenant(alerts[0])
+            message.set_content(alerts[0]["body"])
+        else:
+            message['Subject'] = f"{DIGEST_SUBJECT} ({len(alerts)})"
+            message.set_content("\n\n".join(f"== {a['subject']}{tenant(a)} ==\n{a['body']}" for a in alerts))
+        for alert in alerts:
+            if alert["rendered"] is None:
+                continue
+            try:
+                png = alert["rendered"].result(timeout=self.timeout)
+            except Exception as e:
+                logging.error(f"Failed to create chart {alert['chart'].filename}: {e}")
+                continue
+            message.add_attachment(png, maintype='image', subtype='png', filename=alert["chart"].filename)
+        return message
+
+    def _send(self, message, recipient, alerts):
+        if not self.server or not recipient:
+            logging.warning("SMTP server or alert recipient missing. Skipping email alert.")
+            charts = [a["chart"].filename for a in alerts if a["chart"] is not None]
+            print(f"--- FAKE EMAIL ALERT ---\nTo: {recipient}\nSubject: {message['Subject']}\n"
+                  f"Body: {message.get_body().get_content().rstrip()}\nCharts Attached: {charts}\n------------------------")
+            return
+        for attempt in range(2):
+            try:
+                self._connection().send_message(message, to_addrs=[recipient])
+                self.stats["digests"] += 1
+                logging.info(f"Alert digest sent to {recipient}: {len(alerts)} alerts")
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                # A pooled session the server already dropped fails here; retry once on a new one
+                self._disconnect()
+                if attempt:
+                    self.stats["failed"] += 1
+                    logging.error(f"Failed to send alert digest to {recipient}: {e}")
+
+    def _connection(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+            if self.starttls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.user and self.password:
+                smtp.login(self.user, self.password)
+            self._smtp = smtp
+            self.stats["connections"] += 1
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+_dispatcher = None
+_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """The process-wide dispatcher, created on first use (and again in a forked child)."""
+    global _dispatcher
+    with _lock:
+        if _dispatcher is None or _dispatcher.closed or _dispatcher.pid != os.getpid():
+            _dispatcher = AlertDispatcher()
+            atexit.register(_dispatcher.close)
+        return _dispatcher
+
+
+def submit(subject, body, chart=None, company_id=None, recipients=None):
+    get_dispatcher().submit(subject, body, chart=chart, company_id=company_id, recipients=recipients)
+
+
+def close(timeout=ALERT_CLOSE_TIMEOUT):
+    """Flushes and stops the process-wide dispatcher, if one was started."""
+    if _dispatcher is not None:
+        _dispatcher.close(timeout)
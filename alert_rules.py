@@ -0,0 +1,245 @@
+"""
+Declarative month-over-month alert rules, evaluated over a monthly rollup.
+
+The rollup holds one row per (company_id, month_year) with additive metrics
+(ROLLUP_METRICS: a source column, an aggregation and an optional row filter). It is
+persisted per tenant next to the gold data and updated incrementally: full runs
+replace it, incremental runs recompute only the months they touched.
+
+Rules are plain data (DEFAULT_RULES, or a JSON list in ALERT_RULES_FILE):
+
+    {"name": "cancelaciones_spike", "metric": "cancelados", "check": "pct_change",
+     "window": 1, "threshold": 0.20, "min_value": 0, "months": 1,
+     "message": "... {value:.1%} ... {month}", "chart": "optional chart title"}
+
+check is one of
+    pct_change  metric vs the mean of the previous `window` months, as a fraction
+    zscore      metric vs the mean and deviation of the previous `window` months
+    above       the metric itself
+A rule fires on the latest `months` months of a tenant when the checked value is
+above threshold and the metric is at least min_value. Every rule is evaluated for
+all tenants of the rollup at once, with grouped cumulative sums instead of a loop
+per tenant.
+"""
+import os
+import json
+import uuid
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import gold_store
+import mongo_columnar
+
+ALERT_RULES_FILE = os.getenv("ALERT_RULES_FILE")
+ROLLUP_COLLECTION = os.getenv("ROLLUP_COLLECTION", "alert_rollups")
+ROLLUP_DIRNAME = "alert_rollups"
+ROLLUP_FILE = "rollup.arrow"
+
+ROLLUP_METRICS = {
+    'cfdis': {'agg': 'count'},
+    'total': {'column': 'total', 'agg': 'sum'},
+    'ingresos': {'column': 'total', 'agg': 'sum', 'where': {'column': 'tipo', 'equals': 'i'}},
+    'retenciones': {'column': 'calc_retenciones', 'agg': 'sum'},
+    'cancelados': {'agg': 'count', 'where': {'column': 'estatus', 'contains': 'cancel'}},
+    'duplicados': {'column': 'is_duplicate', 'agg': 'sum'},
+    'casi_duplicados': {'column': 'near_duplicate', 'agg': 'sum'},
+}
+
+DEFAULT_RULES = [
+    {"name": "retenciones_spike", "metric": "retenciones", "check": "pct_change", "window": 1, "threshold": 0.20,
+     "message": "Incremento Atípico de Retenciones: {value:.1%} de aumento en {month}"},
+    {"name": "cancelaciones_spike", "metric": "cancelados", "check": "pct_change", "window": 1, "threshold": 0.20,
+     "message": "Incremento Atípico de Cancelaciones: {value:.1%} de aumento en {month}",
+     "chart": "Tendencia de Facturas Canceladas"},
+]
+CHECKS = {'pct_change', 'zscore', 'above'}
+
+
+def rollup_columns(metrics=ROLLUP_METRICS):
+    """Gold columns a rollup reads."""
+    columns = ['month_year']
+    for spec in metrics.values():
+        for col in [spec.get('column'), spec.get('where', {}).get('column')]:
+            if col and col not in columns:
+                columns.append(col)
+    return columns
+
+
+def _where(df, where):
+    values = df[where['column']].astype('string').str.lower()
+    if 'equals' in where:
+        return (values == str(where['equals']).lower()).fillna(False).to_numpy()
+    return values.str.contains(str(where['contains']).lower(), regex=False).fillna(False).to_numpy()
+
+
+def monthly_rollup(df, metrics=ROLLUP_METRICS):
+    """Rollup rows (month_year + one column per metric) of a gold frame or chunk. Additive across chunks."""
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['month_year'] + list(metrics))
+    months = df['month_year'].astype('string').fillna(gold_store.UNKNOWN_MONTH)
+    values = {}
+    for name, spec in metrics.items():
+        if spec.get('column') and spec['column'] not in df.columns:
+            continue
+        if spec.get('where') and spec['where']['column'] not in df.columns:
+            continue
+        if spec['agg'] == 'count':
+            value = np.ones(len(df))
+        else:
+            value = pd.to_numeric(df[spec['column']], errors='coerce').fillna(0).to_numpy(dtype='float64')
+        if spec.get('where'):
+            value = np.where(_where(df, spec['where']), value, 0.0)
+        values[name] = value
+    rollup = pd.DataFrame(values, index=months.to_numpy()).groupby(level=0).sum()
+    return rollup.reindex(columns=list(metrics), fill_value=0.0).rename_axis('month_year').reset_index()
+
+
+def combine_rollups(parts):
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts:
+        return monthly_rollup(None)
+    return pd.concat(parts, ignore_index=True).groupby('month_year', as_index=False).sum()
+
+
+# --- Storage ---
+
+def _local_path(data_dir, company_id):
+    return os.path.join(gold_store.tenant_dir(os.path.join(data_dir, ROLLUP_DIRNAME), company_id), ROLLUP_FILE)
+
+
+def read_rollup(company_id, db=None, data_dir=None):
+    """A tenant's stored rollup (empty when there is none)."""
+    if db is not None:
+        return read_rollups(db, [company_id])
+    path = _local_path(data_dir, company_id)
+    if not os.path.exists(path):
+        return monthly_rollup(None).assign(company_id=pd.Series(dtype=object))
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def read_rollups(db, company_ids=None):
+    """Stored rollups of every tenant (or of company_ids) in one query."""
+    query = {} if company_ids is None else {"company_id": {"$in": list(company_ids)}}
+    kinds = {'company_id': 'str', 'month_year': 'str', **{metric: 'float' for metric in ROLLUP_METRICS}}
+    return mongo_columnar.find_frame(db[ROLLUP_COLLECTION], query, kinds, list(kinds))
+
+
+def write_rollup(rollup, company_id, months=None, db=None, data_dir=None):
+    """
+    Stores a tenant's rollup rows. months=None replaces the whole rollup; otherwise
+    only those months are replaced (and dropped when the new rollup lacks them).
+    """
+    rollup = rollup.assign(company_id=company_id)
+    if db is not None:
+        collection = db[ROLLUP_COLLECTION]
+        query = {"company_id": company_id}
+        if months is not None:
+            query["month_year"] = {"$in": [str(m) for m in months]}
+        collection.delete_many(query)
+        if not rollup.empty:
+            collection.insert_many(rollup.to_dict(orient='records'))
+        return
+
+    path = _local_path(data_dir, company_id)
+    if months is not None:
+        stored = read_rollup(company_id, data_dir=data_dir)
+        stored = stored[~stored['month_year'].isin([str(m) for m in months])]
+        rollup = pd.concat([stored, rollup], ignore_index=True)
+    rollup = rollup.sort_values('month_year').reset_index(drop=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    table = pa.Table.from_pandas(rollup.astype({'company_id': str, 'month_year': str}), preserve_index=False)
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+
+# --- Rules ---
+
+def load_rules(path=ALERT_RULES_FILE):
+    """Rules from a JSON file, DEFAULT_RULES without one. Invalid rules raise ValueError."""
+    if not path:
+        return DEFAULT_RULES
+    with open(path, 'r', encoding='utf-8') as f:
+        rules = json.load(f)
+    for rule in rules:
+        missing = {'name', 'metric', 'check', 'threshold', 'message'} - set(rule)
+        if missing:
+            raise ValueError(f"Alert rule {rule.get('name', '?')}: missing {sorted(missing)}")
+        if rule['check'] not in CHECKS:
+            raise ValueError(f"Alert rule {rule['name']}: unknown check {rule['check']!r} (one of {sorted(CHECKS)})")
+        if rule['metric'] not in ROLLUP_METRICS:
+            raise ValueError(f"Alert rule {rule['name']}: unknown metric {rule['metric']!r} (one of {sorted(ROLLUP_METRICS)})")
+    return rules
+
+
+def dense_months(rollups):
+    """Every calendar month between each tenant's first and last, missing months as zeros."""
+    period = pd.to_datetime(rollups['month_year'].astype(str), format='%Y-%m', errors='coerce')
+    # CFDIs without a parseable fecha_emision have no place in the series
+    frame = rollups[period.notna()]
+    ordinal = pd.Series(period[period.notna()].dt.to_period('M').array.asi8, index=frame.index)
+    bounds = ordinal.groupby(frame['company_id']).agg(['min', 'max'])
+    lengths = (bounds['max'] - bounds['min'] + 1).to_numpy()
+    company = np.repeat(bounds.index.to_numpy(), lengths)
+    starts = np.repeat(bounds['min'].to_numpy() - np.cumsum(lengths) + lengths, lengths)
+    ordinals = np.arange(lengths.sum()) + starts
+    dense = pd.DataFrame({'company_id': company, 'ordinal': ordinals})
+    metrics = [c for c in ROLLUP_METRICS if c in frame.columns]
+    dense = dense.merge(frame[['company_id'] + metrics].assign(ordinal=ordinal.to_numpy()), on=['company_id', 'ordinal'], how='left')
+    dense[metrics] = dense[metrics].astype('float64').fillna(0.0)
+    dense['month_year'] = pd.PeriodIndex.from_ordinals(dense['ordinal'], freq='M').astype(str)
+    return dense.drop(columns='ordinal')
+
+
+def evaluate(rollups, rules=None):
+    """
+    Fired alerts for every tenant in rollups: one row per (company_id, rule, month)
+    with the checked value, the metric and the formatted message.
+    """
+    rules = DEFAULT_RULES if rules is None else rules
+    columns = ['company_id', 'rule', 'month_year', 'metric', 'value', 'current', 'message', 'chart']
+    if rollups is None or rollups.empty:
+        return pd.DataFrame(columns=columns)
+    frame = dense_months(rollups).sort_values(['company_id', 'month_year'], kind='stable').reset_index(drop=True)
+    by_tenant = frame.groupby('company_id', sort=False)
+    position = by_tenant.cumcount().to_numpy()
+    from_end = by_tenant.cumcount(ascending=False).to_numpy()
+
+    fired = []
+    for rule in rules:
+        current = frame[rule['metric']].to_numpy()
+        window = int(rule.get('window', 1))
+        # Sums of the previous `window` months from grouped cumulative sums
+        prefix = by_tenant[rule['metric']].cumsum().to_numpy()
+        prefix_sq = (frame[rule['metric']] ** 2).groupby(frame['company_id'], sort=False).cumsum().to_numpy()
+        shifted = lambda values, k: np.where(position >= k, np.roll(values, k), 0.0)
+        previous = shifted(prefix, 1) - shifted(prefix, window + 1)
+        previous_sq = shifted(prefix_sq, 1) - shifted(prefix_sq, window + 1)
+        mean = previous / window
+        complete = position >= window
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if rule['check'] == 'pct_change':
+                value = np.where(complete & (mean > 0), current / mean - 1, np.nan)
+            elif rule['check'] == 'zscore':
+                std = np.sqrt(np.maximum(previous_sq / window - mean ** 2, 0))
+                value = np.where(complete & (std > 0), (current - mean) / std, np.nan)
+            else:
+                value = current.astype('float64')
+        hit = (from_end < int(rule.get('months', 1))) & (value > rule['threshold']) & (current >= rule.get('min_value', 0))
+        for i in np.flatnonzero(hit):
+            month = frame['month_year'].iat[i]
+            fired.append({
+                'company_id': frame['company_id'].iat[i], 'rule': rule['name'], 'month_year': month, 'metric': rule['metric'],
+                'value': value[i], 'current': current[i], 'chart': rule.get('chart'),
+                'message': rule['message'].format(value=value[i], current=current[i], month=month, company_id=frame['company_id'].iat[i]),
+            })
+    if fired:
+        logging.info(f"Alert rules: {len(fired)} alerts over {frame['company_id'].nunique()} tenants")
+    return pd.DataFrame(fired, columns=columns)
@@ -5,13 +5,23 @@ import pymongo
 import plotly.express as px
 import plotly.graph_objects as go
 import os
+import logging
 from dotenv import load_dotenv
 import json
 import numpy as np
 import hashlib
+import uuid
 from streamlit_option_menu import option_menu # Import Option Menu
 import textwrap # For dedenting HTML strings
 import audit_module # Moved to top
+import gold_store
+import gold_derived
+import frame_index
+import schemas
+import mongo_pool
+import mongo_columnar
+import aggregate_cache
+import tenant_frame
 
 # ============================================================================
 # CONFIGURACIÓN DE SUBMENÚS PREMIUM
@@ -470,32 +480,96 @@ def plot_dark_histogram(df, x_col, y_col, color_col, title):
     return fig
 
 # --- Data Loading ---
+# Gold columns the dashboards read; None loads every column (the audit module renders whole invoices)
+DASHBOARD_COLUMNS = (
+    'id', 'uuid', 'company_id', 'month_year', 'tipo', 'folio', 'fecha_emision', 'estatus', 'moneda',
+    'metodo_pago', 'forma_pago', 'receptor_uso_cfdi', 'subtotal', 'descuento', 'total',
+    'calc_iva', 'calc_ieps', 'calc_ret_isr', 'calc_ret_iva', 'calc_retenciones', 'calc_traslados',
+    'emisor_id', 'emisor_rfc', 'emisor_nombre', 'receptor_id', 'receptor_rfc', 'receptor_nombre',
+    'rep_pagado', 'rep_parcialidades', 'rep_saldo_insoluto', 'rep_ultimo_pago',
+    'ventas_brutas', 'ventas_netas', 'ventas_netas_calc', 'year', 'week', 'is_duplicate', 'near_duplicate',
+)
+MODULE_COLUMNS = {"Materialidad / REPSE": None}
+ENRICHED_CACHE_ENTRIES = int(os.getenv("ENRICHED_CACHE_ENTRIES", 32))
+# Concept columns the invoice detail view shows
+INVOICE_CONCEPT_COLUMNS = ['cantidad', 'clave_unidad', 'descripcion', 'valor_unitario', 'importe']
+MONTH_PATTERN = r'^\d{4}-\d{2}$'
+
+@st.cache_data(ttl=600)
+def load_filter_options(company_id):
+    """
+    Tipo values and emission months (sorted) of a tenant for the filter widgets, from
+    MongoDB distincts or the local partition names, without loading its invoices.
+    None when the tenant has no data.
+    """
+    mongo = mongo_pool.shared()
+    if mongo is not None and mongo.available():
+        try:
+            collection = mongo.database(os.getenv("DB_NAME", "cfdi_db"))[os.getenv("COLLECTION_NAME", "gold_cfdi")]
+            months = collection.distinct('month_year', {"company_id": company_id})
+            if months:
+                tipos = collection.distinct('tipo', {"company_id": company_id})
+                months = pd.Series(months, dtype=str)
+                return sorted(t for t in tipos if t is not None), sorted(months[months.str.match(MONTH_PATTERN)])
+        except pymongo.errors.ConnectionFailure as e:
+            mongo.mark_failed(e)
+
+    root = gold_store.store_root(os.getenv("DATA_DIR", "./data"))
+    partitions = gold_store.list_partitions(root, company_id)
+    if partitions:
+        tipos = gold_store.read_gold(root, company_id, columns=['tipo'])
+        tipos = sorted(tipos['tipo'].dropna().unique()) if 'tipo' in tipos.columns else []
+        months = pd.Series(list(partitions), dtype=str)
+        return tipos, sorted(months[months.str.match(MONTH_PATTERN)])
+
+    # Legacy single-file export: the options come from the whole (small) frame
+    df = load_data(company_id)
+    if df is None or df.empty:
+        return None
+    tipos = sorted(df['tipo'].dropna().unique()) if 'tipo' in df.columns else []
+    return tipos, sorted(df['month'].unique())
+
 @st.cache_data(ttl=600)
-def load_data(company_id):
-    mongo_uri = os.getenv("MONGO_URI")
+def load_data(company_id, columns=None, months=None, tipos=None):
+    """
+    Gold CFDIs for one tenant. columns, months (month_year values) and tipos restrict
+    what is read (None = everything): the MongoDB query gets them as a projection and
+    filters, the local store reads only those months' partitions and columns.
+    """
+    mongo = mongo_pool.shared()
     db_name = os.getenv("DB_NAME", "cfdi_db")
     collection_name = os.getenv("COLLECTION_NAME", "gold_cfdi")
     
     df = pd.DataFrame()
     
-    # Try MongoDB
-    if mongo_uri:
+    # Try MongoDB (skipped without waiting while the pool reports it down)
+    if mongo is not None and mongo.available():
         try:
-            client = pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=2000)
-            db = client[db_name]
-            collection = db[collection_name]
+            collection = mongo.database(db_name)[collection_name]
             # --- MANDATORY FILTER BY COMPANY ---
-            data = list(collection.find({"company_id": company_id}))
-            if data:
-                df = pd.DataFrame(data)
-                if '_id' in df.columns:
-                    df = df.drop(columns=['_id'])
+            query = {"company_id": company_id}
+            if months is not None:
+                query["month_year"] = {"$in": list(months)}
+            if tipos is not None:
+                query["tipo"] = {"$in": list(tipos)}
+            df = mongo_columnar.find_frame(collection, query, schemas.COLLECTIONS['gold_cfdi'], columns)
+        except pymongo.errors.ConnectionFailure as e:
+            mongo.mark_failed(e)
         except Exception as e:
             pass
     
-    # Fallback to local JSON
+    # Fallback to the local partitioned store (memory-mapped, only this tenant's partitions)
+    data_dir = os.getenv("DATA_DIR", "./data")
     if df.empty:
-        local_path = os.path.join(os.getenv("DATA_DIR", "./data"), "gold_cfdi_processed.json")
+        stored = gold_store.read_gold(gold_store.store_root(data_dir), company_id, columns=columns, months=months)
+        if stored is not None:
+            df = stored
+            if tipos is not None and 'tipo' in df.columns:
+                df = df[df['tipo'].isin(list(tipos))].reset_index(drop=True)
+
+    # Legacy single-file export
+    if df.empty:
+        local_path = os.path.join(data_dir, "gold_cfdi_processed.json")
         if os.path.exists(local_path):
             with open(local_path, 'r') as f:
                 data = json.load(f)
@@ -505,36 +579,20 @@ def load_data(company_id):
 
     # Post-processing
     if not df.empty:
-        # 1. Enforce Datetime
+        # 1. Dates and derived columns: stored by the pipeline (gold_derived); gold that
+        #    predates them is derived here until backfill_gold.py converts it
         if 'fecha_emision' in df.columns:
-            # Bug Fix: Do NOT force numeric first, as it destroys ISO date strings.
-            # 1. Try direct conversion (handles strings like "2026-01-15" and mixed types)
-            df['fecha_emision_dt'] = pd.to_datetime(df['fecha_emision'], errors='coerce')
-            
-            # 2. If we have NaNs, they might be numeric timestamps (e.g. from Mongo export)
-            if df['fecha_emision_dt'].isna().any():
-                 # Try converting the original column to numeric, then to datetime
-                 numeric_dates = pd.to_numeric(df['fecha_emision'], errors='coerce')
-                 # Fill NaNs in the datetime column with the converted numeric timestamps
-                 df['fecha_emision_dt'] = df['fecha_emision_dt'].fillna(pd.to_datetime(numeric_dates, unit='ms', errors='coerce'))
-            
-            df['fecha_emision'] = df['fecha_emision_dt']
-            df = df.drop(columns=['fecha_emision_dt'])
+            if not gold_derived.is_current(df):
+                logging.warning(f"Gold of {company_id} has no derived columns, parsing dates on load. Run backfill_gold.py.")
+                df = gold_derived.add_derived(df)
             df = df.dropna(subset=['fecha_emision']) # Drop invalid dates
-            
-            df['month'] = df['fecha_emision'].dt.to_period('M').astype(str)
-            df['year'] = df['fecha_emision'].dt.year
-            df['week'] = df['fecha_emision'].dt.to_period('W').astype(str)
-            df['ventas_netas_calc'] = (df['subtotal'] + df['calc_iva']) - (df['calc_retenciones'] + df['descuento'])
+            df['month'] = df['month_year'] if 'month_year' in df.columns else df['fecha_emision'].dt.to_period('M').astype(str)
 
-        # 2. Enforce Numeric Columns (Critical for Calculations)
+        # 2. Numeric columns (typed by the gold schema; missing ones count as zero)
         numeric_cols = ['subtotal', 'total', 'descuento', 'calc_iva', 'calc_ieps', 'calc_ret_isr', 'calc_ret_iva', 'calc_retenciones', 'calc_traslados']
         for col in numeric_cols:
             if col in df.columns:
-                # Remove currency symbols if present
-                if df[col].dtype == object:
-                     df[col] = df[col].astype(str).str.replace(r'[$,]', '', regex=True)
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+                df[col] = schemas.parse_money(df[col]).fillna(0)
             else:
                 df[col] = 0.0
 
@@ -558,8 +616,38 @@ def load_data(company_id):
         if 'emisor_nombre' not in df.columns: df['emisor_nombre'] = 'DESCONOCIDO'
         if 'receptor_nombre' not in df.columns: df['receptor_nombre'] = 'DESCONOCIDO'
 
+    # Sorted by date with tipo as a categorical, once per cached load (see frame_index)
+    return frame_index.prepare(df)
+
 
-    return df
+@st.cache_resource(ttl=600, max_entries=ENRICHED_CACHE_ENTRIES)
+def load_enriched(company_id, columns=None, months=None, tipos=None):
+    """
+    load_data joined with the catalogs (tenant_frame): (df, its FrameIndex, the concepts
+    keyed by uuid), or (None, None, empty concepts). Built once per cache entry and
+    returned as is to every rerun and session, not copied: read-only.
+    df.attrs['data_version'] is new on every build and keys the memoized aggregates.
+    """
+    df = load_data(company_id, columns=columns, months=months, tipos=tipos)
+    if df is None or df.empty:
+        return None, None, tenant_frame.concepts_by_uuid(None, None)
+    _, df_receptors = load_catalogs()
+    df = tenant_frame.with_receptor_rfc(df, df_receptors)
+    df.attrs['data_version'] = uuid.uuid4().hex
+    return df, frame_index.FrameIndex(df), tenant_conceptos(company_id, df)
+
+
+def tenant_conceptos(company_id, df):
+    """
+    Concepts of df's invoices keyed by uuid, for the invoice detail view: the tenant's
+    local gold_conceptos partitions when the pipeline wrote them, else the export catalog.
+    """
+    if 'uuid' in df.columns:
+        stored = gold_store.read_conceptos(os.getenv("DATA_DIR", "./data"), company_id, uuids=df['uuid'].dropna(),
+                                           columns=INVOICE_CONCEPT_COLUMNS)
+        if stored is not None:
+            return stored
+    return tenant_frame.concepts_by_uuid(load_conceptos(), df)
 
 
 @st.cache_data(ttl=600)
@@ -568,10 +656,10 @@ def load_conceptos():
     path = os.path.join(os.getenv("DATA_DIR", "./data"), "cfdi_conceptos.csv")
     if os.path.exists(path):
         try:
-            return pd.read_csv(path, encoding='utf-8')
+            return schemas.read_export(path, 'cfdi_conceptos', encoding='utf-8')
         except:
              try:
-                 return pd.read_csv(path, encoding='latin-1')
+                 return schemas.read_export(path, 'cfdi_conceptos', encoding='latin-1')
              except:
                  return pd.DataFrame()
     return pd.DataFrame()
@@ -585,9 +673,9 @@ def load_catalogs():
     def load_safe(filename):
         path = os.path.join(data_dir, filename)
         if os.path.exists(path):
-            try: return pd.read_csv(path, encoding='utf-8')
+            try: return schemas.read_export(path, filename, encoding='utf-8')
             except: 
-                try: return pd.read_csv(path, encoding='latin-1')
+                try: return schemas.read_export(path, filename, encoding='latin-1')
                 except: return pd.DataFrame()
         return pd.DataFrame()
 
@@ -595,6 +683,40 @@ def load_catalogs():
     df_receptors = load_safe("cfdi_receptors.csv")
     return df_emisors, df_receptors
 
+# --- NAVIGATION STATE ---
+def nav_selection():
+    """(module, subtab) selected by the ?nav=&subtab= query params; the data loader needs it before the navbar renders."""
+    import urllib.parse
+    import unicodedata
+
+    # Helper para normalizar acentos y strings
+    def clean_str(val):
+        if not val: return ""
+        if isinstance(val, list): val = val[0]
+        s = urllib.parse.unquote(str(val)).strip().lower()
+        return "".join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+
+    params = st.query_params
+    current_nav_norm = clean_str(params.get("nav", "Cuenta T"))
+    current_sub_norm = clean_str(params.get("subtab", ""))
+
+    active_module_key = "Cuenta T"
+    for k in SUBMENU_CONFIG.keys():
+        if clean_str(k) == current_nav_norm:
+            active_module_key = k
+            break
+            
+    active_sub_key = ""
+    if active_module_key in SUBMENU_CONFIG:
+        subitems = SUBMENU_CONFIG[active_module_key]
+        if subitems:
+            active_sub_key = subitems[0]['key']
+            for sit in subitems:
+                if clean_str(sit['key']) == current_sub_norm:
+                    active_sub_key = sit['key']
+                    break
+    return active_module_key, active_sub_key
+
 # --- SECURITY UTILS ---
 SECRET_KEY = os.getenv("SECRET_KEY", "default-salt")
 
@@ -621,10 +743,16 @@ def check_login(cid, user, password):
                 "password_hash": "mock"
             }
 
-    client = pymongo.MongoClient(os.getenv("MONGO_URI"))
-    db = client[os.getenv("DB_NAME", "cfdi_db")]
-    users_col = db["users"]
-    user_doc = users_col.find_one({"company_id": cid, "username": user})
+    mongo = mongo_pool.shared()
+    # Without a reachable user store the login fails like bad credentials instead of hanging
+    if mongo is None or not mongo.available():
+        return None
+    users_col = mongo.database(os.getenv("DB_NAME", "cfdi_db"))["users"]
+    try:
+        user_doc = users_col.find_one({"company_id": cid, "username": user})
+    except pymongo.errors.ConnectionFailure as e:
+        mongo.mark_failed(e)
+        return None
     if user_doc and user_doc["password_hash"] == hash_password(password):
         user_doc["active_modules"] = user_doc.get("active_modules", [])
         return user_doc
@@ -671,54 +799,12 @@ if st.session_state.authenticated:
     # --- INJECT CSS & ASSETS ---
     render_futuristic_header()
 
-    # --- LOAD DATA ---
-    df = load_data(st.session_state.company_id)
-    df_conceptos = load_conceptos()
-
-    if df is not None and not df.empty:
-        # --- ENRICHMENT: JOIN WITH CATALOGS ---
-        # Fix missing Receptor RFC by joining with catalog
-        if 'receptor_id' in df.columns and not df_receptors.empty:
-            # Prepare receptor catalog for merge
-            cat_rec = df_receptors[['id', 'rfc']].rename(columns={'id': 'receptor_id', 'rfc': 'catalog_receptor_rfc'})
-            # Merge
-            df = df.merge(cat_rec, on='receptor_id', how='left')
-            # Fill receptor_rfc if it was missing or generic
-            if 'receptor_rfc' in df.columns:
-                 df['receptor_rfc'] = df['catalog_receptor_rfc'].fillna(df['receptor_rfc'])
-            else:
-                 df['receptor_rfc'] = df['catalog_receptor_rfc']
-            
-            # Clean up temporary column
-            df = df.drop(columns=['catalog_receptor_rfc'], errors='ignore')
-            
-            # Ensure no NaNs remain after merge (fallback to generic if catalog also fails)
-            df['receptor_rfc'] = df['receptor_rfc'].fillna(df['receptor'].fillna('XAXX010101000') if 'receptor' in df.columns else 'XAXX010101000')
-
-        # --- ENRICHMENT: MAP CONCEPTS TO UUID ---
-        # The concepts loaded from CSV use 'cfdi_id' which links to 'id' in gold_cfdi.
-        # But audit_module expects 'uuid' in concepts. We must map it.
-        if not df_conceptos.empty and 'cfdi_id' in df_conceptos.columns and 'id' in df.columns:
-            # Create mapping: id -> uuid
-            mapping = df[['id', 'uuid']].drop_duplicates().astype(str) # Ensure string types for matching
-            
-            # Ensure proper types for merge keys
-            df_conceptos['cfdi_id'] = df_conceptos['cfdi_id'].astype(str)
-            
-            # Merge to add uuid to concepts
-            df_conceptos = df_conceptos.merge(
-                mapping, 
-                left_on='cfdi_id', 
-                right_on='id', 
-                how='left'
-            )
-            # Cleanup
-            df_conceptos = df_conceptos.drop(columns=['id'], errors='ignore')
-
-
-    if df is None:
+    # --- FILTER OPTIONS (tipos and months only, no invoices loaded) ---
+    filter_options = load_filter_options(st.session_state.company_id)
+    if filter_options is None:
         st.error("SISTEMA OFFLINE: FUENTE DE DATOS INACCESIBLE.")
         st.stop()
+    tipo_opts, month_opts = filter_options
 
     # --- CUSTOM FILTER SIDEBAR ---
     # This container is targeted by CSS to become the sidebar
@@ -730,8 +816,7 @@ if st.session_state.authenticated:
         st.markdown("---")
         
         # --- FILTERS CONTENT ---
-        if 'tipo' in df.columns:
-            tipo_opts = df['tipo'].unique()
+        if tipo_opts:
             selected_tipo = st.multiselect("Tipo Comprobante", tipo_opts, default=tipo_opts)
         else:
             selected_tipo = []
@@ -745,26 +830,39 @@ if st.session_state.authenticated:
         st.markdown("---")
         
         # Date Range Filter
-        if not df.empty and 'fecha_emision' in df.columns:
-            min_date = df['fecha_emision'].min().date()
-            max_date = df['fecha_emision'].max().date()
+        if month_opts:
+            min_date = pd.Period(month_opts[0], freq='M').start_time.date()
+            max_date = pd.Period(month_opts[-1], freq='M').end_time.date()
             date_range = st.date_input("Rango de Fechas", value=(min_date, max_date), min_value=min_date, max_value=max_date)
         else:
             date_range = []
 
-    # --- APPLY FILTERS ---
-    # Default mask (all true)
-    mask = pd.Series([True] * len(df))
-    
-    if selected_tipo:
-        mask = mask & (df['tipo'].isin(selected_tipo))
-        
-    # Apply Date Filter
+    # --- LOAD DATA ---
+    # The selected months, tipos and the module's columns are pushed down into the read
+    selected_months = None
     if len(date_range) == 2:
-        start_date, end_date = date_range
-        mask = mask & (df['fecha_emision'].dt.date >= start_date) & (df['fecha_emision'].dt.date <= end_date)
-        
-    df_filtered = df.loc[mask]
+        selected_months = tuple(pd.period_range(date_range[0], date_range[1], freq='M').astype(str))
+        if set(month_opts) <= set(selected_months):
+            selected_months = None
+    push_tipos = tuple(selected_tipo) if selected_tipo and len(selected_tipo) < len(tipo_opts) else None
+    # Joined with the catalogs once per load and shared by every rerun (load_enriched)
+    df, df_index, df_conceptos = load_enriched(
+        st.session_state.company_id, columns=MODULE_COLUMNS.get(nav_selection()[0], DASHBOARD_COLUMNS),
+        months=selected_months, tipos=push_tipos)
+
+    if df is None or df.empty:
+        st.warning("Sin CFDIs para los filtros seleccionados.")
+        st.stop()
+
+    # --- APPLY FILTERS ---
+    # df comes sorted by fecha_emision (frame_index.prepare in load_data) with its index
+    # from load_enriched: the date range is a slice found by binary search, and tipo is
+    # only checked on the rows inside it
+    start_date, end_date = date_range if len(date_range) == 2 else (None, None)
+    df_filtered = df_index.select(start_date, end_date, selected_tipo)
+    # Aggregates of df_filtered are memoized under this scope (aggregate_cache)
+    agg_scope = (st.session_state.company_id, df.attrs['data_version'],
+                 aggregate_cache.filter_state(date_range=tuple(date_range), tipos=frozenset(selected_tipo)))
 
 
     # --- FIXED HEADER WRAPPER ---
@@ -794,22 +892,8 @@ def render_premium_navbar():
     - CSS Offscreen (position: fixed; left: -100vw; opacity: 0) en lugar de display: none
     - Fix definitivo para "Blank Screen" y botones no clickeables
     """
-    import urllib.parse
-    import unicodedata
     import textwrap
 
-    # Helper para normalizar acentos y strings
-    def clean_str(val):
-        if not val: return ""
-        if isinstance(val, list): val = val[0]
-        s = urllib.parse.unquote(str(val)).strip().lower()
-        return "".join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
-
-    # Get state
-    params = st.query_params
-    current_nav_norm = clean_str(params.get("nav", "Cuenta T"))
-    current_sub_norm = clean_str(params.get("subtab", ""))
-
     # ============================================================================
     # V9.0 SESSION SAFE NAVIGATION (STEALTH FOOTER STRATEGY)
     # ============================================================================
@@ -865,21 +949,7 @@ def render_premium_navbar():
     """, unsafe_allow_html=True)
 
     # 2. RENDER ACTIVE KEYS LOGIC
-    active_module_key = "Cuenta T"
-    for k in SUBMENU_CONFIG.keys():
-        if clean_str(k) == current_nav_norm:
-            active_module_key = k
-            break
-            
-    active_sub_key = ""
-    if active_module_key in SUBMENU_CONFIG:
-        subitems = SUBMENU_CONFIG[active_module_key]
-        if subitems:
-            active_sub_key = subitems[0]['key']
-            for sit in subitems:
-                if clean_str(sit['key']) == current_sub_norm:
-                    active_sub_key = sit['key']
-                    break
+    active_module_key, active_sub_key = nav_selection()
 
     # 3. BUILD HTML (VISUAL NAVBAR)
     nav_items_html = ""
@@ -1538,6 +1608,10 @@ if selected_module == "Configuración":
     with col_c1:
         st.success(f"🟢 SESIÓN ACTIVA: {st.session_state.username} | {st.session_state.company_id}")
         st.caption("Permisos: " + str(st.session_state.active_modules))
+        agg = aggregate_cache.stats()
+        st.caption(f"Caché de agregados: {agg['hits']:,} aciertos / {agg['misses']:,} fallos ({agg['hit_rate']:.0%}), "
+                   f"{agg['entries']:,} entradas, {agg['bytes'] / 1024 ** 2:.1f} de {agg['max_bytes'] / 1024 ** 2:.0f} MB, "
+                   f"{agg['evictions']:,} desalojos")
     
     with col_c2:
         if st.button("🔴 CERRAR SESIÓN", use_container_width=True):
@@ -1557,13 +1631,20 @@ elif selected_module == "Cuenta T":
         # --- SECCIÓN 1: VOLUMETRÍA Y SECCIÓN 2: ESTADÍSTICA (MISMO NIVEL VISUAL) ---
         st.markdown("<div class='section-header'>Volumetría y Control Operativo</div>", unsafe_allow_html=True)
 
-        # Robust filtering for 'Ingreso', 'I', 'egreso', 'E', etc.
-        ing_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('I')
-        egr_mask = df_filtered['tipo'].astype(str).str.upper().str.startswith('E')
-        ing = df_filtered.loc[ing_mask, 'total'].sum()
-        egr = df_filtered.loc[egr_mask, 'total'].sum()
-        vol = len(df_filtered)
-        avg = df_filtered['total'].mean() if vol > 0 else 0
+        def cuenta_t_kpis():
+            # Robust filtering for 'Ingreso', 'I', 'egreso', 'E', etc.
+            tipo_upper = df_filtered['tipo'].astype(str).str.upper()
+            total = df_filtered['total']
+            return {
+                'ing': total[tipo_upper.str.startswith('I')].sum(),
+                'egr': total[tipo_upper.str.startswith('E')].sum(),
+                'vol': len(df_filtered),
+                'avg': total.mean() if len(df_filtered) > 0 else 0,
+                'max': total.max(), 'min': total.min(), 'std': total.std(),
+            }
+
+        kpis = aggregate_cache.memoize(agg_scope, 'cuenta_t_kpis', cuenta_t_kpis)
+        ing, egr, vol, avg = kpis['ing'], kpis['egr'], kpis['vol'], kpis['avg']
 
         v1, v2, v3, v4 = st.columns(4)
         with v1: render_stat_element("Volumen CFDI", f"{vol:,}", "Total Transacciones", "var(--color-primary)")
@@ -1577,9 +1658,9 @@ elif selected_module == "Cuenta T":
         st.markdown("<div class='section-header'>Inteligencia Estadística y Distribución</div>", unsafe_allow_html=True)
 
         s1, s2, s3, s4 = st.columns(4)
-        with s1: render_stat_element("Monto Máximo", f"${df_filtered['total'].max():,.2f}", "Peak Value")
-        with s2: render_stat_element("Desviación Est.", f"${df_filtered['total'].std():,.2f}", "Sigma Variance")
-        with s3: render_stat_element("Rango Operativo", f"${df_filtered['total'].max() - df_filtered['total'].min():,.2f}", "Full Spread")
+        with s1: render_stat_element("Monto Máximo", f"${kpis['max']:,.2f}", "Peak Value")
+        with s2: render_stat_element("Desviación Est.", f"${kpis['std']:,.2f}", "Sigma Variance")
+        with s3: render_stat_element("Rango Operativo", f"${kpis['max'] - kpis['min']:,.2f}", "Full Spread")
         with s4: render_stat_element("Promedio", f"${avg:,.2f}", "Mean Density")
 
         # LÍNEA DIVISORIA
@@ -1590,21 +1671,24 @@ elif selected_module == "Cuenta T":
 
         with st.container():
             if not df_filtered.empty:
-                # 1. Cálculo de Quintiles
-                q_vals = df_filtered['total'].quantile([0.2, 0.4, 0.6, 0.8, 1.0]).values
+                def quintiles():
+                    # 1. Cálculo de Quintiles
+                    q_vals = df_filtered['total'].quantile([0.2, 0.4, 0.6, 0.8, 1.0]).values
+                    # Concentración: only the amounts are needed, not a copy of the frame
+                    quintil = pd.qcut(df_filtered['total'], 5, labels=['Q1 (Bajo)', 'Q2', 'Q3', 'Q4', 'Q5 (Alto)'], duplicates='drop')
+                    q_dist = df_filtered['total'].groupby(quintil.rename('quintil'), observed=False).agg(['sum']).reset_index()
+                    if q_dist['sum'].sum() > 0:
+                       q_dist['porcentaje'] = (q_dist['sum'] / q_dist['sum'].sum()) * 100
+                    else:
+                       q_dist['porcentaje'] = 0
+                    return q_vals, q_dist
+
+                q_vals, q_dist = aggregate_cache.memoize(agg_scope, 'quintiles', quintiles)
                 
                 # Renderizado de Tarjetas Quantum
                 render_quantum_kpis(q_vals[0], q_vals[1], q_vals[2], q_vals[3], q_vals[4])
 
                 # 3. Gráfico de Concentración
-                df_q = df_filtered.copy() # Avoid modifying main df view
-                df_q['quintil'] = pd.qcut(df_q['total'], 5, labels=['Q1 (Bajo)', 'Q2', 'Q3', 'Q4', 'Q5 (Alto)'], duplicates='drop')
-                q_dist = df_q.groupby('quintil', observed=False)['total'].agg(['sum']).reset_index()
-                
-                if q_dist['sum'].sum() > 0:
-                   q_dist['porcentaje'] = (q_dist['sum'] / q_dist['sum'].sum()) * 100
-                else:
-                   q_dist['porcentaje'] = 0
 
                 fig_q = px.bar(
                     q_dist, x='quintil', y='sum',
@@ -1707,8 +1791,9 @@ elif selected_module == "Cuenta T":
 
         entity_col = 'receptor_nombre' if 'receptor_nombre' in df_filtered.columns else 'receptor_id'
         if not df_filtered.empty:
-            top10 = df_filtered.groupby(entity_col)['total'].sum().nlargest(10).reset_index()
-            top10 = top10.sort_values('total', ascending=True) 
+            top10 = aggregate_cache.memoize(
+                agg_scope, f'top10:{entity_col}',
+                lambda: df_filtered.groupby(entity_col)['total'].sum().nlargest(10).reset_index().sort_values('total', ascending=True))
 
             # --- REEMPLAZO PREMIUM: TABLA INTELIGENTE EN LUGAR DE GRÁFICO BÁSICO ---
             # --- REEMPLAZO PREMIUM: TABLA HTML PERSONALIZADA (FONDO BLANCO, LETRAS NEGRAS) ---
@@ -1751,7 +1836,9 @@ elif selected_module == "Cuenta T":
         if not df_filtered.empty:
             # Preparamos los datos semanalmente (o según filtro)
             time_agg_p = time_agg_code if 'time_agg_code' in locals() else 'W'
-            df_w = df_filtered.set_index('fecha_emision').resample(time_agg_p)['total'].sum().reset_index()
+            df_w = aggregate_cache.memoize(
+                agg_scope, f'resample:{time_agg_p}',
+                lambda: df_filtered.set_index('fecha_emision').resample(time_agg_p)['total'].sum().reset_index())
 
             # Creamos la gráfica de área con mejoras visuales
             fig_area = px.area(
@@ -1803,7 +1890,9 @@ elif selected_module == "Cuenta T":
         
         st.markdown('<div class="section-header">CASCADA FINANCIERA</div>', unsafe_allow_html=True)
         
-        sums = df_filtered[['ventas_brutas', 'calc_traslados', 'calc_retenciones', 'descuento', 'ventas_netas_calc']].sum()
+        sums = aggregate_cache.memoize(
+            agg_scope, 'waterfall',
+            lambda: df_filtered[['ventas_brutas', 'calc_traslados', 'calc_retenciones', 'descuento', 'ventas_netas_calc']].sum())
         
         fig_water = go.Figure(go.Waterfall(
             orientation = "v",
@@ -1873,10 +1962,14 @@ elif selected_module == "Riesgos":
             target_col = 'uso_cfdi' if 'uso_cfdi' in df_filtered.columns else ('tipo' if 'tipo' in df_filtered.columns else None)
             
             if all(col in df_filtered.columns for col in sankey_cols) and target_col:
-                top_15_names = df_filtered.groupby('emisor_nombre')['total'].sum().nlargest(15).index.tolist()
-                df_sankey_data = df_filtered[df_filtered['emisor_nombre'].isin(top_15_names)].copy()
-                links = df_sankey_data.groupby(['emisor_nombre', target_col])['total'].sum().reset_index()
-                nodes = list(set(links['emisor_nombre'].unique()) | set(links[target_col].unique()))
+                def sankey_links():
+                    top_15_names = df_filtered.groupby('emisor_nombre')['total'].sum().nlargest(15).index.tolist()
+                    df_sankey_data = df_filtered[df_filtered['emisor_nombre'].isin(top_15_names)]
+                    links = df_sankey_data.groupby(['emisor_nombre', target_col])['total'].sum().reset_index()
+                    nodes = list(set(links['emisor_nombre'].unique()) | set(links[target_col].unique()))
+                    return links, nodes
+
+                links, nodes = aggregate_cache.memoize(agg_scope, f'sankey:{target_col}', sankey_links)
                 node_idx = {name: i for i, name in enumerate(nodes)}
                 
                 fig_sankey = go.Figure(data=[go.Sankey(
@@ -1972,6 +2065,7 @@ elif selected_module == "Materialidad / REPSE":
         # Construct Data Lake
         data_lake = {
             'cfdis': df, 
+            'cfdis_index': df_index,
             'cfdi_emisors': df_emisors,
             'cfdi_receptors': df_receptors,
             'cfdi_conceptos': df_conceptos
@@ -1989,21 +2083,26 @@ elif selected_module == "Compliance":
          st.caption("Ejecuta una validación algorítmica de la Tasa Efectiva por factura. Detecta discrepancias matemáticas entre la Base y el Impuesto Trasladado que los modelos automatizados del SAT marcan inmediatamente como 'inconsistencia de cálculo' o riesgo de evasión.")
          
          if 'subtotal' in df_filtered.columns and 'calc_iva' in df_filtered.columns:
-             # Logic: Tasa = IVA / Subtotal
-             # Handle 0 division
-             df_tabs = df_filtered.copy()
-             df_tabs['tasa_calculada'] = df_tabs.apply(lambda x: x['calc_iva'] / x['subtotal'] if x['subtotal'] > 0 else 0, axis=1)
-             
-             # Identify specific tax rates + tolerance
-             # 16% (0.16), 8% (0.08), 0% (0.0)
-             tolerance = 0.01
-             mask_16 = (df_tabs['tasa_calculada'] - 0.16).abs() < tolerance
-             mask_08 = (df_tabs['tasa_calculada'] - 0.08).abs() < tolerance
-             mask_00 = (df_tabs['tasa_calculada'] - 0.0).abs() < tolerance
-             
-             df_tabs['es_anomalo'] = ~(mask_16 | mask_08 | mask_00)
-             
-             anomalias = df_tabs[df_tabs['es_anomalo']]
+             def tasas_check():
+                 # Logic: Tasa = IVA / Subtotal
+                 # Handle 0 division
+                 # Only the per-invoice rates are kept: the rows are re-sliced from df_filtered
+                 subtotal = df_filtered['subtotal']
+                 tasa = (df_filtered['calc_iva'] / subtotal.where(subtotal > 0)).fillna(0).to_numpy(dtype=np.float64)
+                 
+                 # Identify specific tax rates + tolerance
+                 # 16% (0.16), 8% (0.08), 0% (0.0)
+                 tolerance = 0.01
+                 mask_16 = np.abs(tasa - 0.16) < tolerance
+                 mask_08 = np.abs(tasa - 0.08) < tolerance
+                 mask_00 = np.abs(tasa - 0.0) < tolerance
+                 
+                 return tasa, ~(mask_16 | mask_08 | mask_00)
+
+             tasa, es_anomalo = aggregate_cache.memoize(agg_scope, 'tasas', tasas_check)
+             df_tabs = df_filtered[[c for c in ['uuid', 'subtotal', 'calc_iva'] if c in df_filtered.columns]].assign(
+                 tasa_calculada=tasa, es_anomalo=es_anomalo)
+             anomalias = df_tabs[es_anomalo]
              num_anomalias = len(anomalias)
              
              m1, m2 = st.columns(2)
@@ -2058,7 +2157,11 @@ elif selected_module == "Compliance":
                 mask_rep = pd.Series([False]*len(df_filtered))
              
              monto_ppd = df_filtered.loc[mask_ppd, 'total'].sum()
-             monto_rep = df_filtered.loc[mask_rep, 'total'].sum()
+             if 'rep_pagado' in df_filtered.columns:
+                 # Payments applied per invoice by the pipeline (REP documentos relacionados)
+                 monto_rep = df_filtered.loc[mask_ppd, 'rep_pagado'].fillna(0).sum()
+             else:
+                 monto_rep = df_filtered.loc[mask_rep, 'total'].sum()
              
              gap = monto_ppd - monto_rep
              # Avoid div by zero
@@ -2099,6 +2202,13 @@ elif selected_module == "Compliance":
              fig_gauge.update_layout(paper_bgcolor = "rgba(0,0,0,0)", font = {'color': "black", 'family': "JetBrains Mono"})
              st.plotly_chart(fig_gauge, use_container_width=True)
              
+             if 'rep_saldo_insoluto' in df_filtered.columns:
+                 pendientes = df_filtered[mask_ppd & (df_filtered['rep_saldo_insoluto'] > 0.01)]
+                 if not pendientes.empty:
+                     st.markdown("**Facturas PPD con saldo insoluto**")
+                     cols_pend = [c for c in ['uuid', 'fecha_emision', 'emisor_nombre', 'total', 'rep_pagado', 'rep_saldo_insoluto', 'rep_parcialidades', 'rep_ultimo_pago'] if c in pendientes.columns]
+                     st.dataframe(pendientes.sort_values('rep_saldo_insoluto', ascending=False)[cols_pend], use_container_width=True, hide_index=True)
+             
              if gap > 0:
                  st.error(f"⚠️ RIESGO CRÍTICO DE DEDUCIBILIDAD: Existe una brecha de ${gap:,.2f} en facturas PPD sin complemento de pago asociado. Esto podría resultar en el rechazo del acreditamiento de IVA.")
              elif gap < 0:
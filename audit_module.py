@@ -1,7 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import streamlit.components.v1 as components
 
+import frame_index
+import search_index
+import tenant_frame
+
 def render_invoice_module(data_lake):
     """
     Renders the Invoice Audit Module with Forensic Health Checks.
@@ -17,8 +22,13 @@ def render_invoice_module(data_lake):
     try:
         # Unir CFDI con Emisor y Receptor (Capa Gold) utilizando los nombres de columna actualizados
         # Nota: Ajustado a emisor_rfc / receptor_rfc según estructura de app.py
-        df_master = data_lake['cfdis'].copy()
+        df_master = data_lake['cfdis']
         df_conceptos = data_lake['cfdi_conceptos']
+        # The dashboard's date-sorted index over the same frame (see frame_index)
+        df_index = data_lake.get('cfdis_index')
+        if df_index is None:
+            df_index = frame_index.FrameIndex(df_master)
+        df_master = df_index.frame
     except Exception as e:
         st.error(f"Error processing data: {e}")
         return
@@ -40,35 +50,28 @@ def render_invoice_module(data_lake):
             with col_c3:
                 filter_current_month = st.checkbox("📅 Mes Actual")
 
-    # Apply Filters
-    mask = pd.Series(True, index=df_master.index)
+    # Apply Filters: the month is a slice of the date-sorted frame, the other criteria
+    # only run on the rows inside it
+    rows = slice(None)
+    if filter_current_month and 'fecha_emision' in df_master.columns:
+        now = pd.Timestamp.now()
+        rows = df_index.month_slice(now.year, now.month)
+    df_scope = df_master.iloc[rows]
+    mask = np.ones(len(df_scope), dtype=bool)
     
     if search_term:
-        term = search_term.lower()
-        search_mask = (
-            df_master['emisor_rfc'].astype(str).str.lower().str.contains(term) |
-            df_master['emisor_nombre'].astype(str).str.lower().str.contains(term) |
-            df_master['receptor_rfc'].astype(str).str.lower().str.contains(term) |
-            df_master['receptor_nombre'].astype(str).str.lower().str.contains(term) |
-            df_master['folio'].astype(str).str.lower().str.contains(term) |
-            df_master['uuid'].astype(str).str.lower().str.contains(term)
-        )
-        mask = mask & search_mask
+        # Trigram index over the whole frame, built once per data version (search_index):
+        # accent-insensitive substring match on RFCs, names, folio and uuid
+        search_mask = search_index.for_frame(df_master).search_mask(search_term)
+        mask = mask & search_mask[rows]
 
-    if filter_cancel and 'estatus' in df_master.columns:
-        mask = mask & (df_master['estatus'].astype(str).str.lower() == 'cancelado')
+    if filter_cancel and 'estatus' in df_scope.columns:
+        mask = mask & (df_scope['estatus'].astype(str).str.lower() == 'cancelado').to_numpy()
     
     if filter_high_val:
-        mask = mask & (df_master['total'] > 50000)
-        
-    if filter_current_month and 'fecha_emision' in df_master.columns:
-        now = pd.Timestamp.now()
-        mask = mask & (
-            (df_master['fecha_emision'].dt.month == now.month) & 
-            (df_master['fecha_emision'].dt.year == now.year)
-        )
+        mask = mask & (df_scope['total'] > 50000).to_numpy()
 
-    df_filtered = df_master.loc[mask].copy()
+    df_filtered = df_scope[mask].copy()
 
     # Results Table
     if not df_filtered.empty:
@@ -313,10 +316,8 @@ def render_invoice_html(row, df_conceptos):
     def fmt(val):
         return f"{val:,.2f}"
 
-    concepts_subset = pd.DataFrame()
-    invoice_uuid = row.get('uuid')
-    if pd.notnull(invoice_uuid) and 'uuid' in df_conceptos.columns:
-        concepts_subset = df_conceptos[df_conceptos['uuid'] == invoice_uuid]
+    # Concepts come indexed by invoice uuid (tenant_frame.concepts_by_uuid)
+    concepts_subset = tenant_frame.concepts_of(df_conceptos, row.get('uuid'))
              
     rows_html = ""
     if not concepts_subset.empty:
@@ -0,0 +1,160 @@
+"""
+One-time backfill of the derived gold columns (gold_derived) for gold written before
+the pipeline stored them, so app.load_data never parses dates on load.
+
+- MongoDB (MONGO_URI set): the tenant's documents missing a derived column, or whose
+  fecha_emision is not a BSON date (ISO strings, legacy millisecond epochs), get the
+  canonical date, month_year, fecha_dt and the derived columns. Unordered bulk
+  updates of MONGO_BATCH_SIZE documents; the content hash is left alone, so the
+  next ingest rewrites them with the pipeline's own values.
+- Local gold store: every month partition without the derived columns is rewritten
+  (one partition at a time, swapped in whole).
+- --legacy-json: imports DATA_DIR/gold_cfdi_processed.json into the local store
+  when the tenant has no partitions yet, instead of parsing it on every load.
+
+Running it again only touches what is still missing.
+
+Usage:
+    python backfill_gold.py                     # COMPANY_ID
+    python backfill_gold.py --company 2 --company 3 --legacy-json
+"""
+import os
+import json
+import atexit
+import logging
+import argparse
+
+import pandas as pd
+import pymongo
+from dotenv import load_dotenv
+
+import mongo_pool
+import gold_store
+import gold_derived
+from gold_writer import MONGO_BATCH_SIZE
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME", "cfdi_db")
+COLLECTION_NAME = os.getenv("COLLECTION_NAME", "gold_cfdi")
+DATA_DIR = os.getenv("DATA_DIR", "./data")
+
+LEGACY_JSON = "gold_cfdi_processed.json"
+
+READ_FIELDS = ['fecha_emision'] + gold_derived.VENTAS_NETAS_INPUTS
+
+_mongo = None
+
+
+def mongo_db():
+    """The gold database on the process's one pooled client, shared by every tenant backfilled."""
+    global _mongo
+    if _mongo is None:
+        # pymongo's default timeouts, as in the pipeline: bulk updates outlast the dashboard's 30s socket timeout
+        _mongo = mongo_pool.MongoPool(MONGO_URI, server_selection_ms=30000, connect_timeout_ms=20000,
+                                      socket_timeout_ms=None)
+        atexit.register(_mongo.close)
+    return _mongo.database(DB_NAME)
+
+
+def derived_fields(df):
+    """The columns the backfill sets, computed from the stored fecha_emision and money inputs."""
+    df = gold_derived.add_derived(df)
+    df['fecha_dt'] = df['fecha_emision']
+    df['month_year'] = df['fecha_emision'].dt.to_period('M').astype(str).where(df['fecha_emision'].notna())
+    return df[[c for c in ['fecha_emision', 'fecha_dt', 'month_year'] + gold_derived.DERIVED_COLUMNS if c in df.columns]]
+
+
+def stale_query(company_id):
+    return {"company_id": company_id, "$or": [{col: {"$exists": False}} for col in gold_derived.DERIVED_COLUMNS]
+            + [{"fecha_emision": {"$not": {"$type": "date"}}}]}
+
+
+def backfill_mongo(collection, company_id, batch_size=MONGO_BATCH_SIZE):
+    """Updates the tenant's stale documents. Returns how many were modified."""
+    modified = 0
+    projection = {col: 1 for col in READ_FIELDS}
+
+    def flush(docs):
+        frame = derived_fields(pd.DataFrame(docs))
+        updates = []
+        for doc_id, record in zip((d['_id'] for d in docs), frame.to_dict(orient='records')):
+            fields = {k: v for k, v in record.items() if pd.notnull(v)}
+            if fields:
+                updates.append(pymongo.UpdateOne({"_id": doc_id}, {"$set": fields}))
+        return collection.bulk_write(updates, ordered=False).modified_count if updates else 0
+
+    batch = []
+    for doc in collection.find(stale_query(company_id), projection, batch_size=batch_size):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            modified += flush(batch)
+            batch = []
+    if batch:
+        modified += flush(batch)
+    return modified
+
+
+def backfill_local(root, company_id):
+    """Rewrites the tenant's partitions that lack the derived columns. Returns the months rewritten."""
+    rewritten = []
+    for month in gold_store.list_partitions(root, company_id):
+        df = gold_store.read_gold(root, company_id, months=[month])
+        if df is None or df.empty or gold_derived.is_current(df):
+            continue
+        df = gold_derived.add_derived(df)
+        if 'fecha_dt' in df.columns:
+            df['fecha_dt'] = df['fecha_emision']
+        gold_store.replace_partitions(df, root, company_id, months=[month])
+        rewritten.append(month)
+    return rewritten
+
+
+def import_legacy_json(data_dir, root, company_id):
+    """Loads the legacy single-file export into the local store. Returns the rows imported."""
+    path = os.path.join(data_dir, LEGACY_JSON)
+    if not os.path.exists(path):
+        return 0
+    if gold_store.list_partitions(root, company_id):
+        logging.info(f"{company_id} already has gold partitions, {LEGACY_JSON} not imported")
+        return 0
+    with open(path, 'r') as f:
+        df = pd.DataFrame(json.load(f))
+    if 'company_id' in df.columns:
+        df = df[df['company_id'].astype(str) == str(company_id)]
+    if df.empty:
+        return 0
+    df = gold_derived.add_derived(df.assign(company_id=company_id))
+    df['fecha_dt'] = df['fecha_emision']
+    df['month_year'] = df['fecha_emision'].dt.to_period('M').astype(str)
+    unique_field = 'uuid' if 'uuid' in df.columns else 'id'
+    gold_store.write_gold(df, root, company_id, unique_field, full=True)
+    return len(df)
+
+
+def backfill(company_id, data_dir=DATA_DIR, legacy_json=False):
+    root = gold_store.store_root(data_dir)
+    if legacy_json:
+        imported = import_legacy_json(data_dir, root, company_id)
+        if imported:
+            logging.info(f"{company_id}: {imported:,} rows imported from {LEGACY_JSON}")
+    if MONGO_URI:
+        collection = mongo_db()[COLLECTION_NAME]
+        logging.info(f"{company_id}: {backfill_mongo(collection, company_id):,} MongoDB documents backfilled")
+    months = backfill_local(root, company_id)
+    logging.info(f"{company_id}: {len(months)} local partitions backfilled")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--company", action="append", help="Tenant to backfill (repeatable, default COMPANY_ID)")
+    parser.add_argument("--legacy-json", action="store_true", help=f"Import DATA_DIR/{LEGACY_JSON} into the local store")
+    args = parser.parse_args()
+    for company_id in args.company or [os.getenv("COMPANY_ID", "DEFAULT_TENANT")]:
+        backfill(company_id, legacy_json=args.legacy_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Scaling benchmark: the migration pipeline, the dashboard loader, the risk scoring and
+the FastAPI endpoints on synthetic exports of growing size.
+
+For each scale a synthetic export is generated once (benchmarks/synthetic_exports.py)
+and reused by later runs. Then:
+    migration     migration.main(full=True), batch or --stream above --stream-above
+    load_data     app.load_data (full tenant, and the latest month only)
+    risk_scores   app.py calculate_risk_scores over the tenant, and RiskService's
+                  per-invoice metrics for --risk-sample invoices
+    search_index  the audit search index over the tenant, and one substring query
+    api/*         the dashboard and KPI endpoint handlers, against MONGO_URI
+                  (only when MONGO_URI is set and fastapi is installed)
+
+app.py is a Streamlit script that renders the dashboard when imported, so the
+benchmarked functions are compiled from its source with its imports, without
+their st.cache_data decorators: every timing is a cold call.
+
+Usage:
+    python benchmarks/bench_scaling.py --scales 1000000 5000000 --work-dir /data/bench
+"""
+import os
+import sys
+import ast
+import json
+import time
+import asyncio
+import argparse
+import logging
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BACKEND = os.path.join(ROOT, "konia-react-migration", "backend")
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import migration
+import run_profile
+import fiscal_reports
+import search_index
+import synthetic_exports
+
+COMPANY_ID = "1"
+APP_PATH = os.path.join(ROOT, "app.py")
+
+
+def app_function(name, path=APP_PATH):
+    """
+    A function from app.py (top level or nested in the page code), compiled without
+    its decorators together with app.py's imports and the module constants it reads.
+    Imports that are missing here (streamlit, plotly) are skipped.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    target = next(node for node in ast.walk(tree) if isinstance(node, ast.FunctionDef) and node.name == name)
+    target.decorator_list = []
+    used = {node.id for node in ast.walk(target) if isinstance(node, ast.Name)}
+
+    namespace = {"__name__": f"app_{name}"}
+    for node in tree.body:
+        is_import = isinstance(node, (ast.Import, ast.ImportFrom))
+        is_constant = isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id in used for t in node.targets)
+        if not (is_import or is_constant):
+            continue
+        try:
+            exec(compile(ast.Module([node], type_ignores=[]), path, 'exec'), namespace)
+        except Exception:
+            pass
+    exec(compile(ast.Module([target], type_ignores=[]), path, 'exec'), namespace)
+    return namespace[name]
+
+
+def timed(fn, *args, repeat=1, **kwargs):
+    """Best wall time of repeat calls and the last result."""
+    best, result = float('inf'), None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def ensure_dataset(work_dir, n, months, seed):
+    path = os.path.join(work_dir, f"cfdis_{n}")
+    if synthetic_exports.is_complete(path, n, months, seed):
+        print(f"Reusing synthetic export {path}")
+    else:
+        print(f"Generating {n:,} CFDIs into {path}")
+        synthetic_exports.generate(path, n, months, seed)
+    return path
+
+
+def bench_migration(data_dir, stream, chunksize):
+    migration.DATA_DIR = data_dir
+    seconds, summary = timed(migration.main, full=True, chunksize=chunksize if stream else None,
+                             company_id=COMPANY_ID, use_cache=False)
+    return {
+        "seconds": seconds,
+        "mode": "stream" if stream else "batch",
+        "rows_written": summary["rows_written"] if summary else 0,
+        "rss_peak_mb": run_profile.rss_peak_mb(),
+        "stages": summary["stages"] if summary else {},
+    }
+
+
+def bench_dashboard(data_dir, repeat, risk_sample):
+    os.environ["DATA_DIR"] = data_dir
+    load_data = app_function("load_data")
+    results = {}
+    results["load_data"], df = timed(load_data, COMPANY_ID, repeat=repeat)
+    if df is None or df.empty:
+        return results, df
+    latest = [df['month'].max()]
+    results["load_data_latest_month"], _ = timed(load_data, COMPANY_ID, months=latest, repeat=repeat)
+
+    calculate_risk_scores = app_function("calculate_risk_scores")
+    results["risk_scores"], _ = timed(calculate_risk_scores, df, repeat=repeat)
+
+    results["search_index_build"], index = timed(search_index.SearchIndex, df, repeat=repeat)
+    term = str(df['emisor_nombre'].iloc[0])[:8]
+    results["search_index_query"], _ = timed(index.search, term, repeat=repeat)
+
+    # RiskService without the database: the same issuer context the endpoint would fetch
+    sys.path.insert(0, BACKEND)
+    try:
+        from app.services.risk_wrapper import RiskService
+    except ImportError as e:
+        logging.warning(f"RiskService not importable, skipped: {e}")
+        return results, df
+    finally:
+        sys.path.remove(BACKEND)
+    service = RiskService.__new__(RiskService)
+    sample = df.sample(min(risk_sample, len(df)), random_state=0)
+    by_emisor = {rfc: group[['total']].assign(fecha=group['fecha_emision'].astype(str))
+                 for rfc, group in df[df['emisor_rfc'].isin(sample['emisor_rfc'])].groupby('emisor_rfc')}
+
+    def score_sample():
+        for row in sample.assign(fecha=sample['fecha_emision'].astype(str)).to_dict(orient='records'):
+            service._calculate_risk_metrics(row, by_emisor[row['emisor_rfc']].copy())
+    results["risk_service_per_invoice"], _ = timed(score_sample, repeat=repeat)
+    results["risk_service_per_invoice"] /= len(sample)
+    return results, df
+
+
+def bench_api(df, repeat):
+    """Endpoint handlers called directly (no HTTP, no auth) against MONGO_URI."""
+    if not os.getenv("MONGO_URI"):
+        print("  MONGO_URI not set: API endpoints skipped")
+        return {}
+    sys.path.insert(0, BACKEND)
+    try:
+        from app.api import dashboard, kpis
+        from app.core.database import db
+    except ImportError as e:
+        print(f"  fastapi backend not importable ({e}): API endpoints skipped")
+        return {}
+    finally:
+        sys.path.remove(BACKEND)
+
+    db.connect()
+    user = {"company_id": fiscal_reports.report_company_id(COMPANY_ID)}
+    periodo = df['month'].max()
+    uuid = df.loc[df['tipo'] == 'i', 'uuid'].iloc[0] if (df['tipo'] == 'i').any() else df['uuid'].iloc[0]
+    calls = {
+        "periodos-disponibles": lambda: kpis.get_periodos(user=user),
+        "kpis/resumen": lambda: kpis.get_kpis_resumen(periodo=periodo, user=user),
+        "matriz-resumen": lambda: dashboard.get_matriz_resumen(periodo=periodo, user=user),
+        "matriz-resumen/evolucion": lambda: dashboard.get_matriz_evolucion(user=user),
+        "matriz-resumen/tabla": lambda: dashboard.get_tabla_matriz(periodo=periodo, user=user),
+        "detalle-uuid": lambda: dashboard.get_detalle_uuid(periodo=periodo, page=1, limit=25, flujo=None, segmento=None,
+                                                           uuid_search=None, saldo_min=None, user=user),
+        "trazabilidad/uuids": lambda: dashboard.get_trazabilidad_uuids(periodo=periodo, page=1, limit=50, user=user),
+        "trazabilidad/{uuid}": lambda: dashboard.get_trazabilidad_detalle(uuid_raiz=uuid, user=user),
+        "riesgos/{uuid}": lambda: dashboard.get_risk_analysis(uuid=uuid, current_user=user),
+    }
+    results = {}
+    try:
+        for name, call in calls.items():
+            try:
+                results[f"api/{name}"], _ = timed(lambda: asyncio.run(call()), repeat=repeat)
+            except Exception as e:
+                print(f"  api/{name} failed: {e}")
+    finally:
+        db.close()
+    return results
+
+
+def print_table(results):
+    names = []
+    for r in results:
+        names += [n for n in r["timings"] if n not in names]
+    print(f"\n{'benchmark':<32}" + "".join(f"{r['cfdis']:>14,}" for r in results))
+    for name in names:
+        cells = "".join(f"{r['timings'][name]:>13.3f}s" if name in r["timings"] else f"{'-':>14}" for r in results)
+        print(f"{name:<32}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs='+', default=[1_000_000, 5_000_000], help="CFDIs per synthetic export")
+    parser.add_argument("--work-dir", required=True, help="Where the synthetic exports (and their gold) are kept")
+    parser.add_argument("--months", type=int, default=synthetic_exports.DEFAULT_MONTHS)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--stream-above", type=int, default=5_000_000, help="Use the streaming pipeline above this many CFDIs")
+    parser.add_argument("--chunksize", type=int, default=migration.CHUNK_SIZE)
+    parser.add_argument("--repeat", type=int, default=1, help="Best of N for the read-side benchmarks")
+    parser.add_argument("--risk-sample", type=int, default=1000, help="Invoices scored one by one through RiskService")
+    parser.add_argument("--skip-migration", action="store_true", help="Reuse the gold already built in the work dir")
+    parser.add_argument("--report", help="JSON results path (default bench_scaling.json in the work dir)")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.scales:
+        data_dir = ensure_dataset(args.work_dir, n, args.months, args.seed)
+        entry = {"cfdis": n, "data_dir": data_dir, "timings": {}}
+        if not args.skip_migration:
+            print(f"migration.main on {n:,} CFDIs")
+            entry["migration"] = bench_migration(data_dir, n > args.stream_above, args.chunksize)
+            entry["timings"]["migration"] = entry["migration"]["seconds"]
+        print(f"Dashboard loaders on {n:,} CFDIs")
+        timings, df = bench_dashboard(data_dir, args.repeat, args.risk_sample)
+        entry["timings"].update(timings)
+        if df is not None and not df.empty:
+            entry["timings"].update(bench_api(df, args.repeat))
+        results.append(entry)
+        print_table(results)
+
+    report = args.report or os.path.join(args.work_dir, "bench_scaling.json")
+    with open(report, 'w', encoding='utf-8') as f:
+        json.dump({"environment": run_profile.environment(), "results": results}, f, indent=2, default=str)
+    print(f"\nResults written to {report}")
+
+
+if __name__ == "__main__":
+    main()
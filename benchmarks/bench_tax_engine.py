@@ -0,0 +1,95 @@
+"""
+Benchmark: legacy six-pass tax aggregation vs tax_engine single pivot.
+
+Usage:
+    python benchmarks/bench_tax_engine.py --cfdis 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import tax_engine
+
+
+def legacy_aggregate_taxes(cfdis, impuestos, traslados, retenciones):
+    """The filter + groupby + merge implementation previously inlined in migration.main()."""
+    traslados_merged = traslados.merge(impuestos[['id', 'cfdi_id']], left_on='cfdi_comprobante_impuestos_id', right_on='id', suffixes=('_tras', '_imp'))
+    total_traslados = traslados_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_traslados'})
+    cfdis = cfdis.merge(total_traslados, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_traslados': 0})
+    iva_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_iva'})
+    ieps_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('003', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ieps'})
+    cfdis = cfdis.merge(iva_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_iva': 0})
+    cfdis = cfdis.merge(ieps_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ieps': 0})
+
+    retenciones_merged = retenciones.merge(impuestos[['id', 'cfdi_id']], left_on='cfdi_comprobante_impuestos_id', right_on='id', suffixes=('_ret', '_imp'))
+    total_retenciones = retenciones_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_retenciones'})
+    cfdis = cfdis.merge(total_retenciones, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_retenciones': 0})
+    isr_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('001', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_isr'})
+    iva_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_iva'})
+    cfdis = cfdis.merge(isr_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_isr': 0})
+    cfdis = cfdis.merge(iva_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_iva': 0})
+    return cfdis
+
+
+def make_dataset(n_cfdis, seed=7):
+    """Synthetic cfdis/impuestos/traslados/retenciones with string impuesto codes."""
+    rng = np.random.default_rng(seed)
+    cfdis = pd.DataFrame({
+        'id': np.arange(1, n_cfdis + 1),
+        'subtotal': rng.gamma(2.0, 5000.0, n_cfdis).round(2),
+        'descuento': 0.0,
+    })
+    impuestos = pd.DataFrame({'id': np.arange(1, n_cfdis + 1), 'cfdi_id': cfdis['id'].to_numpy()})
+
+    # ~1.3 traslados per CFDI (IVA, some IEPS), ~5% of CFDIs with retenciones
+    n_tras = int(n_cfdis * 1.3)
+    traslados = pd.DataFrame({
+        'cfdi_comprobante_impuestos_id': rng.integers(1, n_cfdis + 1, n_tras),
+        'impuesto': rng.choice(['002', '003'], n_tras, p=[0.9, 0.1]),
+        'importe': rng.gamma(2.0, 800.0, n_tras).round(2),
+    })
+    n_ret = int(n_cfdis * 0.05)
+    retenciones = pd.DataFrame({
+        'cfdi_comprobante_impuestos_id': rng.integers(1, n_cfdis + 1, n_ret),
+        'impuesto': rng.choice(['001', '002'], n_ret),
+        'importe': rng.gamma(2.0, 300.0, n_ret).round(2),
+    })
+    return cfdis, impuestos, traslados, retenciones
+
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfdis", type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'cfdis':>12} {'legacy (s)':>12} {'engine (s)':>12} {'speedup':>9}")
+    for n in args.cfdis:
+        data = make_dataset(n)
+        t_legacy, legacy = timed(legacy_aggregate_taxes, *data, repeat=args.repeat)
+        t_engine, engine = timed(tax_engine.aggregate_taxes, *data, repeat=args.repeat)
+
+        cols = list(tax_engine.TAX_COLUMNS)
+        legacy = legacy.sort_values('id').reset_index(drop=True)[cols]
+        engine = engine.sort_values('id').reset_index(drop=True)[cols]
+        pd.testing.assert_frame_equal(legacy, engine, check_dtype=False)
+
+        print(f"{n:>12,} {t_legacy:>12.3f} {t_engine:>12.3f} {t_legacy / t_engine:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,769 @@
+"""
+Synthetic Laravel exports at production scale, for benchmarking the pipeline and the dashboards.
+
+Writes the CSV tables of the real export with consistent ids and totals:
+cfdis, cfdi_emisors/cfdi_receptors, cfdi_conceptos with their concept impuestos,
+traslados and retenciones, the comprobante impuestos, cfdi_relacionados, the REP
+payment tables (pagos, detalles, documentos relacionados, dr impuestos, totales)
+and nómina (nominas, percepciones, deducciones, otros pagos, horas extra,
+emisores and receptores).
+
+Distributions follow the real export: mostly emitted ingresos with a long tail of
+clients (Zipf), PPD invoices paid in 1-3 parcialidades, business-hours timestamps,
+IVA 16% with some 8% / 0%, a few retentions and IEPS, ~2% cancelled. CFDI ids
+follow fecha_emision, like an export ordered by download.
+
+Rows are generated and appended in blocks, so 50M CFDIs never sit in memory.
+
+Usage:
+    python benchmarks/synthetic_exports.py --cfdis 1000000 --out /tmp/synth_1m
+"""
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+DEFAULT_BLOCK = 250_000
+DEFAULT_MONTHS = 24
+START_MONTH = np.datetime64('2024-01', 'M')
+COMPANY_RFC = "KDE210101AB1"
+COMPANY_NAME = "KONIA DEMO SA DE CV"
+COMPANY_CP = "94299"
+COMPLETE_MARKER = ".synthetic.json"
+
+TIPO_P = {'I': 0.70, 'E': 0.03, 'P': 0.12, 'N': 0.15}
+HOUR_P = np.array([1, 1, 1, 1, 1, 1, 2, 5, 8, 10, 10, 10, 9, 9, 10, 10, 9, 8, 6, 4, 3, 2, 1.5, 1], dtype=float)
+HOUR_P /= HOUR_P.sum()
+IVA_RATES, IVA_P = np.array([0.16, 0.08, 0.0]), [0.85, 0.05, 0.10]
+RET_ISR, RET_IVA, IEPS_RATE = 0.10, 0.106667, 0.08
+PARCIALIDADES, PARCIALIDADES_P = np.array([0, 1, 2, 3]), [0.15, 0.60, 0.15, 0.10]
+
+# (clave_prod_serv, clave_unidad, unidad, descripcion)
+PRODUCTS = [
+    ("43231600", "E48", "SERVICIO", "Servicio de emision de facturas a traves del portal web"),
+    ("43232403", "ACT", "Servicio", "Servicios de workspace"),
+    ("81112100", "E48", "SERVICIO", "Servicios de internet"),
+    ("81111500", "E48", "SERVICIO", "Desarrollo de software"),
+    ("80111600", "E48", "SERVICIO", "Servicios de personal temporal"),
+    ("78101800", "E48", "SERVICIO", "Servicio de flete terrestre"),
+    ("15101514", "LTR", "Litro", "Gasolina magna"),
+    ("44121600", "H87", "Pieza", "Suministros de oficina"),
+    ("43211500", "H87", "Pieza", "Equipo de computo"),
+    ("50202306", "H87", "Pieza", "Bebidas no alcoholicas"),
+    ("90101501", "E48", "SERVICIO", "Consumo de alimentos"),
+    ("80131500", "E48", "SERVICIO", "Arrendamiento de inmuebles"),
+    ("84111506", "ACT", "", "Servicios de facturacion"),
+    ("72101500", "E48", "SERVICIO", "Mantenimiento de instalaciones"),
+    ("25172500", "H87", "Pieza", "Refacciones automotrices"),
+]
+PRODUCT_P = 1.0 / np.arange(1, len(PRODUCTS) + 1) ** 0.9
+PRODUCT_P /= PRODUCT_P.sum()
+NAME_WORDS = ["GRUPO", "COMERCIAL", "SERVICIOS", "DISTRIBUIDORA", "INDUSTRIAS", "CONSTRUCTORA", "TRANSPORTES",
+              "TECNOLOGIA", "ALIMENTOS", "LOGISTICA", "CONSULTORES", "PROVEEDORA", "SOLUCIONES", "MAQUINARIA",
+              "NORTE", "PACIFICO", "DEL BAJIO", "INTEGRAL", "MEXICANA", "ESPAÑA", "PEÑA", "OCCIDENTE", "GLOBAL"]
+PERSON_NAMES = ["JUAN", "MARIA", "JOSE", "GUADALUPE", "LUIS", "ANA", "CARLOS", "SOFIA", "MIGUEL", "LAURA"]
+SURNAMES = ["HERNANDEZ", "GARCIA", "MARTINEZ", "LOPEZ", "GONZALEZ", "PEREZ", "RODRIGUEZ", "NUÑEZ", "RAMIREZ", "CRUZ"]
+REGIMENES = ["601", "603", "612", "626", "605"]
+CODIGOS_POSTALES = ["06500", "11000", "44100", "64000", "94294", "32472", "04519", "76000", "83000", "97000"]
+ESTADOS = ["VER", "CMX", "JAL", "NLE", "MEX", "PUE", "GUA", "SON"]
+DEPARTAMENTOS = ["SOPORTE TECNICO", "VENTAS", "ADMINISTRACION", "OPERACIONES", "DESARROLLO"]
+
+HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8).astype(np.uint32)
+ALNUM = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", dtype=np.uint8).astype(np.uint32)
+
+
+# --- vectorized text helpers -------------------------------------------------------
+
+def codes_to_str(codes):
+    """(n, width) uint32 code points -> array of n strings."""
+    codes = np.ascontiguousarray(codes, dtype=np.uint32)
+    return codes.view(f'<U{codes.shape[1]}').ravel()
+
+
+def uuids(rng, n, upper=False):
+    nibbles = rng.integers(0, 16, (n, 32), dtype=np.uint8)
+    nibbles[:, 12] = 4
+    nibbles[:, 16] = 8 | (nibbles[:, 16] & 3)
+    codes = HEX[nibbles]
+    if upper:
+        codes = np.where(codes >= ord('a'), codes - 32, codes)
+    return codes_to_str(np.insert(codes, [8, 12, 16, 20], ord('-'), axis=1))
+
+
+def hex_digests(rng, n, width=64):
+    return codes_to_str(HEX[rng.integers(0, 16, (n, width), dtype=np.uint8)])
+
+
+def rfcs(rng, n, persona_moral=True):
+    """RFC-shaped keys: 3 (moral) or 4 letters, a yymmdd date and a 3 character homoclave."""
+    letters = ALNUM[rng.integers(0, 26, (n, 3 if persona_moral else 4))]
+    date = rng.integers(60, 100, n) * 10000 + rng.integers(1, 13, n) * 100 + rng.integers(1, 29, n)
+    digits = ((date[:, None] // 10 ** np.arange(5, -1, -1)) % 10 + ord('0')).astype(np.uint32)
+    homoclave = ALNUM[rng.integers(0, 36, (n, 3))]
+    return codes_to_str(np.hstack([letters, digits, homoclave]))
+
+
+def digit_strings(rng, n, width):
+    return codes_to_str(rng.integers(ord('0'), ord('9') + 1, (n, width)).astype(np.uint32))
+
+
+def timestamps(values):
+    """datetime64 -> 'YYYY-MM-DD HH:MM:SS' (nullable string column)."""
+    values = np.asarray(values, dtype='datetime64[s]')
+    text = np.datetime_as_string(values, unit='s').astype('<U19')
+    codes = text.view(np.uint32).reshape(-1, 19).copy()
+    codes[:, 10] = ord(' ')
+    out = pd.Series(codes_to_str(codes), dtype='string')
+    out[np.isnat(values)] = pd.NA
+    return out
+
+
+def dates(values):
+    return pd.Series(np.datetime_as_string(np.asarray(values, dtype='datetime64[D]'), unit='D'), dtype='string')
+
+
+def pick(rng, choices, n, p=None):
+    return np.asarray(choices, dtype=object)[rng.choice(len(choices), n, p=p)]
+
+
+def zipf_ids(rng, n, first, count, a=1.3):
+    """Ids in [first, first + count) where a few hold most of the rows."""
+    return first + (rng.zipf(a, n) - 1) % max(1, count)
+
+
+def blank(n):
+    """An all-empty text column."""
+    return pd.Series(pd.NA, index=range(n), dtype='string')
+
+
+def nullable(values, mask, dtype='string'):
+    """values where mask, NA elsewhere."""
+    out = pd.Series(values, dtype=dtype)
+    out[~np.asarray(mask, dtype=bool)] = pd.NA
+    return out
+
+
+def allocate(amounts, owners, weights, last):
+    """
+    Splits amounts[owner] across rows proportionally to weights, rounded to cents,
+    with the rounding remainder on each owner's last row so the parts add up exactly.
+    """
+    totals = np.bincount(owners, weights=weights, minlength=len(amounts))
+    parts = np.round(amounts[owners] * weights / totals[owners], 2)
+    remainder = amounts - np.bincount(owners, weights=parts, minlength=len(amounts))
+    parts[last] += remainder[owners[last]]
+    return np.round(parts, 2)
+
+
+# --- catalogs ----------------------------------------------------------------------
+
+class Context:
+    """Scale-dependent sizes and the catalogs every block draws from."""
+
+    def __init__(self, total, months, seed, company_id):
+        self.total = total
+        self.months = months
+        self.company_id = company_id
+        self.n_suppliers = max(50, total // 1000)
+        self.n_clients = max(100, total // 200)
+        self.n_employees = max(20, total // 5000)
+        self.first_client = 2
+        self.first_employee = self.first_client + self.n_clients
+        self.loaded_at = START_MONTH.astype('datetime64[s]')
+
+        rng = np.random.default_rng(seed + 1_000_003)
+        self.supplier_cp = pick(rng, CODIGOS_POSTALES, self.n_suppliers + 2)
+        self.employee_salary = np.round(rng.lognormal(6.0, 0.45, self.n_employees), 2)
+        self.employee_curp = codes_to_str(ALNUM[rng.integers(0, 36, (self.n_employees, 18))])
+        self.employee_nss = digit_strings(rng, self.n_employees, 11)
+        self.employee_start = START_MONTH.astype('datetime64[D]') - rng.integers(30, 4000, self.n_employees)
+        self.employee_depto = rng.integers(0, len(DEPARTAMENTOS), self.n_employees)
+        self.employee_estado = rng.integers(0, len(ESTADOS), self.n_employees)
+
+    def company_names(self, rng, n):
+        a, b = pick(rng, NAME_WORDS, n), pick(rng, NAME_WORDS, n)
+        return pd.Series(a) + " " + pd.Series(b) + " SA DE CV"
+
+    def person_names(self, rng, n):
+        return pd.Series(pick(rng, PERSON_NAMES, n)) + " " + pd.Series(pick(rng, SURNAMES, n)) + " " + pd.Series(pick(rng, SURNAMES, n))
+
+    def emisors(self, rng):
+        n = self.n_suppliers + 1
+        ids = np.arange(1, n + 1)
+        rfc = rfcs(rng, n).astype(object)
+        rfc[0] = COMPANY_RFC
+        nombre = self.company_names(rng, n)
+        nombre[0] = COMPANY_NAME
+        stamp = timestamps(np.full(n, self.loaded_at))
+        return pd.DataFrame({
+            'id': ids, 'rfc': rfc, 'nombre': nombre, 'regimen_fiscal': pick(rng, REGIMENES, n),
+            'curp': blank(n), 'num_reg_id_trib': blank(n),
+            'residencia_fiscal': blank(n), 'metadata': blank(n),
+            'created_at': stamp, 'updated_at': stamp,
+        })
+
+    def receptors(self, rng):
+        n = 1 + self.n_clients + self.n_employees
+        ids = np.arange(1, n + 1)
+        is_employee = ids >= self.first_employee
+        rfc = np.where(is_employee, rfcs(rng, n, persona_moral=False), rfcs(rng, n)).astype(object)
+        rfc[0] = COMPANY_RFC
+        nombre = np.where(is_employee, self.person_names(rng, n), self.company_names(rng, n)).astype(object)
+        nombre[0] = COMPANY_NAME
+        stamp = timestamps(np.full(n, self.loaded_at))
+        return pd.DataFrame({
+            'id': ids, 'rfc': rfc, 'nombre': nombre, 'domicilio_fiscal_cp': pick(rng, CODIGOS_POSTALES, n),
+            'regimen_fiscal': np.where(is_employee, "605", pick(rng, REGIMENES[:3], n)),
+            'curp': blank(n), 'num_reg_id_trib': blank(n),
+            'residencia_fiscal': blank(n),
+            'uso_cfdi_preferido': np.where(is_employee, "CN01", "G03"), 'metadata': blank(n),
+            'created_at': stamp, 'updated_at': stamp,
+        })
+
+
+# --- one block of CFDIs and everything hanging from them --------------------------
+
+def emission_times(rng, ctx, ids):
+    """fecha_emision following the id order: month by position in the export, business-hours biased."""
+    month = START_MONTH + ((ids - 1) * ctx.months // ctx.total)
+    first_day = month.astype('datetime64[D]')
+    days = ((month + 1).astype('datetime64[D]') - first_day).astype(np.int64)
+    day = first_day + (rng.random(len(ids)) * days).astype(np.int64)
+    # Most weekend CFDIs move to the Friday before
+    weekday = (day.astype(np.int64) + 3) % 7
+    to_friday = (weekday >= 5) & (rng.random(len(ids)) < 0.7)
+    day = np.where(to_friday, day - (weekday - 4), day)
+    seconds = rng.choice(24, len(ids), p=HOUR_P) * 3600 + rng.integers(0, 3600, len(ids))
+    return np.sort(day.astype('datetime64[s]') + seconds.astype('timedelta64[s]'))
+
+
+def later_of(rng, candidates, after, window=200):
+    """
+    For each id in after, one of the sorted candidate ids greater than it (soon after),
+    or -1 when there is none.
+    """
+    if len(candidates) == 0:
+        return np.full(len(after), -1, dtype=np.int64)
+    pos = np.searchsorted(candidates, after, side='right')
+    room = len(candidates) - pos
+    offset = (rng.random(len(after)) * np.minimum(room, window)).astype(np.int64)
+    return np.where(room > 0, candidates[np.minimum(pos + offset, len(candidates) - 1)], -1)
+
+
+def earlier_of(rng, candidates, before, window=500):
+    """For each id in before, one of the sorted candidate ids smaller than it, or -1."""
+    if len(candidates) == 0:
+        return np.full(len(before), -1, dtype=np.int64)
+    pos = np.searchsorted(candidates, before, side='left')
+    offset = (rng.random(len(before)) * np.minimum(pos, window)).astype(np.int64) + 1
+    return np.where(pos > 0, candidates[np.maximum(pos - offset, 0)], -1)
+
+
+class Counters(dict):
+    def take(self, table, n):
+        start = self.get(table, 1)
+        self[table] = start + n
+        return np.arange(start, start + n)
+
+
+def generate_block(rng, ctx, counters, first_id, n):
+    """Every table's rows for CFDIs first_id .. first_id + n - 1, as {table: frame}."""
+    ids = np.arange(first_id, first_id + n)
+    tipo = pick(rng, list(TIPO_P), n, p=list(TIPO_P.values())).astype('<U1')
+    is_i, is_e, is_p, is_n = (tipo == 'I'), (tipo == 'E'), (tipo == 'P'), (tipo == 'N')
+    is_ie = is_i | is_e
+    fecha = emission_times(rng, ctx, ids)
+
+    emitido = np.where(is_n, True, rng.random(n) < 0.85)
+    emisor_id = np.where(emitido, 1, zipf_ids(rng, n, 2, ctx.n_suppliers))
+    receptor_id = np.where(emitido, zipf_ids(rng, n, ctx.first_client, ctx.n_clients, a=1.2), 1)
+    employee = rng.integers(0, ctx.n_employees, n)
+    receptor_id = np.where(is_n, ctx.first_employee + employee, receptor_id)
+
+    metodo = np.where(is_i & (rng.random(n) < 0.25), 'PPD', 'PUE').astype(object)
+    metodo[is_p] = None
+    cancelled = np.where(is_p, rng.random(n) < 0.005, is_ie & (rng.random(n) < 0.02))
+    uuid = uuids(rng, n)
+    serie = np.select([is_i, is_e, is_p], ['A', 'NC', 'PAGOS'], 'N')
+
+    # Amounts before taxes
+    subtotal = np.round(np.where(is_e, rng.lognormal(6.5, 1.0, n), rng.lognormal(8.0, 1.3, n)), 2)
+    rounded = is_i & (rng.random(n) < 0.04)
+    subtotal = np.where(rounded, np.maximum(100.0, np.round(subtotal, -2)), subtotal)
+    subtotal[is_p] = 0.0
+    descuento = np.where(is_i & (rng.random(n) < 0.10), np.round(subtotal * rng.uniform(0, 0.1, n), 2), 0.0)
+    iva_rate = IVA_RATES[rng.choice(len(IVA_RATES), n, p=IVA_P)]
+    has_ieps = is_ie & (iva_rate > 0) & (rng.random(n) < 0.02)
+    has_ret = is_i & (rng.random(n) < 0.05)
+
+    # Credit notes follow the invoice they relate to
+    i_ids = ids[is_i]
+    e_rel = earlier_of(rng, i_ids, ids[is_e])
+    e_pos = np.flatnonzero(is_e)[e_rel > 0]
+    e_rel = e_rel[e_rel > 0]
+    emitido[e_pos] = emitido[e_rel - first_id]
+    emisor_id[e_pos] = emisor_id[e_rel - first_id]
+    receptor_id[e_pos] = receptor_id[e_rel - first_id]
+    iva_rate[e_pos] = iva_rate[e_rel - first_id]
+
+    # Nómina amounts per N CFDI
+    n_pos = np.flatnonzero(is_n)
+    nomina = nomina_tables(rng, ctx, counters, ids[n_pos], fecha[n_pos], employee[n_pos])
+    subtotal[n_pos] = nomina['subtotal']
+    descuento[n_pos] = nomina['descuento']
+
+    # Conceptos: 1 + geometric per ingreso/egreso, one per nómina and pago
+    k = np.where(is_ie, np.minimum(rng.geometric(0.55, n), 30), 1)
+    owners = np.repeat(np.arange(n), k)
+    last = np.cumsum(k) - 1
+    weights = rng.uniform(0.2, 1.0, len(owners))
+    c_importe = allocate(subtotal, owners, weights, last)
+    c_descuento = allocate(descuento, owners, weights, last)
+    n_conceptos = len(owners)
+    c_ids = counters.take('cfdi_conceptos', n_conceptos)
+    product = rng.choice(len(PRODUCTS), n_conceptos, p=PRODUCT_P)
+    cantidad = np.where(is_ie[owners], rng.integers(1, 11, n_conceptos), 1).astype(np.float64)
+    owner_tipo = tipo[owners]
+    clave = np.select([owner_tipo == 'N', owner_tipo == 'P'], ["84111505", "84111506"],
+                      np.array([p[0] for p in PRODUCTS], dtype=object)[product])
+    clave_unidad = np.where(np.isin(owner_tipo, ['N', 'P']), "ACT", np.array([p[1] for p in PRODUCTS], dtype=object)[product])
+    unidad = np.where(np.isin(owner_tipo, ['N', 'P']), "", np.array([p[2] for p in PRODUCTS], dtype=object)[product])
+    descripcion = np.select([owner_tipo == 'N', owner_tipo == 'P'], ["Pago de nómina", "Pago"],
+                            np.array([p[3] for p in PRODUCTS], dtype=object)[product])
+    c_stamp = timestamps(fecha[owners] + np.timedelta64(3600, 's'))
+    conceptos = pd.DataFrame({
+        'id': c_ids, 'cfdi_id': ids[owners], 'clave_prod_serv': clave, 'no_identificacion': "",
+        'cantidad': cantidad, 'clave_unidad': clave_unidad, 'unidad': unidad, 'descripcion': descripcion,
+        'valor_unitario': np.round(c_importe / cantidad, 6), 'importe': c_importe, 'descuento': c_descuento,
+        'objeto_impuesto': np.where(is_ie[owners], "02", "01"), 'metadata': blank(n_conceptos),
+        'created_at': c_stamp, 'updated_at': c_stamp,
+    })
+
+    # Concept-level taxes, then the comprobante totals as their sums
+    taxed = np.flatnonzero(is_ie[owners])
+    t_owner = owners[taxed]
+    base = c_importe[taxed] - c_descuento[taxed]
+    ci_ids = counters.take('cfdi_concepto_impuestos', len(taxed))
+    concepto_impuestos = pd.DataFrame({'id': ci_ids, 'cfdi_concepto_id': c_ids[taxed],
+                                       'created_at': c_stamp[taxed].to_numpy(), 'updated_at': c_stamp[taxed].to_numpy()})
+    iva = np.round(base * iva_rate[t_owner], 6)
+    ieps_rows = np.flatnonzero(has_ieps[t_owner])
+    ieps = np.round(base[ieps_rows] * IEPS_RATE, 6)
+    ret_rows = np.flatnonzero(has_ret[t_owner])
+    ret_isr = np.round(base[ret_rows] * RET_ISR, 6)
+    ret_iva = np.round(base[ret_rows] * RET_IVA, 6)
+
+    def tax_frame(table, rows, impuesto, rate, importe):
+        stamp = c_stamp[taxed].to_numpy()[rows]
+        return pd.DataFrame({
+            'id': counters.take(table, len(rows)), 'cfdi_concepto_impuestos_id': ci_ids[rows], 'base': base[rows],
+            'impuesto': impuesto, 'tipo_factor': "Tasa", 'tasa_o_cuota': rate, 'importe': importe,
+            'created_at': stamp, 'updated_at': stamp,
+        })
+    all_rows = np.arange(len(taxed))
+    concepto_traslados = pd.concat([
+        tax_frame('cfdi_concepto_traslados', all_rows, "002", iva_rate[t_owner], iva),
+        tax_frame('cfdi_concepto_traslados', ieps_rows, "003", IEPS_RATE, ieps),
+    ], ignore_index=True)
+    concepto_retenciones = pd.concat([
+        tax_frame('cfdi_concepto_retenciones', ret_rows, "001", RET_ISR, ret_isr),
+        tax_frame('cfdi_concepto_retenciones', ret_rows, "002", RET_IVA, ret_iva),
+    ], ignore_index=True)
+
+    iva_total = np.round(np.bincount(t_owner, weights=iva, minlength=n), 2)
+    ieps_total = np.round(np.bincount(t_owner[ieps_rows], weights=ieps, minlength=n), 2)
+    isr_total = np.round(np.bincount(t_owner[ret_rows], weights=ret_isr, minlength=n), 2)
+    ret_iva_total = np.round(np.bincount(t_owner[ret_rows], weights=ret_iva, minlength=n), 2)
+    base_total = np.round(np.bincount(t_owner, weights=base, minlength=n), 2)
+    total = np.round(subtotal - descuento + iva_total + ieps_total - isr_total - ret_iva_total, 2)
+
+    ie_pos = np.flatnonzero(is_ie)
+    imp_ids = counters.take('cfdi_comprobante_impuestos', len(ie_pos))
+    imp_of = np.zeros(n, dtype=np.int64)
+    imp_of[ie_pos] = imp_ids
+    stamp = timestamps(fecha + np.timedelta64(3600, 's'))
+    comprobante_impuestos = pd.DataFrame({
+        'id': imp_ids, 'cfdi_id': ids[ie_pos],
+        'total_impuestos_trasladados': iva_total[ie_pos] + ieps_total[ie_pos],
+        'total_impuestos_retenidos': np.where(has_ret[ie_pos], isr_total[ie_pos] + ret_iva_total[ie_pos], np.nan),
+        'created_at': stamp[ie_pos].to_numpy(), 'updated_at': stamp[ie_pos].to_numpy(),
+    })
+    ieps_pos = np.flatnonzero(has_ieps)
+    ret_pos = np.flatnonzero(has_ret)
+    comprobante_traslados = pd.DataFrame({
+        'id': counters.take('cfdi_comprobante_traslados', len(ie_pos) + len(ieps_pos)),
+        'cfdi_comprobante_impuestos_id': np.concatenate([imp_of[ie_pos], imp_of[ieps_pos]]),
+        'impuesto': ["002"] * len(ie_pos) + ["003"] * len(ieps_pos), 'tipo_factor': "Tasa",
+        'tasa_o_cuota': np.concatenate([iva_rate[ie_pos], np.full(len(ieps_pos), IEPS_RATE)]),
+        'base': np.concatenate([base_total[ie_pos], base_total[ieps_pos]]),
+        'importe': np.concatenate([iva_total[ie_pos], ieps_total[ieps_pos]]),
+        'created_at': np.concatenate([stamp[ie_pos].to_numpy(), stamp[ieps_pos].to_numpy()]),
+        'updated_at': np.concatenate([stamp[ie_pos].to_numpy(), stamp[ieps_pos].to_numpy()]),
+    })
+    comprobante_retenciones = pd.DataFrame({
+        'id': counters.take('cfdi_comprobante_retenciones', 2 * len(ret_pos)),
+        'cfdi_comprobante_impuestos_id': np.concatenate([imp_of[ret_pos], imp_of[ret_pos]]),
+        'impuesto': ["001"] * len(ret_pos) + ["002"] * len(ret_pos),
+        'importe': np.concatenate([isr_total[ret_pos], ret_iva_total[ret_pos]]),
+        'created_at': np.concatenate([stamp[ret_pos].to_numpy()] * 2),
+        'updated_at': np.concatenate([stamp[ret_pos].to_numpy()] * 2),
+    })
+
+    # REP payments for the PPD invoices, issued by later P CFDIs of the block
+    pagos = payment_tables(rng, counters, ids, tipo, metodo, cancelled, total, iva_rate, uuid, serie, fecha)
+    paid_by = pagos.pop('first_invoice')
+    p_pos = np.flatnonzero(is_p)
+    has_doc = paid_by > 0
+    emitido[p_pos[has_doc]] = emitido[paid_by[has_doc] - first_id]
+    emisor_id[p_pos[has_doc]] = emisor_id[paid_by[has_doc] - first_id]
+    receptor_id[p_pos[has_doc]] = receptor_id[paid_by[has_doc] - first_id]
+
+    # Relations: credit notes (01) and a few substitutions of cancelled invoices (04)
+    cancelled_i = ids[is_i & cancelled]
+    sub_src = ids[is_i & ~cancelled & (rng.random(n) < 0.01)]
+    sub_rel = earlier_of(rng, cancelled_i, sub_src)
+    rel_cfdi = np.concatenate([ids[e_pos], sub_src[sub_rel > 0]])
+    rel_target = np.concatenate([e_rel, sub_rel[sub_rel > 0]])
+    rel_stamp = stamp.to_numpy()[rel_cfdi - first_id]
+    relacionados = pd.DataFrame({
+        'id': counters.take('cfdi_relacionados', len(rel_cfdi)), 'cfdi_id': rel_cfdi,
+        'tipo_relacion': ["01"] * len(e_pos) + ["04"] * int((sub_rel > 0).sum()),
+        'uuid_relacionado': uuid[rel_target - first_id],
+        'cfdi_relacionado_id': nullable(rel_target, rng.random(len(rel_cfdi)) < 0.7, 'Int64'),
+        'created_at': rel_stamp, 'updated_at': rel_stamp,
+    })
+
+    # The CFDI rows themselves
+    created = fecha + (rng.integers(3600, 20 * 86400, n)).astype('timedelta64[s]')
+    updated = np.where(rng.random(n) < 0.03, created + rng.integers(86400, 30 * 86400, n).astype('timedelta64[s]'), created)
+    forma_pago = np.select([is_p, is_n, metodo == 'PPD'], [None, "99", "99"], pick(rng, ["03", "01", "04", "28", "02"], n))
+    uso = np.select([is_p, is_n, is_e], ["CP01", "CN01", "G02"], np.where(rng.random(n) < 0.9, "G03", "G01"))
+    carpeta = np.where(emitido, "emitidos", "recibidos")
+    upper = pd.Series(uuid).str.upper()
+    xml_path = "cfdis/xml/" + pd.Series(carpeta) + "/" + upper + ".xml"
+    cancel_time = fecha + rng.integers(86400, 20 * 86400, n).astype('timedelta64[s]')
+    cfdis = pd.DataFrame({
+        'id': ids, 'company_id': ctx.company_id, 'uuid': uuid, 'direccion': np.where(emitido, "emitido", "recibido"),
+        'tipo': tipo, 'serie': serie, 'folio': ids.astype(str), 'fecha_emision': timestamps(fecha), 'version': "4.0",
+        'subtotal': subtotal, 'descuento': descuento, 'total': total,
+        'moneda': np.where(is_p, "XXX", "MXN"), 'tipo_cambio': 1.0,
+        'forma_pago': pd.Series(forma_pago, dtype='string'), 'metodo_pago': pd.Series(metodo, dtype='string'),
+        'exportacion': "01",
+        'lugar_expedicion': np.where(emitido, COMPANY_CP, ctx.supplier_cp[np.minimum(emisor_id, len(ctx.supplier_cp) - 1)]),
+        'confirmacion': blank(n), 'emisor_id': emisor_id, 'receptor_id': receptor_id,
+        'receptor_uso_cfdi': uso, 'xml_path': xml_path, 'pdf_path': blank(n),
+        'xml_filename': upper + ".xml", 'xml_hash': hex_digests(rng, n), 'xml_size': rng.integers(3500, 9000, n),
+        'cancelado': np.where(cancelled, "t", "f"),
+        'fecha_cancelacion': timestamps(np.where(cancelled, cancel_time, np.datetime64('NaT'))),
+        'motivo_cancelacion': nullable(np.full(n, "02"), cancelled),
+        'estatus': np.where(cancelled, "cancelado", "vigente"), 'metadata': blank(n),
+        'created_at': timestamps(created), 'updated_at': timestamps(updated),
+        'deleted_at': blank(n), 'source': "xml",
+    })
+
+    tables = {
+        'cfdis': cfdis,
+        'cfdi_conceptos': conceptos,
+        'cfdi_concepto_impuestos': concepto_impuestos,
+        'cfdi_concepto_traslados': concepto_traslados,
+        'cfdi_concepto_retenciones': concepto_retenciones,
+        'cfdi_comprobante_impuestos': comprobante_impuestos,
+        'cfdi_comprobante_traslados': comprobante_traslados,
+        'cfdi_comprobante_retenciones': comprobante_retenciones,
+        'cfdi_relacionados': relacionados,
+    }
+    tables.update(pagos)
+    tables.update(nomina['tables'])
+    return tables
+
+
+def payment_tables(rng, counters, ids, tipo, metodo, cancelled, total, iva_rate, uuid, serie, fecha):
+    """
+    Parcialidades for the block's PPD invoices, each paid by a later P CFDI.
+    Returns the payment tables plus, per P CFDI, the first invoice it pays (0 if none).
+    """
+    first_id = ids[0]
+    p_ids = ids[tipo == 'P']
+    ppd = np.flatnonzero((metodo == 'PPD') & ~cancelled)
+    count = PARCIALIDADES[rng.choice(len(PARCIALIDADES), len(ppd), p=PARCIALIDADES_P)]
+    invoice = np.repeat(ids[ppd], count)
+    payer = later_of(rng, p_ids, invoice)
+    invoice, payer = invoice[payer > 0], payer[payer > 0]
+    order = np.lexsort((payer, invoice))
+    invoice, payer = invoice[order], payer[order]
+
+    # Parcialidad shares: fully paid 80% of the time, else a part of the total stays insoluto
+    inv_pos = invoice - first_id
+    starts = np.diff(invoice, prepend=-1) != 0
+    last = np.diff(invoice, append=-1) != 0
+    group = np.cumsum(starts) - 1
+    group_first = np.flatnonzero(starts)
+    num_parcialidad = np.arange(len(invoice)) - group_first[group] + 1
+    weights = rng.uniform(0.2, 1.0, len(invoice))
+    paid_fraction = np.where(rng.random(len(group_first)) < 0.8, 1.0, rng.uniform(0.3, 0.9, len(group_first)))
+    to_pay = np.round(total[invoice[group_first] - first_id] * paid_fraction, 2)
+    pagado = allocate(to_pay, group, weights, np.flatnonzero(last))
+    paid_before = np.cumsum(pagado) - pagado
+    paid_before -= paid_before[group_first][group]
+    saldo_ant = np.round(total[inv_pos] - paid_before, 2)
+    insoluto = np.round(saldo_ant - pagado, 2)
+
+    # One cfdi_pagos / detalle / totales row per P CFDI
+    n_p = len(p_ids)
+    pago_ids = counters.take('cfdi_pagos', n_p)
+    detalle_ids = counters.take('cfdi_pago_detalles', n_p)
+    p_index = np.searchsorted(p_ids, payer)
+    monto = np.round(np.bincount(p_index, weights=pagado, minlength=n_p), 2)
+    p_stamp = timestamps(fecha[p_ids - first_id] + np.timedelta64(3600, 's'))
+    fecha_pago = fecha[p_ids - first_id].astype('datetime64[D]').astype('datetime64[s]') + np.timedelta64(12 * 3600, 's')
+    cfdi_pagos = pd.DataFrame({'id': pago_ids, 'cfdi_id': p_ids, 'version': "2.0",
+                               'created_at': p_stamp, 'updated_at': p_stamp})
+    empty = blank(n_p)
+    detalles = pd.DataFrame({
+        'id': detalle_ids, 'cfdi_pago_id': pago_ids, 'fecha_pago': timestamps(fecha_pago),
+        'forma_pago_p': pick(rng, ["03", "01", "04", "28"], n_p), 'moneda_p': "MXN", 'tipo_cambio_p': 1.0,
+        'monto': monto, 'num_operacion': empty, 'rfc_emisor_cta_ord': empty, 'nom_banco_ord_ext': empty,
+        'cta_ordenante': empty, 'rfc_emisor_cta_ben': empty, 'cta_beneficiario': empty, 'tipo_cad_pago': empty,
+        'cert_pago': empty, 'cad_pago': empty, 'sello_pago': empty, 'created_at': p_stamp, 'updated_at': p_stamp,
+    })
+
+    n_docs = len(invoice)
+    doc_ids = counters.take('cfdi_pago_documentos_relacionados', n_docs)
+    doc_uuid = pd.Series(uuid[inv_pos])
+    shout = rng.random(n_docs) < 0.3
+    doc_uuid[shout] = doc_uuid[shout].str.upper()
+    d_stamp = p_stamp.to_numpy()[p_index]
+    documentos = pd.DataFrame({
+        'id': doc_ids, 'cfdi_pago_detalle_id': detalle_ids[p_index], 'id_documento': doc_uuid,
+        'cfdi_relacionado_id': nullable(invoice, rng.random(n_docs) < 0.7, 'Int64'),
+        'serie': serie[inv_pos], 'folio': invoice.astype(str), 'moneda_dr': "MXN", 'equivalencia_dr': 1.0,
+        'num_parcialidad': num_parcialidad, 'imp_saldo_ant': saldo_ant, 'imp_pagado': pagado,
+        'imp_saldo_insoluto': insoluto, 'objeto_imp_dr': "02", 'created_at': d_stamp, 'updated_at': d_stamp,
+    })
+
+    rate = iva_rate[inv_pos]
+    base_dr = np.round(pagado / (1 + rate), 2)
+    importe_dr = np.round(base_dr * rate, 2)
+    dr_impuestos = pd.DataFrame({
+        'id': counters.take('cfdi_pago_dr_impuestos', n_docs), 'cfdi_pago_documento_relacionado_id': doc_ids,
+        'base_dr': base_dr, 'impuesto_dr': "002", 'tipo_factor_dr': "Tasa", 'tasa_o_cuota_dr': rate,
+        'importe_dr': importe_dr, 'tipo': "traslado", 'created_at': d_stamp, 'updated_at': d_stamp,
+    })
+
+    def by_rate(values, r):
+        sums = np.bincount(p_index, weights=np.where(rate == r, values, 0.0), minlength=n_p)
+        used = np.bincount(p_index, weights=(rate == r).astype(float), minlength=n_p) > 0
+        return np.where(used, np.round(sums, 2), np.nan)
+    totales = pd.DataFrame({
+        'id': counters.take('cfdi_pago_totales', n_p), 'cfdi_pago_id': pago_ids,
+        'total_retenciones_iva': np.nan, 'total_retenciones_isr': np.nan, 'total_retenciones_ieps': np.nan,
+        'total_traslados_base_iva16': by_rate(base_dr, 0.16), 'total_traslados_impuesto_iva16': by_rate(importe_dr, 0.16),
+        'total_traslados_base_iva8': by_rate(base_dr, 0.08), 'total_traslados_impuesto_iva8': by_rate(importe_dr, 0.08),
+        'total_traslados_base_iva0': by_rate(base_dr, 0.0), 'total_traslados_impuesto_iva0': by_rate(importe_dr, 0.0),
+        'total_traslados_base_iva_exento': np.nan, 'monto_total_pagos': monto,
+        'created_at': p_stamp, 'updated_at': p_stamp,
+    })
+
+    first_invoice = np.zeros(n_p, dtype=np.int64)
+    by_p = np.argsort(p_index, kind='stable')
+    p_sorted = p_index[by_p]
+    first_of_p = np.diff(p_sorted, prepend=-1) != 0
+    first_invoice[p_sorted[first_of_p]] = invoice[by_p][first_of_p]
+    return {
+        'cfdi_pagos': cfdi_pagos,
+        'cfdi_pago_detalles': detalles,
+        'cfdi_pago_documentos_relacionados': documentos,
+        'cfdi_pago_dr_impuestos': dr_impuestos,
+        'cfdi_pago_totales': totales,
+        'first_invoice': first_invoice,
+    }
+
+
+def nomina_tables(rng, ctx, counters, cfdi_ids, fecha, employee):
+    """Nómina complement rows per N CFDI, with the subtotal/descuento they imply."""
+    n = len(cfdi_ids)
+    nomina_ids = counters.take('cfdi_nominas', n)
+    semanal = rng.random(n) < 0.3
+    dias = np.where(semanal, 7, 15)
+    pago = fecha.astype('datetime64[D]')
+    stamp = timestamps(fecha + np.timedelta64(3600, 's'))
+    sueldo = np.round(ctx.employee_salary[employee] * dias, 2)
+
+    extra = rng.random(n) < 0.3
+    horas = rng.integers(1, 10, n)
+    extra_pago = np.round(ctx.employee_salary[employee] / 8 * 2 * horas, 2)
+    gravado = sueldo + np.where(extra, extra_pago, 0.0)
+    isr = np.round(gravado * 0.10, 2)
+    imss = np.round(sueldo * 0.025, 2)
+    infonavit = rng.random(n) < 0.2
+    infonavit_monto = np.round(sueldo * 0.05, 2)
+    deducciones = np.round(isr + imss + np.where(infonavit, infonavit_monto, 0.0), 2)
+    subsidio = rng.random(n) < 0.35
+    otros = np.where(subsidio, np.round(rng.uniform(0, 50, n), 2), 0.0)
+
+    nominas = pd.DataFrame({
+        'id': nomina_ids, 'cfdi_id': cfdi_ids, 'version': "1.2", 'tipo_nomina': "O", 'fecha_pago': dates(pago),
+        'fecha_inicial_pago': dates(pago - (dias - 1)), 'fecha_final_pago': dates(pago),
+        'num_dias_pagados': dias.astype(np.float64), 'total_percepciones': np.round(gravado, 2),
+        'total_deducciones': deducciones, 'total_otros_pagos': otros, 'created_at': stamp, 'updated_at': stamp,
+    })
+
+    ex = np.flatnonzero(extra)
+    percepciones = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_percepciones', n + len(ex)),
+        'cfdi_nomina_id': np.concatenate([nomina_ids, nomina_ids[ex]]),
+        'tipo_percepcion': ["001"] * n + ["019"] * len(ex), 'clave': ["001"] * n + ["019"] * len(ex),
+        'concepto': ["Sueldo"] * n + ["Horas extra"] * len(ex),
+        'importe_gravado': np.concatenate([sueldo, extra_pago[ex]]), 'importe_exento': 0.0,
+        'created_at': np.concatenate([stamp.to_numpy(), stamp.to_numpy()[ex]]),
+        'updated_at': np.concatenate([stamp.to_numpy(), stamp.to_numpy()[ex]]),
+    })
+    horas_extra = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_horas_extra', len(ex)), 'cfdi_nomina_id': nomina_ids[ex],
+        'dias': 1, 'tipo_horas': "Dobles", 'horas_extra': horas[ex], 'importe_pagado': extra_pago[ex],
+        'created_at': stamp.to_numpy()[ex], 'updated_at': stamp.to_numpy()[ex],
+    })
+    inf = np.flatnonzero(infonavit)
+    deduccion_rows = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_deducciones', 2 * n + len(inf)),
+        'cfdi_nomina_id': np.concatenate([nomina_ids, nomina_ids, nomina_ids[inf]]),
+        'tipo_deduccion': ["002"] * n + ["001"] * n + ["009"] * len(inf),
+        'clave': ["045"] * n + ["052"] * n + ["016"] * len(inf),
+        'concepto': ["I.S.R. mes"] * n + ["I.M.S.S."] * n + ["Préstamo infonavit CF"] * len(inf),
+        'importe': np.concatenate([isr, imss, infonavit_monto[inf]]),
+        'created_at': np.concatenate([stamp.to_numpy()] * 2 + [stamp.to_numpy()[inf]]),
+        'updated_at': np.concatenate([stamp.to_numpy()] * 2 + [stamp.to_numpy()[inf]]),
+    })
+    sub = np.flatnonzero(subsidio)
+    otros_pagos = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_otros_pagos', len(sub)), 'cfdi_nomina_id': nomina_ids[sub],
+        'tipo_otro_pago': "002", 'clave': "035", 'concepto': "Subs al Empleo mes", 'importe': otros[sub],
+        'subsidio_causado': np.round(otros[sub] + rng.uniform(0, 200, len(sub)), 2),
+        'created_at': stamp.to_numpy()[sub], 'updated_at': stamp.to_numpy()[sub],
+    })
+    empty = blank(n)
+    emisores = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_emisores', n), 'cfdi_nomina_id': nomina_ids, 'curp': empty,
+        'registro_patronal': "F3026040102", 'rfc_patron_origen': empty, 'created_at': stamp, 'updated_at': stamp,
+    })
+    antiguedad = (pago - ctx.employee_start[employee]).astype(np.int64) // 7
+    receptores = pd.DataFrame({
+        'id': counters.take('cfdi_nomina_receptores', n), 'cfdi_nomina_id': nomina_ids,
+        'curp': ctx.employee_curp[employee], 'num_seguridad_social': ctx.employee_nss[employee],
+        'fecha_inicio_rel_laboral': dates(ctx.employee_start[employee]),
+        'antiguedad': "P" + pd.Series(antiguedad).astype(str) + "W", 'tipo_contrato': "01", 'sindicalizado': "f",
+        'tipo_jornada': "01", 'tipo_regimen': "02", 'num_empleado': (employee + 1).astype(str),
+        'departamento': np.array(DEPARTAMENTOS, dtype=object)[ctx.employee_depto[employee]],
+        'puesto': np.array(DEPARTAMENTOS, dtype=object)[ctx.employee_depto[employee]], 'riesgo_puesto': "1",
+        'periodicidad_pago': np.where(semanal, "02", "04"), 'banco': empty, 'cuenta_bancaria': empty,
+        'salario_base_cot_apor': ctx.employee_salary[employee],
+        'salario_diario_integrado': np.round(ctx.employee_salary[employee] * 1.0452, 2),
+        'clave_ent_fed': np.array(ESTADOS, dtype=object)[ctx.employee_estado[employee]],
+        'created_at': stamp, 'updated_at': stamp,
+    })
+    return {
+        'subtotal': np.round(gravado + otros, 2),
+        'descuento': deducciones,
+        'tables': {
+            'cfdi_nominas': nominas,
+            'cfdi_nomina_percepciones': percepciones,
+            'cfdi_nomina_deducciones': deduccion_rows,
+            'cfdi_nomina_otros_pagos': otros_pagos,
+            'cfdi_nomina_horas_extra': horas_extra,
+            'cfdi_nomina_emisores': emisores,
+            'cfdi_nomina_receptores': receptores,
+        },
+    }
+
+
+# --- writing -----------------------------------------------------------------------
+
+class ExportWriter:
+    """Appends frames to <out>/<table>.csv; the first frame of a table fixes its column types."""
+
+    def __init__(self, out):
+        self.out = out
+        self.writers = {}
+        self.schemas = {}
+        self.rows = {}
+
+    def write(self, table, df):
+        self.rows[table] = self.rows.get(table, 0) + len(df)
+        if table not in self.schemas:
+            arrow = pa.Table.from_pandas(df, preserve_index=False)
+            # Columns that start all-null are text in the export
+            self.schemas[table] = pa.schema([f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in arrow.schema])
+            self.writers[table] = pa_csv.CSVWriter(os.path.join(self.out, f"{table}.csv"), self.schemas[table],
+                                                   write_options=pa_csv.WriteOptions(quoting_style='needed'))
+        if len(df):
+            arrow = pa.Table.from_pandas(df, schema=self.schemas[table], preserve_index=False, safe=False)
+            self.writers[table].write_table(arrow)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def generate(out, total, months=DEFAULT_MONTHS, seed=7, block=DEFAULT_BLOCK, company_id=1):
+    """Writes a complete synthetic export of total CFDIs to out and returns the row count per table."""
+    os.makedirs(out, exist_ok=True)
+    marker = os.path.join(out, COMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+    ctx = Context(total, months, seed, company_id)
+    counters = Counters()
+    writer = ExportWriter(out)
+    start = time.perf_counter()
+    try:
+        rng = np.random.default_rng(seed)
+        writer.write('cfdi_emisors', ctx.emisors(rng))
+        writer.write('cfdi_receptors', ctx.receptors(rng))
+        for first in range(1, total + 1, block):
+            n = min(block, total - first + 1)
+            block_rng = np.random.default_rng([seed, first])
+            for table, df in generate_block(block_rng, ctx, counters, first, n).items():
+                writer.write(table, df)
+            print(f"  {first + n - 1:>12,} / {total:,} CFDIs ({time.perf_counter() - start:,.0f}s)", flush=True)
+    finally:
+        writer.close()
+
+    params = {"cfdis": total, "months": months, "seed": seed, "company_id": company_id, "rows": writer.rows}
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(params, f, indent=2)
+    return writer.rows
+
+
+def is_complete(out, total, months=DEFAULT_MONTHS, seed=7):
+    """True when out already holds a finished export generated with these parameters."""
+    try:
+        with open(os.path.join(out, COMPLETE_MARKER), 'r', encoding='utf-8') as f:
+            params = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (params.get("cfdis"), params.get("months"), params.get("seed")) == (total, months, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cfdis", type=int, required=True, help="Rows of cfdis.csv")
+    parser.add_argument("--out", required=True, help="Directory for the CSV exports")
+    parser.add_argument("--months", type=int, default=DEFAULT_MONTHS, help="Months of fecha_emision covered")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="CFDIs generated per block (bounds memory)")
+    parser.add_argument("--company-id", type=int, default=1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows = generate(args.out, args.cfdis, args.months, args.seed, args.block, args.company_id)
+    print(f"\nWrote {len(rows)} tables to {args.out} in {time.perf_counter() - start:,.1f}s")
+    for table, count in sorted(rows.items()):
+        print(f"  {table:<40} {count:>14,}")
+
+
+if __name__ == "__main__":
+    main()
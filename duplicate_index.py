@@ -0,0 +1,278 @@
+"""
+Persistent duplicate index for the (emisor RFC, total, fecha_emision) triad.
+
+Every gold CFDI of a tenant is recorded as (key, dup_hash), where key is its gold
+unique field (uuid) and dup_hash a 64-bit hash of the normalized triad. A new batch
+is checked against the tenant's whole history by looking up its own hashes only,
+so the check costs O(batch) whatever the size of the history.
+
+Stored alongside the gold data:
+
+  local   <DATA_DIR>/gold_cfdi_duplicates/company_id=<id>/
+              base-<seq>.arrow   every entry, sorted by dup_hash (plus a key-sorted
+                                 view), memory-mapped and binary-searched
+              delta-<seq>.arrow  one small segment per incremental run; the newest
+                                 segment wins for a key
+          Deltas are folded into a new base once they outgrow DUP_INDEX_COMPACT_RATIO
+          of it, so updates stay incremental.
+  MongoDB <COLLECTION_NAME>_duplicates, indexed on (company_id, dup_hash) and
+          (company_id, key).
+"""
+import os
+import uuid
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pymongo
+
+import gold_store
+
+DUP_INDEX_DIRNAME = "gold_cfdi_duplicates"
+DUP_INDEX_COMPACT_RATIO = float(os.getenv("DUP_INDEX_COMPACT_RATIO", 0.25))
+DUP_INDEX_BATCH_SIZE = int(os.getenv("DUP_INDEX_BATCH_SIZE", 10000))
+VERSION_KEY = "__version__"
+
+
+def triad_hash(df):
+    """
+    64-bit hash of the normalized triad per row: RFC trimmed and upper-cased (the
+    emisor_id when there is no RFC), total in cents, emission time to the second.
+    Raw export chunks and typed gold frames of the same CFDI hash alike.
+    """
+    rfc = df['emisor_rfc'] if 'emisor_rfc' in df.columns else df['emisor_id']
+    cents = np.round(pd.to_numeric(df['total'], errors='coerce') * 100)
+    fecha = pd.to_datetime(df['fecha_emision'], errors='coerce')
+    keys = pd.DataFrame({
+        'rfc': rfc.astype('string').str.strip().str.upper().fillna(''),
+        'cents': cents.fillna(-1).astype('int64').to_numpy(),
+        'second': fecha.to_numpy(dtype='datetime64[s]').astype('int64'),
+    })
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def key_hash(keys):
+    return pd.util.hash_pandas_object(pd.Series(keys, dtype='string'), index=False).to_numpy()
+
+
+def _entries(keys, hashes):
+    """(dup_hash, key_hash, key) per key, the last hash winning for repeated keys."""
+    entries = pd.DataFrame({'key': pd.Series(keys, dtype='string').to_numpy(), 'dup_hash': np.asarray(hashes, dtype=np.uint64)})
+    entries = entries.drop_duplicates('key', keep='last').reset_index(drop=True)
+    entries['key_hash'] = key_hash(entries['key'])
+    return entries[['dup_hash', 'key_hash', 'key']]
+
+
+def _ranges(lo, hi):
+    """Concatenated positions lo[i]..hi[i] of sorted-array matches."""
+    lengths = hi - lo
+    starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum()) + starts
+
+
+def _seq(name):
+    return int(name.split('-', 1)[1].split('.', 1)[0])
+
+
+class LocalDuplicateIndex:
+    """Sorted Arrow base plus per-run delta segments for one tenant (see module docstring)."""
+
+    def __init__(self, root, company_id, compact_ratio=DUP_INDEX_COMPACT_RATIO):
+        self.directory = gold_store.tenant_dir(root, company_id)
+        self.compact_ratio = compact_ratio
+
+    def _segments(self):
+        """Latest base and the deltas written after it, oldest first."""
+        if not os.path.isdir(self.directory):
+            return None, []
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".arrow") and not n.startswith("."))
+        bases = [n for n in names if n.startswith("base-")]
+        base = bases[-1] if bases else None
+        base_seq = _seq(base) if base else -1
+        deltas = [n for n in names if n.startswith("delta-") and _seq(n) > base_seq]
+        return base, sorted(deltas, key=_seq)
+
+    def version(self):
+        """Changes with every commit, for the stage cache keys."""
+        base, deltas = self._segments()
+        return [base] + deltas
+
+    def _read(self, name):
+        with pa.memory_map(os.path.join(self.directory, name), "r") as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _base(self):
+        base, _ = self._segments()
+        return self._read(base) if base else None
+
+    def _deltas(self):
+        _, deltas = self._segments()
+        frames = [self._read(name).to_pandas() for name in deltas]
+        if not frames:
+            return pd.DataFrame({'dup_hash': pd.Series(dtype='uint64'), 'key_hash': pd.Series(dtype='uint64'),
+                                 'key': pd.Series(dtype='string')})
+        return pd.concat(frames, ignore_index=True).drop_duplicates('key_hash', keep='last')
+
+    def lookup(self, hashes):
+        """Current (key, dup_hash) entries holding any of the hashes."""
+        hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+        deltas = self._deltas()
+        parts = [deltas[deltas['dup_hash'].isin(hashes)]]
+        table = self._base()
+        if table is not None and len(hashes):
+            sorted_hashes = table.column('dup_hash').to_numpy()
+            lo = np.searchsorted(sorted_hashes, hashes, 'left')
+            hi = np.searchsorted(sorted_hashes, hashes, 'right')
+            found = table.select(['dup_hash', 'key_hash', 'key']).take(pa.array(_ranges(lo, hi))).to_pandas()
+            # Entries re-recorded by a later delta are superseded
+            parts.insert(0, found[~found['key_hash'].isin(deltas['key_hash'])])
+        return pd.concat(parts, ignore_index=True)[['key', 'dup_hash']]
+
+    def previous(self, keys):
+        """Current (key, dup_hash) entries of the keys that are already indexed."""
+        keys = pd.Series(keys, dtype='string').to_numpy()
+        hashes = key_hash(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        dup = np.zeros(len(keys), dtype=np.uint64)
+
+        table = self._base()
+        if table is not None and len(keys) and table.num_rows:
+            by_key = table.column('by_key_hash').to_numpy()
+            pos = np.minimum(np.searchsorted(by_key, hashes), len(by_key) - 1)
+            found = by_key[pos] == hashes
+            dup[found] = table.column('by_key_dup').to_numpy()[pos[found]]
+
+        deltas = self._deltas().set_index('key_hash')['dup_hash']
+        in_delta = np.isin(hashes, deltas.index.to_numpy())
+        dup[in_delta] = deltas.reindex(hashes[in_delta]).to_numpy()
+        found |= in_delta
+        return pd.DataFrame({'key': keys[found], 'dup_hash': dup[found]})
+
+    def commit(self, keys, hashes, replace=False):
+        """Records a batch; replace=True makes it the whole history (full rebuilds)."""
+        entries = _entries(keys, hashes)
+        os.makedirs(self.directory, exist_ok=True)
+        base, deltas = self._segments()
+        seq = max([_seq(n) for n in ([base] if base else []) + deltas], default=0) + 1
+        if replace:
+            self._write_base(entries, seq)
+        else:
+            self._write(pa.Table.from_pandas(entries, preserve_index=False), f"delta-{seq:08d}.arrow")
+            base_rows = self._read(base).num_rows if base else 0
+            delta_rows = sum(self._read(n).num_rows for n in deltas) + len(entries)
+            if delta_rows > self.compact_ratio * base_rows:
+                self._compact(seq + 1)
+        self._cleanup()
+
+    def _compact(self, seq):
+        """Folds the deltas into a new base."""
+        table = self._base()
+        deltas = self._deltas()
+        current = table.select(['dup_hash', 'key_hash', 'key']).to_pandas() if table is not None else deltas.iloc[:0]
+        current = current[~current['key_hash'].isin(deltas['key_hash'])]
+        self._write_base(pd.concat([current, deltas], ignore_index=True), seq)
+        logging.info(f"Duplicate index compacted: {len(current) + len(deltas):,} entries in {self.directory}")
+
+    def _write_base(self, entries, seq):
+        by_hash = entries.sort_values('dup_hash', kind='stable')
+        by_key = entries.sort_values('key_hash', kind='stable')
+        self._write(pa.table({
+            'dup_hash': pa.array(by_hash['dup_hash'].to_numpy(), pa.uint64()),
+            'key_hash': pa.array(by_hash['key_hash'].to_numpy(), pa.uint64()),
+            'key': pa.array(by_hash['key'].to_numpy(dtype=object), pa.string()),
+            'by_key_hash': pa.array(by_key['key_hash'].to_numpy(), pa.uint64()),
+            'by_key_dup': pa.array(by_key['dup_hash'].to_numpy(), pa.uint64()),
+        }), f"base-{seq:08d}.arrow")
+
+    def _write(self, table, name):
+        tmp = os.path.join(self.directory, f".{name}.{uuid.uuid4().hex}")
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, os.path.join(self.directory, name))
+
+    def _cleanup(self):
+        """Drops the segments a newer base already holds."""
+        base, deltas = self._segments()
+        keep = set([base] + deltas)
+        for name in os.listdir(self.directory):
+            if name.endswith(".arrow") and not name.startswith(".") and name not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # Still mapped by a reader (Windows); removed by a later commit
+                    pass
+
+
+class MongoDuplicateIndex:
+    """The same index as a MongoDB collection next to gold_cfdi. Hashes are stored as int64."""
+
+    def __init__(self, collection, company_id, batch_size=DUP_INDEX_BATCH_SIZE):
+        self.collection = collection
+        self.company_id = company_id
+        self.batch_size = max(1, batch_size)
+        collection.create_index([("company_id", pymongo.ASCENDING), ("key", pymongo.ASCENDING)], unique=True)
+        collection.create_index([("company_id", pymongo.ASCENDING), ("dup_hash", pymongo.ASCENDING)])
+
+    def version(self):
+        doc = self.collection.find_one({"company_id": self.company_id, "key": VERSION_KEY})
+        return doc["version"] if doc else 0
+
+    def _find(self, field, values):
+        docs = []
+        for start in range(0, len(values), self.batch_size):
+            query = {"company_id": self.company_id, field: {"$in": values[start:start + self.batch_size]}}
+            docs.extend(self.collection.find(query, {"_id": 0, "key": 1, "dup_hash": 1}))
+        found = pd.DataFrame(docs, columns=['key', 'dup_hash'])
+        found['dup_hash'] = found['dup_hash'].to_numpy(dtype=np.int64).view(np.uint64)
+        return found
+
+    def lookup(self, hashes):
+        signed = np.unique(np.asarray(hashes, dtype=np.uint64)).view(np.int64)
+        return self._find("dup_hash", [int(h) for h in signed])
+
+    def previous(self, keys):
+        return self._find("key", [str(k) for k in pd.unique(pd.Series(keys, dtype='string'))])
+
+    def commit(self, keys, hashes, replace=False):
+        entries = _entries(keys, hashes)
+        if replace:
+            self.collection.delete_many({"company_id": self.company_id, "key": {"$ne": VERSION_KEY}})
+        signed = entries['dup_hash'].to_numpy().view(np.int64)
+        changed = 0
+        for start in range(0, len(entries), self.batch_size):
+            ops = [pymongo.UpdateOne({"company_id": self.company_id, "key": key}, {"$set": {"dup_hash": int(h)}}, upsert=True)
+                   for key, h in zip(entries['key'].iloc[start:start + self.batch_size], signed[start:start + self.batch_size])]
+            result = self.collection.bulk_write(ops, ordered=False)
+            changed += result.upserted_count + result.modified_count
+        if changed or replace:
+            self.collection.update_one({"company_id": self.company_id, "key": VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True)
+
+
+def check_batch(index, keys, hashes, history=True):
+    """
+    Checks a batch against the tenant's history.
+
+    Returns the triad hashes held by more than one CFDI once the batch is recorded
+    (a batch row is a duplicate when its hash is among them), and the history
+    CFDIs outside the batch whose duplicate flag flips because of it, as a frame
+    of key and is_duplicate. history=False checks the batch on its own.
+    """
+    batch = _entries(keys, hashes)[['key', 'dup_hash']]
+    if history:
+        previous = index.previous(batch['key'])
+        stored = index.lookup(np.union1d(batch['dup_hash'].to_numpy(), previous['dup_hash'].to_numpy()))
+    else:
+        stored = batch.iloc[:0]
+    others = stored[~stored['key'].isin(batch['key'])]
+    old_counts = stored.groupby('dup_hash').size()
+    new_counts = pd.concat([others, batch], ignore_index=True).groupby('dup_hash').size()
+    dup_hashes = new_counts.index[new_counts > 1].to_numpy(dtype=np.uint64)
+
+    was_duplicate = others['dup_hash'].map(old_counts).fillna(0).to_numpy() > 1
+    is_duplicate = others['dup_hash'].map(new_counts).fillna(0).to_numpy() > 1
+    peers = others.loc[was_duplicate != is_duplicate, ['key']].assign(is_duplicate=is_duplicate[was_duplicate != is_duplicate])
+    if len(peers):
+        logging.info(f"Duplicate index: {len(peers)} earlier CFDIs change their duplicate flag with this batch.")
+    return dup_hashes, peers.reset_index(drop=True)
@@ -0,0 +1,391 @@
+"""
+Builds the fiscal_reports collections read by the dashboard API from the gold data.
+
+    matriz_resumen     one row per (company_id, periodo, segmento, concepto)
+    detalle_uuid       one row per invoice: concept breakdown, balance, REP status and aging
+    trazabilidad_uuid  one row per event of an invoice's chain, with the running balance
+    dim_tiempo         calendar attributes per periodo
+
+Every invoice (tipo I, not cancelled) heads a chain. Related CFDIs (cfdi_relacionados)
+and REP payments move its balance with the sign of their matrix concept, and the whole
+chain belongs to the invoice's emission month. A (company_id, periodo) partition only
+depends on the invoices emitted that month, so an ingest rebuilds just the partitions
+holding a CFDI it processed.
+
+Partitions are published whole: one MongoDB transaction per periodo replaces the tenant's
+documents in the three report collections, or a directory swap in the local store.
+Standalone servers have no transactions: there every document carries the build_id of
+its publish, and the readers skip the builds listed in the tenant's report_builds
+document (the new one while it is inserted, the previous one once it is replaced).
+"""
+import os
+import uuid
+import logging
+
+import numpy as np
+import pandas as pd
+import pymongo
+from pymongo.errors import OperationFailure
+
+import gold_store
+from gold_writer import clean_records
+
+FISCAL_DB_NAME = os.getenv("FISCAL_DB_NAME", "fiscal_reports")
+REPORT_COLLECTIONS = ['matriz_resumen', 'detalle_uuid', 'trazabilidad_uuid']
+DIM_TIEMPO = 'dim_tiempo'
+# {company_id, hidden: {periodo: [build_id, ...]}}: builds the API readers skip
+REPORT_BUILDS = 'report_builds'
+
+# Gold columns the builder reads back
+GOLD_COLUMNS = ['id', 'uuid', 'tipo', 'metodo_pago', 'direccion', 'estatus', 'total', 'fecha_emision', 'month_year',
+                'receptor_rfc', 'receptor_nombre', 'emisor_rfc', 'emisor_nombre']
+
+TOTAL_FACTURADO = "1. (+) Total Facturado"
+PAGOS_APLICADOS = "8. (-) Pagos Aplicados (08/09)"
+# c_TipoRelacion -> (matrix concept, sign on the balance of the related invoice)
+RELATION_CONCEPTS = {
+    '01': ("2. (-) Notas de Crédito (01)", -1),
+    '02': ("3. (+) Nota de Débito (02)", 1),
+    '03': ("4. (-) Devoluciones (03)", -1),
+    '04': ("5. (-) Sustituciones (04)", -1),
+    '05': ("6. Traslado de mercancia (05,06)", 0),
+    '06': ("6. Traslado de mercancia (05,06)", 0),
+    '07': ("7. (-) Anticipo (07)", -1),
+    '08': (PAGOS_APLICADOS, -1),
+    '09': (PAGOS_APLICADOS, -1),
+}
+CONCEPTS = [TOTAL_FACTURADO] + list(dict.fromkeys(c for c, _ in RELATION_CONCEPTS.values()))
+SALDO_CONCEPTS = {'PPD': "9. (=) Saldo Insoluto PPD", 'PUE': "9. (=) Saldo Teórico PUE"}
+SALDO_DETALLE = "9. (=) Saldo Acumulado"
+
+AGING_BUCKETS = ["0-30d", "31-60d", "61-90d", "+90d"]
+SALDO_TOLERANCE = 0.01
+MESES = ['Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio', 'Julio', 'Agosto', 'Septiembre', 'Octubre',
+         'Noviembre', 'Diciembre']
+
+
+def report_company_id(company_id):
+    """The API filters fiscal_reports by the numeric company id when there is one."""
+    text = str(company_id)
+    return int(text) if text.isdigit() else company_id
+
+
+def _lower(series):
+    return series.astype(str).str.lower().str.strip()
+
+
+def _fecha_text(series):
+    return pd.to_datetime(series, errors='coerce').dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def chains(gold, payments=None, related=None):
+    """
+    Invoice roots (indexed by CFDI id) and the long event table of their chains:
+    ORIGINAL, every related CFDI and every REP payment, with the running balance.
+    payments are migration.payment_documents() rows, related the cfdi_relacionados rows.
+    """
+    gold = gold.drop_duplicates('id').set_index('id')
+    cancelled = _lower(gold['estatus']).str.contains('cancel', na=False) if 'estatus' in gold else pd.Series(False, index=gold.index)
+    periodo = gold['month_year'].astype(str)
+    is_root = (_lower(gold['tipo']) == 'i') & ~cancelled & periodo.str.match(r'^\d{4}-\d{2}$')
+
+    source = gold[is_root]
+    metodo = _lower(source['metodo_pago']) if 'metodo_pago' in source else pd.Series('', index=source.index)
+    roots = pd.DataFrame({
+        'uuid': source['uuid'].astype(str),
+        'periodo': periodo[is_root],
+        'segmento': metodo.map({'ppd': 'PPD', 'pue': 'PUE'}).fillna('OTROS'),
+        'flujo': _lower(source['direccion']).map({'emitido': 'EMITIDOS', 'recibido': 'RECIBIDOS'}).fillna('OTROS'),
+        'total': pd.to_numeric(source['total'], errors='coerce').fillna(0.0),
+        'fecha_emision': pd.to_datetime(source['fecha_emision'], errors='coerce'),
+    }, index=source.index)
+    for target, col in [('rfc_receptor', 'receptor_rfc'), ('nombre_receptor', 'receptor_nombre'),
+                        ('rfc_emisor', 'emisor_rfc'), ('nombre_emisor', 'emisor_nombre')]:
+        roots[target] = source[col] if col in source else None
+
+    parts = [pd.DataFrame({
+        'root_id': roots.index, 'cfdi_id': roots.index, 'uuid': roots['uuid'].to_numpy(),
+        'fecha': roots['fecha_emision'].to_numpy(), 'concepto': TOTAL_FACTURADO, 'tipo_relacion': 'ORIGINAL',
+        'monto': roots['total'].to_numpy(), 'num_parcialidad': np.nan,
+    })]
+
+    live = gold[~cancelled]
+    if related is not None and not related.empty:
+        uuid_to_id = pd.Series(gold.index, index=_lower(gold['uuid']))
+        uuid_to_id = uuid_to_id[~uuid_to_id.index.duplicated()]
+        # Laravel resolves cfdi_relacionado_id when the related CFDI is in the export, else only the uuid is known
+        root_id = pd.Series(related['cfdi_relacionado_id'], dtype='Float64').fillna(
+            pd.Series(uuid_to_id.reindex(_lower(related['uuid_relacionado']).to_numpy()).to_numpy(dtype='float64', na_value=np.nan),
+                      index=related.index, dtype='Float64'))
+        code = related['tipo_relacion'].astype(str).str.strip().str.zfill(2)
+        child = live.reindex(related['cfdi_id'].to_numpy())
+        keep = (root_id.isin(roots.index).to_numpy() & child['uuid'].notna().to_numpy() & code.isin(list(RELATION_CONCEPTS)).to_numpy()
+                & (root_id.to_numpy(dtype='float64', na_value=np.nan) != related['cfdi_id'].to_numpy(dtype='float64')))
+        code = code[keep]
+        child = child[keep]
+        sign = code.map({k: s for k, (_, s) in RELATION_CONCEPTS.items()}).to_numpy(np.float64)
+        parts.append(pd.DataFrame({
+            'root_id': root_id[keep].to_numpy(dtype='int64'), 'cfdi_id': child.index.to_numpy(), 'uuid': child['uuid'].astype(str).to_numpy(),
+            'fecha': pd.to_datetime(child['fecha_emision'], errors='coerce').to_numpy(),
+            'concepto': code.map({k: c for k, (c, _) in RELATION_CONCEPTS.items()}).to_numpy(), 'tipo_relacion': code.to_numpy(),
+            'monto': sign * pd.to_numeric(child['total'], errors='coerce').fillna(0.0).to_numpy(), 'num_parcialidad': np.nan,
+        }))
+
+    if payments is not None and not payments.empty:
+        docs = payments[~payments['rep_cancelled'] & payments['invoice_id'].isin(roots.index)]
+        rep = gold.reindex(docs['rep_cfdi_id'].to_numpy())
+        parts.append(pd.DataFrame({
+            'root_id': docs['invoice_id'].to_numpy(dtype='int64'), 'cfdi_id': docs['rep_cfdi_id'].to_numpy(dtype='float64'),
+            'uuid': rep['uuid'].to_numpy(), 'fecha': pd.to_datetime(docs['fecha_pago'], errors='coerce').to_numpy(),
+            'concepto': PAGOS_APLICADOS, 'tipo_relacion': 'PAGO',
+            'monto': -docs['imp_pagado'].to_numpy(np.float64), 'num_parcialidad': docs['num_parcialidad'].to_numpy(dtype='float64'),
+        }))
+
+    events = pd.concat(parts, ignore_index=True)
+    events['cfdi_id'] = events['cfdi_id'].astype('Int64')
+    # The original always opens its chain, whatever dates the related documents carry
+    events['orden'] = (events['tipo_relacion'] != 'ORIGINAL').astype(np.int8)
+    events = events.sort_values(['root_id', 'orden', 'fecha'], kind='stable', na_position='last').reset_index(drop=True)
+    events['saldo_acumulado'] = events.groupby('root_id')['monto'].cumsum()
+    events['secuencia'] = events.groupby('root_id').cumcount() + 1
+    return roots, events.drop(columns='orden')
+
+
+def affected_periodos(roots, events, processed_ids):
+    """Periods whose chains hold a processed CFDI, as root or as one of its events."""
+    processed = pd.Index(list(processed_ids))
+    hit = events.loc[events['root_id'].isin(processed) | events['cfdi_id'].isin(processed), 'root_id']
+    return set(roots['periodo'].reindex(pd.unique(hit)).dropna())
+
+
+def detalle_frame(roots, events, as_of):
+    """detalle_uuid rows with one column per matrix concept (nested into 'conceptos' on publish)."""
+    sums = events.groupby(['root_id', 'concepto'])['monto'].sum().unstack(fill_value=0.0)
+    sums = sums.reindex(index=roots.index, columns=CONCEPTS, fill_value=0.0).fillna(0.0)
+    detalle = roots.copy()
+    for col in CONCEPTS:
+        detalle[col] = sums[col].to_numpy()
+    detalle['saldo_acumulado'] = sums.sum(axis=1).to_numpy()
+    detalle[SALDO_DETALLE] = detalle['saldo_acumulado']
+
+    pagos = events[events['tipo_relacion'] == 'PAGO'].groupby('root_id')['fecha'].max()
+    detalle['tiene_rep'] = detalle.index.isin(pagos.index)
+    detalle['ultimo_pago'] = pagos.reindex(detalle.index).to_numpy()
+    # Aging of the open PPD balances: days since the last payment, or since emission when none
+    open_ppd = (detalle['segmento'] == 'PPD') & (detalle['saldo_acumulado'] > SALDO_TOLERANCE)
+    since = detalle['ultimo_pago'].fillna(detalle['fecha_emision'])
+    dias = (as_of - since).dt.days.where(open_ppd)
+    detalle['dias_sin_pago'] = dias.astype('Int64')
+    detalle['aging_bucket'] = pd.cut(dias, [-np.inf, 30, 60, 90, np.inf], labels=AGING_BUCKETS).astype(object)
+    detalle['fecha_corte'] = as_of
+    return detalle.reset_index(names='cfdi_id')
+
+
+def matriz_frame(detalle):
+    """matriz_resumen rows: every concept per (periodo, segmento), closed by the segment balance."""
+    segments = detalle[detalle['segmento'].isin(list(SALDO_CONCEPTS))]
+    if segments.empty:
+        return pd.DataFrame(columns=['periodo', 'segmento', 'concepto', 'monto', 'orden'])
+    totals = segments.groupby(['periodo', 'segmento'])[CONCEPTS + ['saldo_acumulado']].sum().reset_index()
+    rows = totals.melt(id_vars=['periodo', 'segmento'], var_name='concepto', value_name='monto')
+    saldo = rows['concepto'] == 'saldo_acumulado'
+    rows.loc[saldo, 'concepto'] = rows.loc[saldo, 'segmento'].map(SALDO_CONCEPTS)
+    rows['orden'] = rows['concepto'].str.extract(r'^(\d+)\.', expand=False).astype(int)
+    return rows.sort_values(['periodo', 'segmento', 'orden'], kind='stable').reset_index(drop=True)
+
+
+def trazabilidad_frame(roots, events):
+    """trazabilidad_uuid rows: each event stamped with its root's uuid and periodo."""
+    traz = events.copy()
+    traz['uuid_raiz'] = roots['uuid'].reindex(traz['root_id']).to_numpy()
+    traz['periodo'] = roots['periodo'].reindex(traz['root_id']).to_numpy()
+    traz['uuid_relacionado'] = traz['uuid'].where(traz['tipo_relacion'] != 'ORIGINAL')
+    traz['fecha'] = _fecha_text(traz['fecha'])
+    return traz.drop(columns=['root_id'])
+
+
+def dim_tiempo_frame(periodos):
+    """Calendar attributes of each YYYY-MM periodo."""
+    periods = pd.PeriodIndex(sorted(periodos), freq='M')
+    return pd.DataFrame({
+        'periodo': periods.strftime('%Y-%m'),
+        'anio': periods.year,
+        'mes': periods.month,
+        'nombre_mes_es': [MESES[m - 1] for m in periods.month],
+        'trimestre': periods.quarter,
+        'semestre': (periods.month - 1) // 6 + 1,
+        'dias_mes': periods.days_in_month,
+        'fecha_inicio': periods.start_time.strftime('%Y-%m-%d'),
+        'fecha_fin': periods.end_time.strftime('%Y-%m-%d'),
+    })
+
+
+def build_reports(roots, events, company_id, periodos=None, as_of=None):
+    """
+    The four report frames for the given periods (every period when None).
+    as_of is the aging reference date, today by default.
+    """
+    as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of)
+    if periodos is not None:
+        roots = roots[roots['periodo'].isin(list(periodos))]
+        events = events[events['root_id'].isin(roots.index)]
+
+    detalle = detalle_frame(roots, events, as_of)
+    reports = {
+        'matriz_resumen': matriz_frame(detalle),
+        'detalle_uuid': detalle,
+        'trazabilidad_uuid': trazabilidad_frame(roots, events),
+    }
+    cid = report_company_id(company_id)
+    for frame in reports.values():
+        frame['company_id'] = cid
+    reports[DIM_TIEMPO] = dim_tiempo_frame(roots['periodo'].unique())
+    return reports
+
+
+def documents(name, frame):
+    """Report frame -> MongoDB documents in the shape the API reads."""
+    if name == 'detalle_uuid' and not frame.empty:
+        frame = frame.copy()
+        frame['conceptos'] = frame[CONCEPTS + [SALDO_DETALLE]].to_dict(orient='records')
+        frame = frame.drop(columns=CONCEPTS + [SALDO_DETALLE])
+    return clean_records(frame)
+
+
+def local_root(data_dir, name):
+    return gold_store.store_root(data_dir, os.path.join(FISCAL_DB_NAME, name))
+
+
+def stored_periodos(company_id, uuids, db=None, data_dir=None):
+    """Periods where the given CFDIs appear in the published trazabilidad (before this rebuild)."""
+    uuids = [str(u) for u in uuids]
+    if not uuids:
+        return set()
+    if db is not None:
+        found = set()
+        collection = db['trazabilidad_uuid']
+        for i in range(0, len(uuids), 10000):
+            found |= set(collection.distinct('periodo', {'company_id': report_company_id(company_id), 'uuid': {'$in': uuids[i:i + 10000]}}))
+        return found
+    stored = gold_store.read_gold(local_root(data_dir, 'trazabilidad_uuid'), company_id, columns=['uuid', 'periodo'])
+    if stored is None or stored.empty:
+        return set()
+    return set(stored.loc[stored['uuid'].isin(uuids), 'periodo'].dropna())
+
+
+def has_reports(company_id, db=None, data_dir=None):
+    """Every fiscal_reports collection holds at least one document of the tenant."""
+    if db is not None:
+        cid = report_company_id(company_id)
+        return all(db[name].find_one({'company_id': cid}, {'_id': 1}) is not None for name in REPORT_COLLECTIONS)
+    return all(gold_store.list_partitions(local_root(data_dir, name), company_id) for name in REPORT_COLLECTIONS)
+
+
+def _hide_builds(db, cid, periodo, build_ids, session=None):
+    """One update of the tenant's report_builds document: the builds of periodo the readers skip."""
+    if build_ids:
+        db[REPORT_BUILDS].update_one({'company_id': cid}, {'$set': {f'hidden.{periodo}': list(build_ids)}},
+                                     upsert=True, session=session)
+    else:
+        db[REPORT_BUILDS].update_one({'company_id': cid}, {'$unset': {f'hidden.{periodo}': ''}}, session=session)
+
+
+def _replace_partition(db, cid, periodo, docs_by_collection, session):
+    partition = {'company_id': cid, 'periodo': periodo}
+    for name, docs in docs_by_collection.items():
+        db[name].delete_many(partition, session=session)
+        if docs:
+            db[name].insert_many(docs, ordered=False, session=session)
+    # Builds left hidden by an interrupted swap are gone with the partition
+    _hide_builds(db, cid, periodo, [], session=session)
+
+
+def _swap_partition(db, cid, periodo, docs_by_collection, build_id):
+    """
+    Replaces a partition without a transaction: the new build is inserted hidden, one
+    update of report_builds then hides the previous builds instead, and they are deleted.
+    Readers see either build, never both.
+    """
+    partition = {'company_id': cid, 'periodo': periodo}
+    previous = set()
+    for name in docs_by_collection:
+        previous |= set(db[name].distinct('build_id', partition))
+        # Documents published before build ids existed (None also matches a missing field)
+        if db[name].find_one({**partition, 'build_id': None}, {'_id': 1}) is not None:
+            previous.add(None)
+    _hide_builds(db, cid, periodo, [build_id])
+    for name, docs in docs_by_collection.items():
+        if docs:
+            db[name].insert_many(docs, ordered=False)
+    _hide_builds(db, cid, periodo, sorted(previous, key=str))
+    for name in docs_by_collection:
+        db[name].delete_many({**partition, 'build_id': {'$ne': build_id}})
+    _hide_builds(db, cid, periodo, [])
+
+
+def publish_mongo(db, reports, company_id, periodos=None):
+    """
+    Replaces the tenant's partitions of the report collections, one transaction per periodo.
+    periodos=None replaces every partition, dropping the ones no longer produced.
+    Returns the number of partitions published.
+    """
+    cid = report_company_id(company_id)
+    build_id = uuid.uuid4().hex
+    for name in REPORT_COLLECTIONS:
+        db[name].create_index([('company_id', pymongo.ASCENDING), ('periodo', pymongo.ASCENDING)])
+    db['trazabilidad_uuid'].create_index([('company_id', pymongo.ASCENDING), ('uuid', pymongo.ASCENDING)])
+    db[DIM_TIEMPO].create_index([('periodo', pymongo.ASCENDING)], unique=True)
+    db[REPORT_BUILDS].create_index([('company_id', pymongo.ASCENDING)], unique=True)
+
+    produced = {name: {p: documents(name, part) for p, part in reports[name].groupby('periodo')} for name in REPORT_COLLECTIONS}
+    if periodos is None:
+        periodos = set()
+        for name in REPORT_COLLECTIONS:
+            periodos |= set(db[name].distinct('periodo', {'company_id': cid})) | set(produced[name])
+
+    transactions = True
+    for periodo in sorted(periodos):
+        docs_by_collection = {name: produced[name].get(periodo, []) for name in REPORT_COLLECTIONS}
+        for docs in docs_by_collection.values():
+            for doc in docs:
+                doc['build_id'] = build_id
+        if transactions:
+            try:
+                with db.client.start_session() as session:
+                    session.with_transaction(lambda s: _replace_partition(db, cid, periodo, docs_by_collection, s))
+                continue
+            except OperationFailure as e:
+                # Standalone servers have no transactions (IllegalOperation)
+                if e.code != 20:
+                    raise
+                transactions = False
+                logging.warning("fiscal_reports: MongoDB has no transactions (standalone server), partitions are swapped by build id.")
+        _swap_partition(db, cid, periodo, docs_by_collection, build_id)
+
+    dim = reports[DIM_TIEMPO]
+    if not dim.empty:
+        db[DIM_TIEMPO].bulk_write([pymongo.ReplaceOne({'periodo': doc['periodo']}, doc, upsert=True) for doc in clean_records(dim)], ordered=False)
+    return len(periodos)
+
+
+def publish_local(data_dir, reports, company_id, periodos=None):
+    """Local store equivalent of publish_mongo(): each periodo partition is swapped in whole."""
+    months = None
+    if periodos is not None:
+        months = set(periodos)
+    for name, frame in reports.items():
+        gold_store.replace_partitions(frame, local_root(data_dir, name), company_id, months, partition_column='periodo')
+    if months is None:
+        months = set(reports['detalle_uuid']['periodo']) | set(reports['trazabilidad_uuid']['periodo'])
+    return len(months)
+
+
+def publish(reports, company_id, periodos=None, db=None, data_dir=None):
+    """Publishes to MongoDB when a database is given, else to the local store under data_dir."""
+    if db is not None:
+        count = publish_mongo(db, reports, company_id, periodos)
+    else:
+        count = publish_local(data_dir, reports, company_id, periodos)
+    logging.info(f"fiscal_reports: {count} periodo partitions published for {company_id} "
+                 f"({len(reports['detalle_uuid'])} invoices, {len(reports['trazabilidad_uuid'])} events)")
+    return count
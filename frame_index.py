@@ -0,0 +1,79 @@
+"""
+Filter engine shared by the dashboard modules.
+
+load_data returns the tenant frame sorted by fecha_emision with tipo as a categorical
+(prepare, paid once per cached load). On every rerun FrameIndex then resolves:
+
+- a date range with two binary searches into a row slice: a view of the sorted
+  frame, nothing is compared or copied for the rows outside the range;
+- a tipo selection as a lookup table over the categorical codes, applied only to the
+  rows of the slice (no string comparisons, no Python date objects).
+
+Other filters (search terms, status, amounts) run on the result, so each rerun only
+pays for the rows in range.
+"""
+import numpy as np
+import pandas as pd
+
+DATE_COLUMN = 'fecha_emision'
+TIPO_COLUMN = 'tipo'
+
+
+def prepare(df, date_column=DATE_COLUMN):
+    """The frame sorted by date (NaT last) with a fresh RangeIndex and tipo as a categorical."""
+    if df is None or df.empty or date_column not in df.columns:
+        return df
+    if not df[date_column].is_monotonic_increasing:
+        df = df.sort_values(date_column, kind='stable', na_position='last')
+    # reset_index copies every column: only when the index is not 0..n-1 already
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        df = df.reset_index(drop=True)
+    if TIPO_COLUMN in df.columns and not isinstance(df[TIPO_COLUMN].dtype, pd.CategoricalDtype):
+        df[TIPO_COLUMN] = df[TIPO_COLUMN].astype('category')
+    return df
+
+
+class FrameIndex:
+    """Date-range slices and tipo masks over a frame sorted by prepare()."""
+
+    def __init__(self, df, date_column=DATE_COLUMN):
+        self.frame = prepare(df, date_column)
+        self.dates = self.frame[date_column].to_numpy()
+        tipo = self.frame[TIPO_COLUMN] if TIPO_COLUMN in self.frame.columns else None
+        self.tipo_categories = tipo.cat.categories if tipo is not None else pd.Index([])
+        self.tipo_codes = tipo.cat.codes.to_numpy() if tipo is not None else None
+
+    def __len__(self):
+        return len(self.frame)
+
+    def _position(self, day):
+        value = pd.Timestamp(day).to_datetime64().astype(self.dates.dtype)
+        return int(np.searchsorted(self.dates, value, side='left'))
+
+    def date_slice(self, start=None, end=None):
+        """Rows emitted from the start day through the end day (both inclusive, None: open)."""
+        lo = 0 if start is None else self._position(start)
+        hi = len(self.dates) if end is None else self._position(pd.Timestamp(end).normalize() + pd.Timedelta(days=1))
+        return slice(lo, max(lo, hi))
+
+    def month_slice(self, year, month):
+        period = pd.Period(year=year, month=month, freq='M')
+        return self.date_slice(period.start_time, period.end_time)
+
+    def tipo_mask(self, tipos, rows=slice(None)):
+        """Boolean mask over rows: tipo in tipos. Rows without a tipo never match."""
+        if self.tipo_codes is None:
+            return np.zeros(len(self.dates[rows]), dtype=bool)
+        wanted = self.tipo_categories.get_indexer(list(tipos))
+        # One slot per category plus a last, always False, slot that code -1 (NaN) lands on
+        lookup = np.zeros(len(self.tipo_categories) + 1, dtype=bool)
+        lookup[wanted[wanted >= 0]] = True
+        return lookup[self.tipo_codes[rows]]
+
+    def select(self, start=None, end=None, tipos=None):
+        """Rows in the date range with one of tipos (None or empty: any tipo)."""
+        rows = self.date_slice(start, end)
+        view = self.frame.iloc[rows]
+        if tipos:
+            view = view[self.tipo_mask(tipos, rows)]
+        return view
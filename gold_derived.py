@@ -0,0 +1,58 @@
+"""
+Columns derived from every gold CFDI at ingest, so the dashboard reads them as stored
+instead of parsing dates on each load.
+
+    fecha_emision      canonical datetime64 (ISO strings, and the millisecond epochs of
+                       legacy MongoDB exports, parsed once)
+    year, week         emission year and week ('2024-01-01/2024-01-07')
+    ventas_netas_calc  (subtotal + calc_iva) - (calc_retenciones + descuento)
+
+The month is month_year, which the pipeline already stores.
+
+migration.py adds them to every CFDI it writes. Gold written before that is converted
+once by backfill_gold.py; until then app.load_data derives them in memory.
+"""
+import pandas as pd
+
+import schemas
+
+DERIVED_COLUMNS = ['year', 'week', 'ventas_netas_calc']
+VENTAS_NETAS_INPUTS = ['subtotal', 'calc_iva', 'calc_retenciones', 'descuento']
+
+
+def emission_datetime(values):
+    """fecha_emision as datetime64: strings and datetimes first, then millisecond epochs for what did not parse."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.tz_localize(None) if values.dt.tz is not None else values
+    parsed = pd.to_datetime(values, errors='coerce')
+    if parsed.isna().any():
+        epochs = pd.to_datetime(pd.to_numeric(values, errors='coerce'), unit='ms', errors='coerce')
+        parsed = parsed.fillna(epochs)
+    return parsed
+
+
+def is_current(df):
+    """
+    Whether a gold frame already carries the canonical date and every derived column.
+    A projected column that no stored document has comes back all null: not current.
+    """
+    if 'fecha_emision' not in df.columns:
+        return True
+    if not pd.api.types.is_datetime64_any_dtype(df['fecha_emision']):
+        return False
+    dated = df['fecha_emision'].notna().any()
+    return all(col in df.columns and (not dated or df[col].notna().any()) for col in DERIVED_COLUMNS)
+
+
+def add_derived(df):
+    """Canonical fecha_emision, typed money inputs and the derived columns (rows with no date keep nulls)."""
+    if 'fecha_emision' not in df.columns:
+        return df
+    df['fecha_emision'] = emission_datetime(df['fecha_emision'])
+    df['year'] = df['fecha_emision'].dt.year.astype('Int64')
+    df['week'] = df['fecha_emision'].dt.to_period('W').astype(str).where(df['fecha_emision'].notna())
+    if all(col in df.columns for col in VENTAS_NETAS_INPUTS):
+        for col in VENTAS_NETAS_INPUTS:
+            df[col] = schemas.parse_money(df[col])
+        df['ventas_netas_calc'] = (df['subtotal'] + df['calc_iva']) - (df['calc_retenciones'] + df['descuento'])
+    return df
@@ -0,0 +1,288 @@
+"""
+Local columnar gold store, used when there is no MongoDB.
+
+Layout (one directory per tenant, one per published version, one per month inside,
+Arrow IPC files in those):
+
+    <DATA_DIR>/<dataset>/company_id=<id>/CURRENT                     name of the published version
+    <DATA_DIR>/<dataset>/company_id=<id>/v-<hex>/month_year=<YYYY-MM>/part-*.arrow
+
+Datasets: gold_cfdi (one row per CFDI) and gold_conceptos (one row per concept,
+sorted by the CFDI uuid it belongs to). The fiscal_reports builder keeps its
+collections under fiscal_reports/<name>, partitioned by periodo.
+
+Arrow IPC files are uncompressed and memory-mapped on read: only the requested
+columns are paged in, and re-reads come from the OS page cache. The frames built
+from them are private copies (object strings and categoricals, like the MongoDB
+loader's), not views of the mapped pages.
+
+Writers stage their files next to the store, build the next version (months they
+do not touch are hard-linked from the published one) and publish it by replacing
+CURRENT, a single atomic rename: readers see the previous version or the new one,
+never a half-written or missing partition. A reader whose version is removed while
+it reads starts over on the new one. Tenant directories written before versions
+existed (month directories directly inside, no CURRENT) are read as they are and
+replaced by the first publish.
+"""
+import os
+import shutil
+import uuid
+import logging
+from urllib.parse import quote, unquote
+
+import pandas as pd
+import pyarrow as pa
+
+GOLD_STORE_DIRNAME = "gold_cfdi"
+CONCEPTOS_DIRNAME = "gold_conceptos"
+PARTITION_COLUMN = "month_year"
+UNKNOWN_MONTH = "__unknown__"
+CURRENT_FILE = "CURRENT"
+VERSION_PREFIX = "v-"
+READ_ATTEMPTS = 5
+
+
+def store_root(data_dir, dataset=GOLD_STORE_DIRNAME):
+    return os.path.join(data_dir, dataset)
+
+
+def tenant_dir(root, company_id):
+    return os.path.join(root, f"company_id={quote(str(company_id), safe='')}")
+
+
+def month_dirname(month):
+    return f"{PARTITION_COLUMN}={quote(str(month), safe='')}"
+
+
+def typed_frame(df):
+    """Object columns become strings so every file of a partition has one type per column."""
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype("string")
+    return df
+
+
+def published_dir(base):
+    """The published version directory of a tenant dir (the dir itself before versions existed)."""
+    try:
+        with open(os.path.join(base, CURRENT_FILE)) as f:
+            return os.path.join(base, f.read().strip())
+    except FileNotFoundError:
+        return base
+
+
+def _month_dirs(base, months=None):
+    if not os.path.isdir(base):
+        return {}
+    wanted = {str(m) for m in months} if months is not None else None
+    partitions = {}
+    for name in sorted(os.listdir(base)):
+        if not name.startswith(f"{PARTITION_COLUMN}="):
+            continue
+        month = unquote(name.split("=", 1)[1])
+        if wanted is None or month in wanted:
+            partitions[month] = os.path.join(base, name)
+    return partitions
+
+
+def list_partitions(root, company_id, months=None):
+    """{month: partition dir} of a tenant's published version, optionally only the given months."""
+    return _month_dirs(published_dir(tenant_dir(root, company_id)), months)
+
+
+def _write_file(df, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{uuid.uuid4().hex}.arrow")
+    table = pa.Table.from_pandas(typed_frame(df), preserve_index=False)
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def _read_dir(directory, columns=None, memory_map=True):
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".arrow"):
+            continue
+        path = os.path.join(directory, name)
+        source = pa.memory_map(path, "r") if memory_map else pa.OSFile(path, "rb")
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.column_names])
+        # Plain object strings (None for nulls), the same frame shape the JSON loader produced
+        frames.append(table.to_pandas(split_blocks=True, ignore_metadata=True))
+    if not frames:
+        return pd.DataFrame()
+    # pandas concat (not Arrow) so all-null columns typed differently per file still line up
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def _link_dir(source, target):
+    """target gets the files of source: hard links (they are never modified), copies where links fail."""
+    os.makedirs(target, exist_ok=True)
+    for name in os.listdir(source):
+        try:
+            os.link(os.path.join(source, name), os.path.join(target, name))
+        except OSError:
+            shutil.copy2(os.path.join(source, name), os.path.join(target, name))
+
+
+def _publish(version, base):
+    """Moves a built version directory into base and points CURRENT at it."""
+    os.makedirs(base, exist_ok=True)
+    name = f"{VERSION_PREFIX}{uuid.uuid4().hex}"
+    os.rename(version, os.path.join(base, name))
+    pointer = os.path.join(base, f".{CURRENT_FILE}-{uuid.uuid4().hex}")
+    with open(pointer, "w") as f:
+        f.write(name)
+    os.replace(pointer, os.path.join(base, CURRENT_FILE))
+    # Previous versions and the unversioned month directories. Files still memory-mapped
+    # by readers stay valid until they are unmapped; where they cannot be removed yet
+    # (Windows), the next publish removes them.
+    for entry in os.listdir(base):
+        if entry != name and (entry.startswith(VERSION_PREFIX) or entry.startswith(f"{PARTITION_COLUMN}=")):
+            shutil.rmtree(os.path.join(base, entry), ignore_errors=True)
+
+
+def new_staging(root, company_id):
+    """Private directory next to the store for one run's output."""
+    path = os.path.join(root, f".staging-{quote(str(company_id), safe='')}-{uuid.uuid4().hex}")
+    os.makedirs(path)
+    return path
+
+
+def write_staging(df, staging, partition_column=PARTITION_COLUMN):
+    """Appends a frame (or chunk) to the staging area, one file per month."""
+    if df.empty:
+        return
+    months = df[partition_column].astype("string").fillna(UNKNOWN_MONTH)
+    for month, part in df.groupby(months.to_numpy(), sort=False):
+        _write_file(part, os.path.join(staging, month_dirname(month)))
+
+
+def staged_months(staging):
+    return {unquote(name.split("=", 1)[1]): os.path.join(staging, name)
+            for name in os.listdir(staging) if name.startswith(f"{PARTITION_COLUMN}=")}
+
+
+def commit_staging(staging, root, company_id, unique_field, full, months=None):
+    """
+    Publishes a staging area into the store as the tenant's next version.
+
+    full: the staged months become the tenant's whole gold set.
+    incremental: only the staged months are rewritten (older copies of the staged
+    records replaced), plus months, where the caller found older copies stored under
+    another month; the other partitions are linked into the new version unread.
+    """
+    base = tenant_dir(root, company_id)
+    try:
+        if full:
+            _publish(staging, base)
+            return
+
+        staged = staged_months(staging)
+        keys = pd.concat([_read_dir(d, [unique_field])[unique_field] for d in staged.values()], ignore_index=True) if staged else pd.Series(dtype="string")
+        keys = keys.astype("string")
+        existing = _month_dirs(published_dir(base))
+        touched = set(staged) | {str(m) for m in months or ()}
+
+        version = os.path.join(staging, f".version-{uuid.uuid4().hex}")
+        os.makedirs(version)
+        for month in sorted(set(staged) | set(existing)):
+            current = existing.get(month)
+            target = os.path.join(version, month_dirname(month))
+            if month not in touched:
+                _link_dir(current, target)
+                continue
+
+            parts = []
+            if current is not None:
+                previous = _read_dir(current)
+                parts.append(previous[~previous[unique_field].astype("string").isin(keys)])
+            if month in staged:
+                parts.append(_read_dir(staged[month]))
+            merged = pd.concat(parts, ignore_index=True)
+            if not merged.empty:
+                _write_file(merged, target)
+        _publish(version, base)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def write_gold(df, root, company_id, unique_field, full, months=None):
+    """Batch helper: stage a whole frame and publish it (months as in commit_staging)."""
+    os.makedirs(root, exist_ok=True)
+    staging = new_staging(root, company_id)
+    write_staging(df, staging)
+    commit_staging(staging, root, company_id, unique_field, full, months)
+
+
+def replace_partitions(df, root, company_id, months=None, partition_column=PARTITION_COLUMN):
+    """
+    Publishes whole partitions: each listed month becomes exactly the rows of df for it
+    (or disappears when df has none). months=None replaces the tenant's whole dataset.
+    """
+    os.makedirs(root, exist_ok=True)
+    staging = new_staging(root, company_id)
+    base = tenant_dir(root, company_id)
+    try:
+        write_staging(df, staging, partition_column)
+        if months is None:
+            _publish(staging, base)
+            return
+        replaced = {str(m) for m in months}
+        version = os.path.join(staging, f".version-{uuid.uuid4().hex}")
+        os.makedirs(version)
+        for month, current in _month_dirs(published_dir(base)).items():
+            if month not in replaced:
+                _link_dir(current, os.path.join(version, month_dirname(month)))
+        for month, part in staged_months(staging).items():
+            if month in replaced:
+                os.rename(part, os.path.join(version, month_dirname(month)))
+        _publish(version, base)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def read_gold(root, company_id, columns=None, months=None, memory_map=True):
+    """
+    A tenant's gold records, reading only the requested months and columns.
+    Returns None when the tenant has no partitions.
+    """
+    base = tenant_dir(root, company_id)
+    for attempt in range(READ_ATTEMPTS):
+        version = published_dir(base)
+        try:
+            partitions = _month_dirs(version, months)
+            frames = [_read_dir(d, columns, memory_map) for d in partitions.values()]
+        except FileNotFoundError:
+            frames = None
+        # A version replaced meanwhile may have lost files to the writer's cleanup: read the new one
+        if published_dir(base) == version and frames is not None:
+            break
+    else:
+        raise RuntimeError(f"Gold store: {base} kept changing while it was read ({READ_ATTEMPTS} attempts)")
+    if not partitions:
+        return None
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+    logging.info(f"Gold store: {len(partitions)} partitions read for {company_id}")
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_conceptos(data_dir, company_id, uuids=None, columns=None):
+    """
+    A tenant's gold_conceptos indexed by CFDI uuid, optionally only for some invoices.
+    Returns None when the tenant has no concept partitions.
+    """
+    if columns is not None and 'uuid' not in columns:
+        columns = ['uuid'] + list(columns)
+    df = read_gold(store_root(data_dir, CONCEPTOS_DIRNAME), company_id, columns=columns)
+    if df is None:
+        return None
+    if uuids is not None:
+        df = df[df['uuid'].isin(list(uuids))]
+    return df.set_index('uuid').sort_index(kind='stable')
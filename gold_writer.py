@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pymongo
+
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", 1000))
+MONGO_WRITE_WORKERS = int(os.getenv("MONGO_WRITE_WORKERS", 4))
+HASH_FIELD = "_content_hash"
+
+# Collections whose indexes were already checked by this process
+_ensured_indexes = set()
+
+
+def ensure_index(collection, field, unique=True):
+    """
+    Creates the index on field (a tuple of fields: a compound index) once per process,
+    and only if it is missing.
+    """
+    fields = (field,) if isinstance(field, str) else tuple(field)
+    key = (collection.full_name, fields)
+    if key in _ensured_indexes:
+        return
+    spec = [(f, pymongo.ASCENDING) for f in fields]
+    existing = [list(dict(index["key"]).items()) for index in collection.list_indexes()]
+    if spec not in existing:
+        collection.create_index(spec, unique=unique)
+    _ensured_indexes.add(key)
+
+
+def clean_records(df):
+    """Frame -> Mongo documents without NaN fields (same shape the loader always wrote)."""
+    return [{k: v for k, v in record.items() if pd.notnull(v)} for record in df.to_dict(orient='records')]
+
+
+def content_hash(record):
+    """Stable hash of a document's content, independent of key order."""
+    payload = json.dumps(record, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class GoldWriter:
+    """
+    Change-aware upsert writer for the gold collection.
+
+    Every document carries a content hash. Before writing a batch, the stored hashes
+    for its keys are read back and documents whose content did not change are skipped.
+    The rest go out as unordered bulk writes, optionally from parallel threads.
+    """
+
+    def __init__(self, collection, unique_field, batch_size=MONGO_BATCH_SIZE, workers=MONGO_WRITE_WORKERS, lookup_fields=()):
+        self.collection = collection
+        self.unique_field = unique_field
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.stats = {"received": 0, "inserted": 0, "modified": 0, "unchanged": 0, "skipped": 0, "seconds": 0.0, "serialize_seconds": 0.0}
+        ensure_index(collection, unique_field, unique=True)
+        for field in lookup_fields:
+            ensure_index(collection, field, unique=False)
+
+    def _write_batch(self, records):
+        keys = [r[self.unique_field] for r in records]
+        stored = {
+            doc[self.unique_field]: doc.get(HASH_FIELD)
+            for doc in self.collection.find({self.unique_field: {"$in": keys}}, {self.unique_field: 1, HASH_FIELD: 1, "_id": 0})
+        }
+
+        operations = []
+        skipped = 0
+        for record in records:
+            record[HASH_FIELD] = content_hash(record)
+            if stored.get(record[self.unique_field]) == record[HASH_FIELD]:
+                skipped += 1
+                continue
+            operations.append(pymongo.UpdateOne({self.unique_field: record[self.unique_field]}, {'$set': record}, upsert=True))
+
+        counts = {"inserted": 0, "modified": 0, "unchanged": 0, "skipped": skipped}
+        if operations:
+            result = self.collection.bulk_write(operations, ordered=False)
+            counts["inserted"] = result.upserted_count
+            counts["modified"] = result.modified_count
+            counts["unchanged"] = result.matched_count - result.modified_count
+        return counts
+
+    def write(self, df):
+        """Upserts a frame (or chunk) of gold records and returns the counts for it."""
+        start = time.perf_counter()
+        records = [r for r in clean_records(df) if self.unique_field in r]
+        serialize_seconds = time.perf_counter() - start
+        batches = [records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)]
+
+        if self.workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(batches))) as pool:
+                results = list(pool.map(self._write_batch, batches))
+        else:
+            results = [self._write_batch(b) for b in batches]
+
+        totals = {"received": len(records), "inserted": 0, "modified": 0, "unchanged": 0, "skipped": 0}
+        for counts in results:
+            for k, v in counts.items():
+                totals[k] += v
+        totals["seconds"] = time.perf_counter() - start
+        totals["serialize_seconds"] = serialize_seconds
+        for k, v in totals.items():
+            self.stats[k] += v
+        return totals
+
+    def report(self):
+        s = self.stats
+        rate = s["received"] / s["seconds"] if s["seconds"] > 0 else 0
+        logging.info(
+            f"MongoDB Write ({self.collection.name}): {s['inserted']} inserted, {s['modified']} modified, {s['skipped']} skipped (unchanged hash), "
+            f"{s['unchanged']} rewritten without changes, {s['received']:,} records in {s['seconds']:.2f}s ({rate:,.0f} records/s, "
+            f"{s['serialize_seconds']:.2f}s building documents)"
+        )
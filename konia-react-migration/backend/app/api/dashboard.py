@@ -3,6 +3,7 @@ from typing import Optional, List, Dict, Any
 from pydantic import BaseModel
 from ..core.auth import decode_token
 from ..core.database import get_database
+from ..core.report_builds import visible
 from datetime import datetime
 import re
 
@@ -56,7 +57,8 @@ async def get_matriz_resumen(
     # 1. Fetch Data
     cursor = fiscal_db["matriz_resumen"].find({
         "company_id": company_id,
-        "periodo": periodo
+        "periodo": periodo,
+        **visible(fiscal_db, company_id)
     })
     docs = list(cursor)
     
@@ -141,9 +143,10 @@ async def get_matriz_evolucion(
     company_id = user["company_id"]
     
     # 1. Obtain ALL available periods for this company
+    publicados = visible(fiscal_db, company_id)
     periodos_disponibles = fiscal_db["matriz_resumen"].distinct(
         "periodo",
-        {"company_id": company_id}
+        {"company_id": company_id, **publicados}
     )
     periodos_disponibles.sort()  # chronological order "2025-10", "2025-11"...
     
@@ -153,7 +156,8 @@ async def get_matriz_evolucion(
         cursor = fiscal_db["matriz_resumen"].find({
             "company_id": company_id,
             "periodo": p,
-            "concepto": {"$in": ["9. (=) Saldo Insoluto PPD", "9. (=) Saldo Teórico PUE"]}
+            "concepto": {"$in": ["9. (=) Saldo Insoluto PPD", "9. (=) Saldo Teórico PUE"]},
+            **publicados
         })
         docs = list(cursor)
         
@@ -194,9 +198,11 @@ async def get_tabla_matriz(
         periodo_anterior = None
 
     # 2. Query Current Month
+    publicados = visible(fiscal_db, company_id)
     docs_actual = list(fiscal_db["matriz_resumen"].find({
         "company_id": company_id,
-        "periodo": periodo
+        "periodo": periodo,
+        **publicados
     }))
     
     # 3. Query Previous Month (if exists)
@@ -204,7 +210,8 @@ async def get_tabla_matriz(
     if periodo_anterior:
         docs_anterior = list(fiscal_db["matriz_resumen"].find({
             "company_id": company_id,
-            "periodo": periodo_anterior
+            "periodo": periodo_anterior,
+            **publicados
         }))
     
     # 4. Organize in matrices
@@ -265,7 +272,7 @@ async def get_detalle_uuid(
     
     company_id = user["company_id"]
     
-    filtro = {"company_id": company_id, "periodo": periodo}
+    filtro = {"company_id": company_id, "periodo": periodo, **visible(fiscal_db, company_id)}
     if segmento and segmento != "TODOS": 
         filtro["segmento"] = segmento
     if flujo and flujo != "TODOS":    
@@ -344,7 +351,7 @@ def test_traz():
     fiscal_db = db.client["fiscal_reports"]
     try:
         pipeline = [
-            {"$match": {"company_id": pid}},
+            {"$match": {"company_id": pid, **visible(fiscal_db, pid)}},
             {"$sort": {"fecha": 1}},
             {"$group": {
                 "_id": "$uuid_raiz",
@@ -381,7 +388,7 @@ def test_traz_single(uuid: str):
     fiscal_db = db.client["fiscal_reports"]
     try:
         eventos = list(fiscal_db["trazabilidad_uuid"].find(
-            {"company_id": pid, "uuid_raiz": uuid},
+            {"company_id": pid, "uuid_raiz": uuid, **visible(fiscal_db, pid)},
             {"_id": 0}
         ).sort("fecha", 1))
 
@@ -429,7 +436,7 @@ async def get_trazabilidad_uuids(
     except (ValueError, TypeError):
         filtro_company = company_id_raw
 
-    match_filter = {"company_id": filtro_company}
+    match_filter = {"company_id": filtro_company, **visible(db, filtro_company)}
     if periodo:
         match_filter["periodo"] = periodo
 
@@ -497,7 +504,8 @@ async def get_trazabilidad_detalle(
     eventos = list(db["trazabilidad_uuid"].find(
         {
             "company_id": filtro_company, 
-            "uuid_raiz": {"$regex": f"^{uuid_raiz}$", "$options": "i"}
+            "uuid_raiz": {"$regex": f"^{uuid_raiz}$", "$options": "i"},
+            **visible(db, filtro_company)
         },
         {"_id": 0}
     ).sort("fecha", 1))
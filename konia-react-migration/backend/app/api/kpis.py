@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends
 from ..core.database import get_database
+from ..core.report_builds import visible
 from .dashboard import get_current_user_and_company
 
 router = APIRouter()
@@ -14,7 +15,7 @@ async def get_periodos(user: dict = Depends(get_current_user_and_company)):
         filtro_company = company_id_raw
 
     db = get_database().client["fiscal_reports"]
-    periodos = db.detalle_uuid.distinct("periodo", {"company_id": filtro_company})
+    periodos = db.detalle_uuid.distinct("periodo", {"company_id": filtro_company, **visible(db, filtro_company)})
     periodos_ordenados = sorted(periodos, reverse=True)
     return {"periodos": periodos_ordenados}
 
@@ -31,7 +32,7 @@ async def get_kpis_resumen(
         filtro_company = company_id_raw
 
     db = get_database().client["fiscal_reports"]
-    filtro = {"company_id": filtro_company, "periodo": periodo}
+    filtro = {"company_id": filtro_company, "periodo": periodo, **visible(db, filtro_company)}
 
     # ── BLOQUE 1: Salud de Cartera PPD ───────────────
     ppd_filter = {**filtro, "segmento": "PPD"}
@@ -0,0 +1,147 @@
+"""
+Columnar reads from MongoDB for the API services: the cursor is read as raw BSON
+batches (find_raw_batches), each batch decoded by the bson C extension, gathered
+into columns by pandas and every column cast once to its declared Arrow type,
+instead of pd.DataFrame(list(cursor)). Only one batch of documents is alive at a time.
+
+Same reader as the dashboard's mongo_columnar (repo root), kept here because the
+image is built from backend/ alone. COLLECTIONS declares the columns the services
+read, in the kinds of the dashboard's schemas.py; undeclared fields keep Arrow's inference.
+"""
+import os
+import logging
+
+import bson
+import pandas as pd
+import pyarrow as pa
+
+MONGO_READ_BATCH_SIZE = int(os.getenv("MONGO_READ_BATCH_SIZE", 5000))
+
+COLLECTIONS = {
+    'gold_cfdi': {'uuid': 'str', 'emisor_rfc': 'str', 'receptor_rfc': 'str', 'fecha_emision': 'datetime',
+                  'subtotal': 'money', 'total': 'money'},
+    # company_id is left to inference (numeric only when the tenant id is)
+    'matriz_resumen': {'periodo': 'str', 'segmento': 'str', 'concepto': 'str', 'monto': 'money', 'orden': 'int',
+                       'total': 'money', 'tipo_comprobante': 'str'},
+    'dim_tiempo': {
+        'periodo': 'str', 'anio': 'int', 'mes': 'int', 'nombre_mes_es': 'str', 'trimestre': 'int', 'semestre': 'int',
+        'dias_mes': 'int', 'fecha_inicio': 'str', 'fecha_fin': 'str',
+    },
+}
+
+ARROW_TYPES = {
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'money': pa.float64(),
+    'bool': pa.bool_(),
+    'str': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'datetime': pa.timestamp('ms'),
+}
+_CONVERSION_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, OverflowError, TypeError, ValueError)
+_BOOLS = {True: True, False: False, 'true': True, 'false': False, 'True': True, 'False': False}
+
+
+def collection_kinds(name):
+    """Declared column types of a collection ({} when undeclared)."""
+    return COLLECTIONS.get(name, {})
+
+
+def projection(columns=None):
+    """find() projection of columns (every field when None), never _id."""
+    fields = {col: 1 for col in columns} if columns is not None else {}
+    fields['_id'] = 0
+    return fields
+
+
+def arrow_schema(columns, kinds=None):
+    """pa.schema of columns; undeclared ones are typed as strings."""
+    kinds = kinds or {}
+    return pa.schema([(col, ARROW_TYPES.get(kinds.get(col), pa.string())) for col in columns])
+
+
+def _coerce(values, kind):
+    """A batch column Arrow would not take as it is: money as text, dates as strings..."""
+    series = values.astype(object)
+    if kind == 'money':
+        if pd.api.types.is_numeric_dtype(series):
+            return series.astype('float64')
+        return pd.to_numeric(series.astype(str).str.replace(r'[$,]', '', regex=True), errors='coerce')
+    if kind in ('int', 'float'):
+        return pd.to_numeric(series, errors='coerce')
+    if kind == 'datetime':
+        return pd.to_datetime(series, errors='coerce', utc=True, format='ISO8601').dt.tz_localize(None)
+    if kind == 'bool':
+        return series.map(_BOOLS).astype(object)
+    return series.where(series.isna(), series.astype(str))
+
+
+def _as_text(values):
+    return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _column(values, kind=None):
+    """A batch column (Series) as an Arrow array of the declared kind (inferred when undeclared)."""
+    arrow_type = ARROW_TYPES.get(kind)
+    try:
+        return pa.Array.from_pandas(values, type=arrow_type)
+    except _CONVERSION_ERRORS:
+        if arrow_type is None:
+            # Undeclared field with mixed types: keep it as text
+            return _as_text(values.where(values.notna(), None))
+        if pa.types.is_dictionary(arrow_type):
+            return pa.Array.from_pandas(_coerce(values, 'str'), type=pa.string()).dictionary_encode()
+        return pa.Array.from_pandas(_coerce(values, kind), type=arrow_type, safe=False)
+
+
+def batch_table(docs, columns=None, kinds=None):
+    """One decoded batch as a table: a typed column per field (every field seen when columns is None)."""
+    kinds = kinds or {}
+    frame = pd.DataFrame(docs, columns=columns)
+    names = [str(name) for name in frame.columns]
+    return pa.Table.from_arrays([_column(frame.iloc[:, i], kinds.get(name)) for i, name in enumerate(names)], names=names)
+
+
+def _concat(tables):
+    try:
+        return pa.concat_tables(tables, promote_options='permissive')
+    except _CONVERSION_ERRORS:
+        pass
+    # An undeclared field inferred differently by two batches (text in one, numbers in another)
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, set()).add(field.type)
+    mixed = [name for name, found in types.items() if len(found) > 1]
+    logging.warning(f"Columnar read: {mixed} have different types across batches, read as text")
+    retyped = []
+    for table in tables:
+        for name in mixed:
+            if name in table.column_names:
+                table = table.set_column(table.schema.get_field_index(name), name, _as_text(table[name].to_pylist()))
+        retyped.append(table)
+    return pa.concat_tables(retyped, promote_options='permissive')
+
+
+def find_arrow(collection, query, kinds=None, columns=None, batch_size=MONGO_READ_BATCH_SIZE):
+    """
+    find() as a pa.Table. columns become the projection (only those fields leave the
+    server, in that order); kinds ({column: kind}) declares their types.
+    """
+    kinds = kinds or {}
+    columns = list(columns) if columns is not None else None
+    tables = []
+    for batch in collection.find_raw_batches(query, projection(columns), batch_size=batch_size):
+        docs = bson.decode_all(batch)
+        if docs:
+            tables.append(batch_table(docs, columns, kinds))
+    if not tables:
+        return arrow_schema(columns or [], kinds).empty_table()
+    return _concat(tables) if len(tables) > 1 else tables[0]
+
+
+def find_frame(collection, query, kinds=None, columns=None, batch_size=MONGO_READ_BATCH_SIZE):
+    """find() as a DataFrame, built column by column from find_arrow."""
+    table = find_arrow(collection, query, kinds, columns, batch_size)
+    return table.to_pandas(split_blocks=True, ignore_metadata=True)
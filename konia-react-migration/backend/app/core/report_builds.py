@@ -0,0 +1,20 @@
+"""
+Builds of the fiscal_reports partitions the API must not read.
+
+On MongoDB servers without transactions the pipeline (fiscal_reports.py) publishes a
+(company_id, periodo) partition next to the previous one, tagged with a build_id, and
+lists in the company's report_builds document the build readers must skip: the new
+one while it is inserted, then the previous one until it is deleted. Queries on the
+report collections add visible(...) so they never count both builds.
+"""
+REPORT_BUILDS = "report_builds"
+
+
+def visible(fiscal_db, company_filter):
+    """Query fragment excluding the company's hidden builds ({} when there are none)."""
+    hidden = []
+    for doc in fiscal_db[REPORT_BUILDS].find({"company_id": company_filter}, {"_id": 0, "hidden": 1}):
+        for periodo, builds in (doc.get("hidden") or {}).items():
+            if builds:
+                hidden.append({"periodo": periodo, "build_id": {"$in": builds}})
+    return {"$nor": hidden} if hidden else {}
@@ -2,6 +2,8 @@ from datetime import datetime
 import pandas as pd
 from typing import List, Dict, Any, Optional
 from ..core.database import get_database
+from ..core.columnar import find_frame, collection_kinds
+from ..core.report_builds import visible
 
 class FiscalService:
     def __init__(self):
@@ -11,10 +13,8 @@ class FiscalService:
     def _load_dim_tiempo(self) -> pd.DataFrame:
         """Fetches the time dimension table from MongoDB."""
         try:
-            col = self.db["dim_tiempo"]
-            docs = list(col.find({}, {"_id": 0}))
-            if docs:
-                df_tiempo = pd.DataFrame(docs)
+            df_tiempo = find_frame(self.db["dim_tiempo"], {}, collection_kinds("dim_tiempo"))
+            if not df_tiempo.empty:
                 # Ensure proper types for merging
                 if 'periodo' in df_tiempo.columns:
                     df_tiempo['periodo'] = df_tiempo['periodo'].astype(str)
@@ -44,7 +44,7 @@ class FiscalService:
             
             col = self.db[self.collection_name]
             
-            query = {"company_id": cid}
+            query = {"company_id": cid, **visible(self.db, cid)}
             
             if year:
                 if month and month > 0:
@@ -52,16 +52,15 @@ class FiscalService:
                 else:
                     query["periodo"] = {"$regex": f"^{year}-"}
             
-            docs = list(col.find(query, {"_id": 0}))
+            df_fiscal = find_frame(col, query, collection_kinds(self.collection_name))
             
-            if not docs:
+            if df_fiscal.empty:
                 return {
                     "kpis": {"income": 0, "expense": 0, "net": 0, "count": 0},
                     "chart_data": [],
                     "details": []
                 }
             
-            df_fiscal = pd.DataFrame(docs)
             df_tiempo = self._load_dim_tiempo()
             
             if not df_tiempo.empty and 'periodo' in df_fiscal.columns:
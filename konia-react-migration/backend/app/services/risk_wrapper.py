@@ -2,6 +2,7 @@ from datetime import datetime
 import pandas as pd
 from typing import Dict, Any, List, Optional
 from ..core.database import get_database
+from ..core.columnar import find_frame, collection_kinds
 
 class RiskService:
     def __init__(self):
@@ -26,8 +27,7 @@ class RiskService:
             # Fetch context (all invoices from same issuer) for statistical deviation
             # In a real heavy production app, this should be pre-calculated or aggregated
             # For migration fidelity, we replicate the logic of fetching 'df_master' for the specific issuer
-            context_docs = list(col.find({"emisor_rfc": emisor_rfc}, {"total": 1, "fecha": 1, "_id": 0}))
-            df_context = pd.DataFrame(context_docs)
+            df_context = find_frame(col, {"emisor_rfc": emisor_rfc}, collection_kinds(self.collection_name), ["total", "fecha"])
             
             return self._calculate_risk_metrics(target, df_context)
 
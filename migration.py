@@ -1,13 +1,32 @@
 import pandas as pd
+import numpy as np
 import os
-import pymongo
+import sys
+import json
+import codecs
+import shutil
+import argparse
+import atexit
+import threading
+from functools import partial
+from contextlib import nullcontext
+import mongo_pool
+import tax_engine
+import schemas
+from gold_writer import GoldWriter, ensure_index
+import gold_store
+import gold_derived
+import mongo_columnar
+import duplicate_index
+import near_duplicates
+import alert_rules
+import alert_dispatcher
+import fiscal_reports
+from stage_cache import StageCache, StageGraph
+import run_profile
+from run_profile import StageTimer
 from dotenv import load_dotenv
-import smtplib
-from email.mime.image import MIMEImage
 import logging
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg') # non-interactive backend
 
 # Setup Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,305 +39,1287 @@ DATA_DIR = os.getenv("DATA_DIR", "./data")
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME", "cfdi_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "gold_cfdi")
+DUPLICATE_INDEX_COLLECTION = os.getenv("DUPLICATE_INDEX_COLLECTION", f"{COLLECTION_NAME}_duplicates")
 
-# SMTP Config
-SMTP_SERVER = os.getenv("SMTP_SERVER")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
-SMTP_USER = os.getenv("SMTP_USER")
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-ALERT_RECEIVER = os.getenv("ALERT_RECEIVER")
+# SMTP settings (SMTP_*, ALERT_RECEIVER, ALERT_ROUTES) are read by alert_dispatcher
 
-def load_csv(filename):
+# Concept-level gold dataset
+CONCEPTOS_COLLECTION = os.getenv("CONCEPTOS_COLLECTION", "gold_conceptos")
+CONCEPT_COLUMNS = ['id', 'cfdi_id', 'clave_prod_serv', 'no_identificacion', 'cantidad', 'clave_unidad', 'unidad',
+                   'descripcion', 'valor_unitario', 'importe', 'descuento', 'objeto_impuesto']
+CONCEPT_TOTAL_COLUMNS = [f"conceptos_{col}" for col in tax_engine.TAX_COLUMNS]
+
+# Payment complement (REP) state per PPD invoice
+PAYMENT_COLUMNS = ['rep_pagado', 'rep_iva_pagado', 'rep_saldo_insoluto', 'rep_parcialidades', 'rep_ultimo_pago']
+
+# Incremental State (per-tenant watermark of the last successful run)
+STATE_COLLECTION = os.getenv("STATE_COLLECTION", "pipeline_state")
+STATE_FILE = "pipeline_state.json"
+
+# Stage cache (batch mode): exports per stage and the sources whose changes invalidate every key
+STAGE_CACHE = os.getenv("STAGE_CACHE", "1") != "0"
+EXPORT_TABLES = {
+    'cfdis': "cfdis.csv",
+    'impuestos': "cfdi_comprobante_impuestos.csv",
+    'traslados': "cfdi_comprobante_traslados.csv",
+    'retenciones': "cfdi_comprobante_retenciones.csv",
+    'receptors': "cfdi_receptors.csv",
+    'emisors': "cfdi_emisors.csv",
+}
+PAYMENT_FILES = ["cfdis.csv", "cfdi_pagos.csv", "cfdi_pago_detalles.csv", "cfdi_pago_documentos_relacionados.csv", "cfdi_pago_dr_impuestos.csv"]
+CONCEPT_FILES = ["cfdi_conceptos.csv", "cfdi_concepto_impuestos.csv", "cfdi_concepto_traslados.csv", "cfdi_concepto_retenciones.csv"]
+PIPELINE_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in [
+    "migration.py", "tax_engine.py", "schemas.py", "alert_rules.py", "gold_derived.py",
+    "near_duplicates.py", "duplicate_index.py", "gold_store.py", "gold_writer.py", "fiscal_reports.py",
+    "mongo_columnar.py", "stage_cache.py",
+]]
+
+# Run report (JSON, relative paths live in DATA_DIR) and the optional regression gate,
+# one baseline per tenant (same rule for relative paths, company_id added to the name)
+RUN_REPORT_FILE = os.getenv("RUN_REPORT_FILE", "run_report.json")
+PROFILE_BASELINE = os.getenv("PROFILE_BASELINE")
+PROFILE_TOLERANCE = float(os.getenv("PROFILE_TOLERANCE", 0.25))
+PROFILE_MIN_SECONDS = float(os.getenv("PROFILE_MIN_SECONDS", 0.5))
+PROFILE_MEMORY = os.getenv("PROFILE_MEMORY", "0") == "1"
+
+# Streaming Ingestion
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 100000))
+ENCODING_SAMPLE_BYTES = 1024 * 1024
+
+def detect_encoding(path, sample_size=ENCODING_SAMPLE_BYTES):
+    """Detects the file encoding once from a leading sample: UTF-8, else Latin-1."""
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+    try:
+        # Incremental decoder tolerates a multi-byte char cut at the sample boundary
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+# Per export: bytes past the encoding sample that were not UTF-8
+_undecodable = {}
+
+def latin1_fallback(filename):
+    """Name of a codec error handler decoding the non-UTF-8 bytes of filename as Latin-1 (counted)."""
+    name = f"latin1_fallback:{filename}"
+    if filename not in _undecodable:
+        def handler(error):
+            _undecodable[filename] += error.end - error.start
+            return error.object[error.start:error.end].decode('latin-1'), error.end
+        codecs.register_error(name, handler)
+    _undecodable[filename] = 0
+    return name
+
+def warn_undecodable(filename):
+    if _undecodable.get(filename):
+        logging.warning(f"{filename}: {_undecodable[filename]} bytes past the encoding sample are not UTF-8, "
+                        f"decoded as Latin-1")
+
+def load_csv(filename, usecols=None, chunksize=None):
+    """
+    Loads a Laravel export typed by the schema registry. With chunksize, returns an
+    iterator of raw DataFrames instead (iter_csv applies the schema per chunk).
+    usecols may list columns that are absent from the file; they are ignored.
+    """
     path = os.path.join(DATA_DIR, filename)
     if not os.path.exists(path):
         logging.error(f"File not found: {path}")
         return None
-    try:
-        # Try UTF-8 first, then Latin-1
-        return pd.read_csv(path, encoding='utf-8')
-    except UnicodeDecodeError:
-        return pd.read_csv(path, encoding='latin-1')
-
-def clean_money_column(series):
-    """Cleans money columns potentially having currency symbols."""
-    # If already numeric, return
-    if pd.api.types.is_numeric_dtype(series):
-        return series.astype(float)
-    return series.astype(str).str.replace(r'[$,]', '', regex=True).astype(float)
-
-def send_alert(subject, body, image_path=None):
-    if not all([SMTP_SERVER, SMTP_USER, SMTP_PASSWORD, ALERT_RECEIVER]):
-        logging.warning("SMTP credentials missing. Skipping email alert.")
-        print(f"--- FAKE EMAIL ALERT ---\nSubject: {subject}\nBody: {body}\nChart Attached: {image_path}\n------------------------")
+    encoding = detect_encoding(path)
+    wanted = (lambda c: c in usecols) if usecols is not None else None
+    # A stray Latin-1 byte past the sample must not abort a multi-GB parse, nor become U+FFFD
+    errors = latin1_fallback(filename) if encoding == 'utf-8' else 'strict'
+    df = pd.read_csv(path, encoding=encoding, encoding_errors=errors, usecols=wanted, chunksize=chunksize,
+                     dtype=schemas.csv_dtypes(filename))
+    if chunksize:
+        return df
+    warn_undecodable(filename)
+    return schemas.apply_schema(df, filename)
+
+def iter_csv(filename, chunksize, usecols=None):
+    """Yields fixed-size chunks of an export (nothing if the file is missing)."""
+    reader = load_csv(filename, usecols=usecols, chunksize=chunksize)
+    if reader is None:
         return
+    with reader:
+        for chunk in reader:
+            yield schemas.apply_schema(chunk, filename)
+    warn_undecodable(filename)
 
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = SMTP_USER
-        msg['To'] = ALERT_RECEIVER
-        msg['Subject'] = subject
-        
-        # Attach HTML body to support inline images if needed, but for now just plain text + attachment
-        msg.attach(MIMEText(body, 'plain'))
-
-        if image_path and os.path.exists(image_path):
-            with open(image_path, 'rb') as f:
-                img_data = f.read()
-                image = MIMEImage(img_data, name=os.path.basename(image_path))
-                msg.attach(image)
-            logging.info(f"Image attached: {image_path}")
-
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        logging.info(f"Alert sent: {subject}")
-    except Exception as e:
-        logging.error(f"Failed to send alert: {e}")
+def row_timestamps(df):
+    """Change timestamp per row: updated_at, falling back to created_at."""
+    ts = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    for col in ['updated_at', 'created_at']:
+        if col in df.columns:
+            ts = ts.fillna(pd.to_datetime(df[col], errors='coerce'))
+    return ts
 
-def create_trend_chart(series, title, filename):
+def max_timestamp(tables):
+    """Latest change timestamp across all loaded tables (the next watermark)."""
+    stamps = [row_timestamps(df).max() for df in tables if df is not None and not df.empty]
+    stamps = [ts for ts in stamps if pd.notnull(ts)]
+    return max(stamps) if stamps else None
+
+_mongo = None
+_mongo_lock = threading.Lock()
+
+def mongo_db(name=DB_NAME):
+    """
+    A database on the process's one pipeline client (None without MONGO_URI): every
+    helper and tenant run shares its connection pool instead of opening a client each.
+    """
+    global _mongo
+    if not MONGO_URI:
+        return None
+    with _mongo_lock:
+        if _mongo is None:
+            # pymongo's default timeouts: bulk loads outlast the dashboard's 30s socket timeout
+            _mongo = mongo_pool.MongoPool(MONGO_URI, server_selection_ms=30000, connect_timeout_ms=20000,
+                                          socket_timeout_ms=None)
+            atexit.register(_mongo.close)
+    return _mongo.database(name)
+
+def load_watermark(company_id):
+    """Returns the watermark of the last successful run for a tenant, or None."""
     try:
-        plt.figure(figsize=(10, 6))
-        series.plot(kind='bar', color='#00f2ff', edgecolor='black')
-        plt.title(title, fontsize=14, fontweight='bold', color='black')
-        plt.ylabel('Volumen', fontsize=12)
-        plt.xlabel('Periodo (Mes)', fontsize=12)
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.tight_layout()
-        chart_path = os.path.join(os.getcwd(), filename)
-        plt.savefig(chart_path)
-        plt.close()
-        return chart_path
+        if MONGO_URI:
+            doc = mongo_db()[STATE_COLLECTION].find_one({"company_id": company_id})
+            value = doc.get("watermark") if doc else None
+        else:
+            path = os.path.join(DATA_DIR, STATE_FILE)
+            if not os.path.exists(path):
+                return None
+            with open(path, 'r') as f:
+                value = json.load(f).get(str(company_id), {}).get("watermark")
     except Exception as e:
-        logging.error(f"Failed to create chart: {e}")
+        logging.error(f"Failed to read watermark, falling back to full run: {e}")
         return None
+    return pd.Timestamp(value) if value else None
 
-def main():
-    logging.info("Starting Migration Pipeline...")
+def save_watermark(company_id, watermark):
+    """Persists the tenant watermark. Only called after a successful load."""
+    if watermark is None:
+        return
+    value = pd.Timestamp(watermark).isoformat()
+    if MONGO_URI:
+        mongo_db()[STATE_COLLECTION].update_one(
+            {"company_id": company_id},
+            {'$set': {"company_id": company_id, "watermark": value}},
+            upsert=True
+        )
+    else:
+        path = os.path.join(DATA_DIR, STATE_FILE)
+        state = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+        state[str(company_id)] = {"watermark": value}
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=2)
+    logging.info(f"Watermark for {company_id} advanced to {value}")
 
-    # 1. Load Data
-    cfdis = load_csv("cfdis.csv")
-    impuestos = load_csv("cfdi_comprobante_impuestos.csv")
-    traslados = load_csv("cfdi_comprobante_traslados.csv")
-    retenciones = load_csv("cfdi_comprobante_retenciones.csv")
-    receptors = load_csv("cfdi_receptors.csv")
-    emisors = load_csv("cfdi_emisors.csv")
+def changed_cfdi_ids(watermark, cfdis, impuestos, traslados, retenciones, emisors, receptors):
+    """
+    Ids of CFDIs whose own row, child tax rows or catalog entries changed after the watermark.
+    Rows without any timestamp are treated as changed.
+    """
+    def changed(df):
+        ts = row_timestamps(df)
+        return ts.isna() | (ts > watermark)
 
-    if cfdis is None: 
-        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
-        return
+    ids = set(cfdis.loc[changed(cfdis), 'id'])
 
-    # 2. Data Cleaning & Pre-processing
-    logging.info("Cleaning Data...")
-    
-    # Normalize text columns
-    text_cols = ['tipo', 'moneda', 'forma_pago', 'metodo_pago', 'estatus']
-    for col in text_cols:
-        if col in cfdis.columns:
-            cfdis[col] = cfdis[col].astype(str).str.lower().str.strip()
+    if impuestos is not None:
+        ids.update(impuestos.loc[changed(impuestos), 'cfdi_id'])
+        imp_to_cfdi = impuestos.set_index('id')['cfdi_id']
+        for child in [traslados, retenciones]:
+            if child is not None:
+                imp_ids = child.loc[changed(child), 'cfdi_comprobante_impuestos_id']
+                ids.update(imp_to_cfdi.reindex(imp_ids).dropna())
 
-    # Cast Money Columns
-    money_cols = ['subtotal', 'descuento', 'total']
-    for col in money_cols:
-        if col in cfdis.columns:
-            cfdis[col] = clean_money_column(cfdis[col])
-            
-    # Clean Taxes Money Columns
-    if traslados is not None:
-        traslados['importe'] = clean_money_column(traslados['importe'])
-    if retenciones is not None:
-        retenciones['importe'] = clean_money_column(retenciones['importe'])
-
-    # 3. Calculate Taxes Aggregates per CFDI
-    # Logic: cfdis.id -> impuestos.cfdi_id (impuestos.id) -> traslados/retenciones.cfdi_comprobante_impuestos_id
-    
-    cfdi_taxes = pd.DataFrame({'cfdi_id': cfdis['id'].unique()})
-    
-    if impuestos is not None and traslados is not None:
-        # Traslados Aggregate
-        # Join traslados with impuestos to get cfdi_id
-        traslados_merged = traslados.merge(
-            impuestos[['id', 'cfdi_id']], 
-            left_on='cfdi_comprobante_impuestos_id', 
-            right_on='id', 
-            suffixes=('_tras', '_imp')
-        )
-        
-        # Calculate Total Traslados per CFDI
-        total_traslados = traslados_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_traslados'})
-        cfdis = cfdis.merge(total_traslados, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_traslados': 0})
-        
-        # Calculate IVA vs IEPS
-        iva_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_iva'})
-        ieps_tras = traslados_merged[traslados_merged['impuesto'].astype(str).str.contains('003', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ieps'})
-        
-        cfdis = cfdis.merge(iva_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_iva': 0})
-        cfdis = cfdis.merge(ieps_tras, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ieps': 0})
+    # Catalog renames must reach every CFDI that references them
+    for catalog, fk in [(emisors, 'emisor_id'), (receptors, 'receptor_id')]:
+        if catalog is not None and fk in cfdis.columns:
+            cat_ids = catalog.loc[changed(catalog), 'id']
+            ids.update(cfdis.loc[cfdis[fk].isin(cat_ids), 'id'])
 
-    else:
-        cfdis['calc_traslados'] = 0
-        cfdis['calc_iva'] = 0
-        cfdis['calc_ieps'] = 0
-
-    if impuestos is not None and retenciones is not None:
-        # Retenciones Aggregate
-        retenciones_merged = retenciones.merge(
-            impuestos[['id', 'cfdi_id']],
-            left_on='cfdi_comprobante_impuestos_id',
-            right_on='id',
-            suffixes=('_ret', '_imp')
-        )
-        
-        total_retenciones = retenciones_merged.groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_retenciones'})
-        cfdis = cfdis.merge(total_retenciones, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_retenciones': 0})
-        
-        # ISR vs IVA Ret
-        isr_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('001', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_isr'})
-        iva_ret = retenciones_merged[retenciones_merged['impuesto'].astype(str).str.contains('002', na=False)].groupby('cfdi_id')['importe'].sum().reset_index().rename(columns={'importe': 'calc_ret_iva'})
-        
-        cfdis = cfdis.merge(isr_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_isr': 0})
-        cfdis = cfdis.merge(iva_ret, left_on='id', right_on='cfdi_id', how='left').drop(columns=['cfdi_id']).fillna({'calc_ret_iva': 0})
+    return ids
 
-    else:
-        cfdis['calc_retenciones'] = 0
-        cfdis['calc_ret_isr'] = 0
-        cfdis['calc_ret_iva'] = 0
+# --- Pipeline Stages ---
+# Each stage takes either a whole table or a single chunk of it.
 
-    # --- NEW: Inject Company ID for Multi-tenancy ---
-    # Default to a value from ENV or argument
-    COMPANY_ID = os.getenv("COMPANY_ID", "DEFAULT_TENANT")
-    cfdis['company_id'] = COMPANY_ID
-    logging.info(f"Targeting Company ID: {COMPANY_ID}")
+def clean_cfdis(cfdis):
+    """Normalizes text columns. Money columns are already typed by the schema registry."""
+    text_cols = ['tipo', 'moneda', 'forma_pago', 'metodo_pago', 'estatus']
+    for col in text_cols:
+        if col in cfdis.columns:
+            cfdis[col] = schemas.normalize_text(cfdis[col])
+    return cfdis
 
-    # 4. Enrich with Names
+def enrich_names(cfdis, emisors, receptors):
+    """Adds receptor_nombre, receptor_rfc, emisor_nombre and emisor_rfc from the catalogs."""
     if receptors is not None:
         # Assuming 'receptor_id' in cfdis maps to 'id' in receptors
         # Check column names in receptors. usually id, nombre/razon_social
         # For robustness, we select the string column that looks like a name
         name_col = next((c for c in receptors.columns if 'nombre' in c.lower() or 'razon' in c.lower()), None)
+        rfc_col = next((c for c in receptors.columns if 'rfc' in c.lower()), None)
         if name_col:
-            receptors = receptors[['id', name_col]].rename(columns={name_col: 'receptor_nombre'})
+            cols_to_keep = ['id', name_col] + ([rfc_col] if rfc_col else [])
+            receptors = receptors[cols_to_keep].rename(columns={name_col: 'receptor_nombre', rfc_col: 'receptor_rfc'})
             cfdis = cfdis.merge(receptors, left_on='receptor_id', right_on='id', how='left', suffixes=('', '_rec'))
-    
+
     if emisors is not None:
         name_col = next((c for c in emisors.columns if 'nombre' in c.lower() or 'razon' in c.lower()), None)
         rfc_col = next((c for c in emisors.columns if 'rfc' in c.lower()), None)
         cols_to_keep = ['id']
         if name_col: cols_to_keep.append(name_col)
         if rfc_col: cols_to_keep.append(rfc_col)
-        
+
         emisors_clean = emisors[cols_to_keep].rename(columns={name_col: 'emisor_nombre', rfc_col: 'emisor_rfc'})
         cfdis = cfdis.merge(emisors_clean, left_on='emisor_id', right_on='id', how='left', suffixes=('', '_emi'))
+    return cfdis
 
-    # 5. Financial Calculations
+def add_financials(cfdis):
+    """Gross and net sales per CFDI."""
     # Formula: $Neto = [Subtotal + Traslados] - [Retenciones + Descuentos]$
     cfdis['ventas_brutas'] = cfdis['subtotal']
     cfdis['ventas_netas'] = (cfdis['subtotal'] + cfdis['calc_traslados']) - (cfdis['calc_retenciones'] + cfdis['descuento'])
-    
-    logging.info(f"Processed {len(cfdis)} records.")
-    
-    # 6. Forensics & Alerts
-    alerts = []
-    
-    # Check for Duplicates (Tríada: RFC + Monto + Fecha)
+    return cfdis
+
+def add_period(cfdis):
+    """
+    Canonical emission date, its month (used by the monthly checks) and the derived
+    columns the dashboard reads as stored (gold_derived).
+    """
+    cfdis = gold_derived.add_derived(cfdis)
+    cfdis['fecha_dt'] = cfdis['fecha_emision']
+    cfdis['month_year'] = cfdis['fecha_dt'].dt.to_period('M')
+    return cfdis
+
+def duplicate_key_cols(columns):
+    """Columns of the duplicate triad (RFC + Monto + Fecha)."""
     # Using 'emisor_id' (proxy for RFC if RFC missing) or 'emisor_rfc'
     group_cols = ['total', 'fecha_emision']
-    if 'emisor_rfc' in cfdis.columns:
+    if 'emisor_rfc' in columns:
         group_cols.append('emisor_rfc')
     else:
         group_cols.append('emisor_id')
-        
-    duplicates = cfdis[cfdis.duplicated(subset=group_cols, keep=False)]
-    if not duplicates.empty:
-        alert_msg = f"Posibles Duplicados Detectados:\n{duplicates[group_cols].head(10).to_string()}"
-        alerts.append(alert_msg)
-        cfdis['is_duplicate'] = cfdis.duplicated(subset=group_cols, keep=False)
-    else:
-        cfdis['is_duplicate'] = False
+    return group_cols
 
-    # Check Retention Spike > 20% vs previous month
-    # Convert date
-    cfdis['fecha_dt'] = pd.to_datetime(cfdis['fecha_emision'], errors='coerce')
-    cfdis['month_year'] = cfdis['fecha_dt'].dt.to_period('M')
-    
-    monthly_ret = cfdis.groupby('month_year')['calc_retenciones'].sum().sort_index()
-    monthly_pct_change = monthly_ret.pct_change()
-    
-    # Check latest month
-    if not monthly_pct_change.empty:
-        latest_change = monthly_pct_change.iloc[-1]
-        if latest_change > 0.20:
-            alerts.append(f"Incremento Atípico de Retenciones: {latest_change:.1%} de aumento en {monthly_ret.index[-1]}")
-
-    # --- NEW: Check Cancelled CFDI Spike > 20% vs previous month ---
+def with_emisor_rfc(cfdis, emisors):
+    """Raw CFDI rows with the emisor RFC the enrich step would add, for the duplicate triad."""
+    rfc_col = next((c for c in emisors.columns if 'rfc' in c.lower()), None) if emisors is not None else None
+    if rfc_col is None:
+        return cfdis
+    return cfdis.assign(emisor_rfc=cfdis['emisor_id'].map(emisors.set_index('id')[rfc_col]))
+
+def duplicate_keys(cfdis):
+    """Gold unique field values, the keys of the duplicate index."""
+    return cfdis['uuid' if 'uuid' in cfdis.columns else 'id'].astype(str).to_numpy()
+
+def send_run_alerts(company_id, alerts, evaluate_rules):
+    """Sends the run's forensic alerts together with the tenant's fired alert rules."""
     chart_to_send = None
-    if 'estatus' in cfdis.columns:
-        cancelled_mask = cfdis['estatus'].astype(str).str.lower().str.contains('cancel', na=False)
-        monthly_cancelled = cfdis[cancelled_mask].groupby('month_year').size().sort_index()
-        
-        if not monthly_cancelled.empty:
-            cancelled_pct_change = monthly_cancelled.pct_change()
-            if not cancelled_pct_change.empty:
-                latest_cancel_change = cancelled_pct_change.iloc[-1]
-                if latest_cancel_change > 0.20:
-                    alerts.append(f"Incremento Atípico de Cancelaciones: {latest_cancel_change:.1%} de aumento en {monthly_cancelled.index[-1]}")
-                    # Create chart for cancellation trend
-                    chart_to_send = create_trend_chart(monthly_cancelled, "Tendencia de Facturas Canceladas", "alerta_cancelaciones.png")
-
-    # Send Alerts
+    if evaluate_rules:
+        rule_messages, chart_to_send = tenant_rule_alerts(company_id)
+        alerts = alerts + rule_messages
+    dispatch_alerts(alerts, chart_to_send, company_id)
+
+def dispatch_alerts(alerts, chart_to_send=None, company_id=None):
+    """Queues the alerts as one e-mail; alert_dispatcher sends it in the background."""
     if alerts:
-        send_alert("Alertas Forenses CFDI", "\n\n".join(alerts), image_path=chart_to_send)
-        if chart_to_send and os.path.exists(chart_to_send):
-            try:
-                os.remove(chart_to_send)
-            except:
-                pass
+        alert_dispatcher.submit("Alertas Forenses CFDI", "\n\n".join(alerts), chart=chart_to_send, company_id=company_id)
+
+def rollup_db():
+    return mongo_db()
+
+def gold_months(company_id, keys, unique_field):
+    """Months where the given CFDIs are stored in gold (before this run's load)."""
+    keys = [str(k) for k in keys]
+    if not keys:
+        return set()
+    if MONGO_URI:
+        collection = mongo_db()[COLLECTION_NAME]
+        found = set()
+        for i in range(0, len(keys), 10000):
+            found |= set(collection.distinct('month_year', {'company_id': company_id, unique_field: {'$in': keys[i:i + 10000]}}))
+        return found
+    stored = gold_store.read_gold(gold_store_root(), company_id, columns=[unique_field, 'month_year'])
+    if stored is None or stored.empty:
+        return set()
+    return set(stored.loc[stored[unique_field].astype(str).isin(keys), 'month_year'].dropna())
+
+def stored_near_duplicates(company_id, keys, unique_field):
+    """
+    Keys of the stored CFDIs flagged as near duplicates of one of keys. When those
+    change, the flag of such an earlier CFDI may have to go, so it is reprocessed too.
+    """
+    keys = [str(k) for k in keys]
+    if not keys:
+        return set()
+    if MONGO_URI:
+        collection = mongo_db()[COLLECTION_NAME]
+        ensure_index(collection, ('company_id', 'near_duplicate_of'), unique=False)
+        found = set()
+        for i in range(0, len(keys), 10000):
+            found |= set(collection.distinct(unique_field, {'company_id': company_id, 'near_duplicate_of': {'$in': keys[i:i + 10000]}}))
+        return {str(k) for k in found}
+    stored = gold_store.read_gold(gold_store_root(), company_id, columns=[unique_field, 'near_duplicate_of'])
+    if stored is None or stored.empty or 'near_duplicate_of' not in stored.columns:
+        return set()
+    return set(stored.loc[stored['near_duplicate_of'].astype(str).isin(keys), unique_field].astype(str))
+
+def update_alert_rollup(company_id, rollup, months=None):
+    """
+    Stores the run's monthly rollup for the alert rules: the whole rollup on a full
+    run (months=None); on an incremental run the given months, recomputed from the
+    loaded gold.
+    """
+    if months is not None:
+        months = sorted(m for m in months if m != 'NaT')
+        if not months:
+            return
+        columns = alert_rules.rollup_columns()
+        if not MONGO_URI:
+            gold = gold_store.read_gold(gold_store_root(), company_id, columns=columns, months=months)
+        else:
+            query = {'company_id': company_id, 'month_year': {'$in': months}}
+            collection = mongo_db()[COLLECTION_NAME]
+            gold = mongo_columnar.find_frame(collection, query, schemas.COLLECTIONS['gold_cfdi'], columns)
+        rollup = alert_rules.monthly_rollup(gold)
+    alert_rules.write_rollup(rollup, company_id, months, db=rollup_db(), data_dir=DATA_DIR)
+
+def rule_alerts(rollups, rules=None):
+    """
+    Evaluates the alert rules over stored rollups (one tenant or many). Returns
+    {company_id: (messages, chart)}; the chart is the trend of the first fired rule
+    that asks for one.
+    """
+    fired = alert_rules.evaluate(rollups, alert_rules.load_rules() if rules is None else rules)
+    results = {}
+    for company_id, group in fired.groupby('company_id', sort=False):
+        chart_to_send = None
+        charted = group[group['chart'].notna()]
+        if not charted.empty:
+            rule = charted.iloc[0]
+            series = alert_rules.dense_months(rollups[rollups['company_id'] == company_id]).set_index('month_year')[rule['metric']]
+            chart_to_send = alert_dispatcher.Chart(series, rule['chart'], f"alerta_{rule['rule']}_{company_id}.png")
+        results[company_id] = (group['message'].tolist(), chart_to_send)
+    return results
+
+def tenant_rule_alerts(company_id):
+    """The tenant's fired rules over its stored rollup."""
+    rollup = alert_rules.read_rollup(company_id, db=rollup_db(), data_dir=DATA_DIR)
+    return rule_alerts(rollup).get(company_id, ([], None))
+
+def gold_store_root():
+    return gold_store.store_root(DATA_DIR)
+
+def tenant_gold_missing(company_id):
+    """
+    The tenant's gold (or gold_conceptos, when concepts are exported) is not stored, in
+    MongoDB or the local store: an incremental run would have nothing to merge into.
+    """
+    with_conceptos = os.path.exists(os.path.join(DATA_DIR, "cfdi_conceptos.csv"))
+    if MONGO_URI:
+        db = mongo_db()
+        return db[COLLECTION_NAME].find_one({'company_id': company_id}, {'_id': 1}) is None or \
+            (with_conceptos and db[CONCEPTOS_COLLECTION].find_one({'company_id': company_id}, {'_id': 1}) is None)
+    conceptos_root = gold_store.store_root(DATA_DIR, gold_store.CONCEPTOS_DIRNAME)
+    return not gold_store.list_partitions(gold_store_root(), company_id) or \
+        (with_conceptos and not gold_store.list_partitions(conceptos_root, company_id))
+
+def near_duplicate_partners(ids, keys, arrays, batch_ids=None):
+    """
+    A near-duplicate partner (its key) per CFDI id, searched over the whole export.
+    Incremental runs (batch_ids) keep the batch CFDIs and the earlier CFDIs paired
+    with them, so those are reprocessed with the flag.
+    """
+    groups, seconds, cents, eligible = arrays
+    ids = np.asarray(ids)
+    if batch_ids is not None:
+        in_batch = np.isin(ids, list(batch_ids))
+        eligible = eligible & np.isin(groups, groups[in_batch & eligible])
+    partner = near_duplicates.find_partners(groups, seconds, cents, eligible)
+    rows = np.flatnonzero(partner >= 0)
+    if batch_ids is not None:
+        rows = rows[in_batch[rows] | in_batch[partner[rows]]]
+        rows = np.union1d(rows, partner[rows[in_batch[rows]]])
+    return pd.Series(pd.Series(keys).iloc[partner[rows]].to_numpy(), index=ids[rows], dtype=object)
+
+def open_duplicate_index(company_id):
+    """The tenant's duplicate index, stored next to its gold."""
+    if MONGO_URI:
+        return duplicate_index.MongoDuplicateIndex(mongo_db()[DUPLICATE_INDEX_COLLECTION], company_id)
+    return duplicate_index.LocalDuplicateIndex(gold_store.store_root(DATA_DIR, duplicate_index.DUP_INDEX_DIRNAME), company_id)
+
+def replaces_duplicate_history(watermark):
+    """A local full rebuild replaces the tenant's gold, and with it the duplicate history."""
+    return watermark is None and not MONGO_URI
+
+def patch_duplicate_flags(peers, loaded_keys, unique_field):
+    """
+    Earlier CFDIs whose duplicate flag flipped but that were not reloaded by this run
+    (gone from the export): MongoDB documents get the new flag in place.
+    """
+    peers = peers[~peers['key'].isin(loaded_keys)]
+    if peers.empty:
+        return
+    if not MONGO_URI:
+        logging.warning(f"{len(peers)} earlier CFDIs outside this export keep a stale duplicate flag until the next --full run.")
+        return
+    collection = mongo_db()[COLLECTION_NAME]
+    for flag, group in peers.groupby('is_duplicate'):
+        collection.update_many({unique_field: {"$in": group['key'].tolist()}}, {"$set": {"is_duplicate": bool(flag)}})
+    logging.info(f"Duplicate flag updated on {len(peers)} earlier gold CFDIs.")
+
+def gold_writer(unique_field):
+    """
+    Change-aware writer for the gold collection (unique index ensured once). The
+    (company_id, month_year, tipo) index serves the dashboard's month and tipo push-down.
+    """
+    return GoldWriter(mongo_db()[COLLECTION_NAME], unique_field, lookup_fields=[('company_id', 'month_year', 'tipo')])
+
+def concept_tax_state(chunksize):
+    """
+    Concept-level taxes from cfdi_concepto_traslados/retenciones, read in chunks.
+    Returns the calc_* totals and the tasa_*/tipo_factor_* per concept id, and the
+    same totals rolled up per CFDI id as conceptos_calc_*.
+    """
+    owner = 'cfdi_concepto_id'
+    totals = tax_engine.combine_totals([])
+    rates = pd.DataFrame(columns=tax_engine.RATE_COLUMNS)
+    per_cfdi = pd.DataFrame(columns=CONCEPT_TOTAL_COLUMNS, dtype='float64')
+
+    impuestos = load_csv("cfdi_concepto_impuestos.csv", usecols=['id', owner])
+    if impuestos is None or impuestos.empty:
+        return totals, rates, per_cfdi
+    imp_to_concept = impuestos.set_index('id')[owner]
+
+    total_parts, rate_parts = [], []
+    for kind, filename in [('traslados', "cfdi_concepto_traslados.csv"), ('retenciones', "cfdi_concepto_retenciones.csv")]:
+        for chunk in iter_csv(filename, chunksize, usecols=['cfdi_concepto_impuestos_id', 'impuesto', 'importe', 'tasa_o_cuota', 'tipo_factor']):
+            rows = tax_engine.tax_rows(imp_to_concept, **{kind: chunk}, parent_col='cfdi_concepto_impuestos_id', owner=owner, rates=True)
+            total_parts.append(tax_engine.tax_totals(rows, owner=owner))
+            rate_parts.append(tax_engine.rate_columns(rows, owner=owner))
+    totals = tax_engine.combine_totals(total_parts)
+    if rate_parts:
+        rates = pd.concat(rate_parts).groupby(level=0).first()
+    if totals.empty:
+        return totals, rates, per_cfdi
+
+    # Per-CFDI rollup through the concept -> cfdi map (two int columns only)
+    concept_cfdi = pd.concat(iter_csv("cfdi_conceptos.csv", chunksize, usecols=['id', 'cfdi_id']), ignore_index=True)
+    concept_cfdi = concept_cfdi.set_index('id')['cfdi_id']
+    pos = concept_cfdi.index.get_indexer(totals.index)
+    found = pos >= 0
+    per_cfdi = totals[found].groupby(concept_cfdi.to_numpy()[pos[found]]).sum()
+    per_cfdi.columns = CONCEPT_TOTAL_COLUMNS
+    per_cfdi.index.name = 'cfdi_id'
+    return totals, rates, per_cfdi
+
+def payment_documents(chunksize, watermark=None):
+    """
+    Every REP payment (cfdi_pagos -> pago_detalles -> documentos_relacionados, plus the
+    IVA of pago_dr_impuestos) resolved to the invoice it pays, one row per paid document.
+
+    Returns the documents and the latest payment-table timestamp for the next watermark.
+    With a watermark, documents whose rows changed after it are flagged in 'changed'.
+    Documents carried by a cancelled REP are flagged in 'rep_cancelled'.
+    """
+    pagos = load_csv("cfdi_pagos.csv", usecols=['id', 'cfdi_id', 'created_at', 'updated_at'])
+    detalles = load_csv("cfdi_pago_detalles.csv", usecols=['id', 'cfdi_pago_id', 'fecha_pago', 'created_at', 'updated_at'])
+    if pagos is None or detalles is None or not os.path.exists(os.path.join(DATA_DIR, "cfdi_pago_documentos_relacionados.csv")):
+        return pd.DataFrame(), None
+
+    stamps = []
+    def changed(df):
+        ts = row_timestamps(df)
+        stamps.append(ts.max())
+        if watermark is None:
+            return np.zeros(len(df), dtype=bool)
+        return (ts.isna() | (ts > watermark)).to_numpy()
+
+    def latest():
+        valid = [ts for ts in stamps if pd.notnull(ts)]
+        return max(valid) if valid else None
+
+    # Invoices are referenced by cfdi_relacionado_id when Laravel resolved them, else by uuid
+    uuid_parts, cancelled_parts = [], []
+    for chunk in iter_csv("cfdis.csv", chunksize, usecols=['id', 'uuid', 'estatus']):
+        uuid_parts.append(pd.Series(chunk['id'].to_numpy(), index=chunk['uuid'].astype(str).str.lower()))
+        cancelled_parts.append(chunk.loc[chunk['estatus'].astype(str).str.lower().str.contains('cancel', na=False), 'id'])
+    uuid_to_id = pd.concat(uuid_parts)
+    uuid_to_id = uuid_to_id[~uuid_to_id.index.duplicated()]
+    cancelled = pd.concat(cancelled_parts)
+
+    pagos = pagos.assign(changed=changed(pagos), rep_cancelled=pagos['cfdi_id'].isin(cancelled)).set_index('id')
+    detalles = detalles.assign(changed=changed(detalles)).set_index('id')
+    det_pago = pagos.reindex(detalles['cfdi_pago_id'].to_numpy())
+    detalles['changed'] = detalles['changed'].to_numpy() | det_pago['changed'].fillna(True).to_numpy(bool)
+    detalles['rep_cancelled'] = det_pago['rep_cancelled'].fillna(False).to_numpy(bool)
+    detalles['rep_cfdi_id'] = det_pago['cfdi_id'].to_numpy()
+
+    doc_parts = []
+    for chunk in iter_csv("cfdi_pago_documentos_relacionados.csv", chunksize,
+                          usecols=['id', 'cfdi_pago_detalle_id', 'id_documento', 'cfdi_relacionado_id', 'num_parcialidad', 'imp_pagado',
+                                   'created_at', 'updated_at']):
+        invoice = pd.Series(chunk['cfdi_relacionado_id'], dtype='Float64')
+        by_uuid = uuid_to_id.reindex(chunk['id_documento'].astype(str).str.lower().to_numpy()).to_numpy(dtype='float64', na_value=np.nan)
+        invoice = invoice.fillna(pd.Series(by_uuid, index=chunk.index))
+        det = detalles.reindex(chunk['cfdi_pago_detalle_id'].to_numpy())
+        doc_parts.append(pd.DataFrame({
+            'doc_id': chunk['id'].to_numpy(),
+            'invoice_id': invoice.to_numpy(dtype='float64', na_value=np.nan),
+            'rep_cfdi_id': det['rep_cfdi_id'].to_numpy(),
+            'num_parcialidad': chunk['num_parcialidad'].to_numpy() if 'num_parcialidad' in chunk else np.nan,
+            'imp_pagado': chunk['imp_pagado'].fillna(0).to_numpy(np.float64),
+            'fecha_pago': det['fecha_pago'].to_numpy(),
+            'changed': changed(chunk) | det['changed'].fillna(True).to_numpy(bool),
+            'rep_cancelled': det['rep_cancelled'].fillna(False).to_numpy(bool),
+        }))
+    docs = pd.concat(doc_parts, ignore_index=True) if doc_parts else pd.DataFrame()
+    if docs.empty:
+        return docs, latest()
+    # Unresolved documents (invoices outside this export) cannot be applied
+    docs = docs[docs['invoice_id'].notna()]
+    docs['invoice_id'] = docs['invoice_id'].astype(np.int64)
+
+    # IVA trasladado paid with each document
+    iva = pd.Series(0.0, index=pd.Index(docs['doc_id']))
+    for chunk in iter_csv("cfdi_pago_dr_impuestos.csv", chunksize,
+                          usecols=['cfdi_pago_documento_relacionado_id', 'impuesto_dr', 'importe_dr', 'tipo', 'created_at', 'updated_at']):
+        is_iva = (tax_engine.impuesto_codes(chunk['impuesto_dr']) == tax_engine.IVA) & \
+            chunk['tipo'].astype(str).str.lower().str.startswith('traslado').to_numpy()
+        doc_iva = chunk[is_iva].groupby('cfdi_pago_documento_relacionado_id')['importe_dr'].sum()
+        iva = iva.add(doc_iva, fill_value=0).reindex(iva.index)
+        touched_docs = chunk.loc[changed(chunk), 'cfdi_pago_documento_relacionado_id']
+        docs.loc[docs['doc_id'].isin(touched_docs), 'changed'] = True
+    docs['iva_pagado'] = iva.reindex(docs['doc_id'].to_numpy()).fillna(0).to_numpy()
+    return docs.reset_index(drop=True), latest()
+
+def payment_state(docs):
+    """
+    Paid amount, IVA paid, parcialidades and last payment date per invoice id from
+    payment_documents(), plus the ids of invoices touched by changed payment rows.
+    """
+    state = pd.DataFrame(columns=['rep_pagado', 'rep_iva_pagado', 'rep_parcialidades', 'rep_ultimo_pago'])
+    if docs.empty:
+        return state, set()
+    touched = set(docs.loc[docs['changed'], 'invoice_id'])
+    applied = docs[~docs['rep_cancelled']]
+    grouped = applied.groupby('invoice_id')
+    state = pd.DataFrame({
+        'rep_pagado': grouped['imp_pagado'].sum(),
+        'rep_iva_pagado': grouped['iva_pagado'].sum(),
+        'rep_parcialidades': grouped['doc_id'].count(),
+        'rep_ultimo_pago': grouped['fecha_pago'].max(),
+    })
+    return state, touched
+
+def apply_payments(cfdis, state):
+    """REP columns for the PPD invoices of a frame (or chunk); other CFDIs get nulls."""
+    ppd = (cfdis['metodo_pago'].astype(str).str.lower() == 'ppd').to_numpy() if 'metodo_pago' in cfdis.columns \
+        else np.zeros(len(cfdis), dtype=bool)
+    pos = state.index.get_indexer(cfdis['id'])
+    paid = pos >= 0
+    take = np.where(paid, pos, 0)
+
+    def column(name, default):
+        values = state[name].to_numpy()[take] if len(state) else np.full(len(cfdis), default)
+        return np.where(paid, values, default)
+
+    pagado = column('rep_pagado', 0.0).astype(np.float64)
+    cfdis['rep_pagado'] = np.where(ppd, pagado, np.nan)
+    cfdis['rep_iva_pagado'] = np.where(ppd, column('rep_iva_pagado', 0.0).astype(np.float64), np.nan)
+    cfdis['rep_saldo_insoluto'] = np.where(ppd, cfdis['total'].to_numpy(np.float64) - pagado, np.nan)
+    parcialidades = pd.array(column('rep_parcialidades', 0).astype(np.int64), dtype='Int64')
+    parcialidades[~ppd] = pd.NA
+    cfdis['rep_parcialidades'] = parcialidades
+    cfdis['rep_ultimo_pago'] = pd.to_datetime(pd.Series(column('rep_ultimo_pago', pd.NaT), index=cfdis.index)).where(ppd)
+    return cfdis
+
+def cfdi_keys(cfdis):
+    """id -> uuid, company_id, month_year of the gold CFDIs, to stamp their concepts."""
+    return cfdis.drop_duplicates('id').set_index('id')[['uuid', 'company_id', 'month_year']]
+
+def build_conceptos(keys, totals, rates, chunksize):
+    """
+    Yields gold_conceptos chunks: every concept of the CFDIs in keys, with its calc_*
+    taxes, tasa/tipo_factor per tax and the CFDI uuid, sorted by uuid.
+    """
+    for chunk in iter_csv("cfdi_conceptos.csv", chunksize, usecols=CONCEPT_COLUMNS):
+        pos = keys.index.get_indexer(chunk['cfdi_id'])
+        chunk = chunk[pos >= 0].rename(columns={'id': 'concepto_id'})
+        if chunk.empty:
+            continue
+        stamped = keys.iloc[pos[pos >= 0]]
+        for col in stamped.columns:
+            chunk[col] = stamped[col].to_numpy()
+        # Concept ids are only unique within one Laravel export; the uuid makes the key global
+        chunk['concepto_key'] = chunk['uuid'].astype(str) + ':' + chunk['concepto_id'].astype(str)
+        chunk = tax_engine.join_tax_totals(chunk, totals, on='concepto_id')
+        chunk_rates = rates.reindex(chunk['concepto_id'].to_numpy())
+        for col in tax_engine.RATE_COLUMNS:
+            chunk[col] = chunk_rates[col].to_numpy()
+        yield chunk.sort_values('uuid', kind='stable')
+
+def write_conceptos(chunks, company_id, incremental, write_slots=None, months=None):
+    """
+    Loads gold_conceptos into the local store (merged by uuid) or MongoDB. Returns (rows, writer).
+    months: where the invoices' concepts were stored before (incremental local merges).
+    """
+    rows = 0
+    if not MONGO_URI:
+        root = gold_store.store_root(DATA_DIR, gold_store.CONCEPTOS_DIRNAME)
+        os.makedirs(root, exist_ok=True)
+        staging = gold_store.new_staging(root, company_id)
+        try:
+            for chunk in chunks:
+                gold_store.write_staging(chunk, staging)
+                rows += len(chunk)
+            gold_store.commit_staging(staging, root, company_id, 'uuid', full=not incremental, months=months)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        logging.info(f"gold_conceptos: {rows} concepts saved locally")
+        return rows, None
+
+    writer = GoldWriter(mongo_db()[CONCEPTOS_COLLECTION], 'concepto_key', lookup_fields=['uuid'])
+    for chunk in chunks:
+        with write_slots or nullcontext():
+            writer.write(chunk)
+        rows += len(chunk)
+    writer.report()
+    return rows, writer
+
+def related_documents():
+    """cfdi_relacionados rows (notas de crédito, sustituciones, anticipos...), None when not exported."""
+    if not os.path.exists(os.path.join(DATA_DIR, "cfdi_relacionados.csv")):
+        return None
+    return load_csv("cfdi_relacionados.csv", usecols=['cfdi_id', 'tipo_relacion', 'uuid_relacionado', 'cfdi_relacionado_id'])
+
+def report_gold(company_id):
+    """The tenant's loaded gold, only the columns the fiscal_reports builder needs."""
+    if not MONGO_URI:
+        return gold_store.read_gold(gold_store_root(), company_id, columns=fiscal_reports.GOLD_COLUMNS)
+    collection = mongo_db()[COLLECTION_NAME]
+    return mongo_columnar.find_frame(collection, {'company_id': company_id}, schemas.COLLECTIONS['gold_cfdi'],
+                                     fiscal_reports.GOLD_COLUMNS)
+
+def load_fiscal_reports(company_id, processed_ids, payment_docs, incremental, write_slots=None):
+    """
+    Rebuilds the fiscal_reports partitions holding a CFDI processed by this run (all of
+    them on a full run) from the loaded gold. Returns the number of partitions published.
+    """
+    gold = report_gold(company_id)
+    if gold is None or gold.empty:
+        return 0
+    db = mongo_db(fiscal_reports.FISCAL_DB_NAME)
+    roots, events = fiscal_reports.chains(gold, payment_docs, related_documents())
+
+    periodos = None
+    if incremental:
+        # Plus the periods that held these CFDIs before, in case they moved month or stopped being invoices
+        processed_uuids = gold.loc[gold['id'].isin(list(processed_ids)), 'uuid']
+        periodos = fiscal_reports.affected_periodos(roots, events, processed_ids) | \
+            fiscal_reports.stored_periodos(company_id, processed_uuids, db=db, data_dir=DATA_DIR)
+        if not periodos:
+            return 0
+
+    reports = fiscal_reports.build_reports(roots, events, company_id, periodos)
+    with (write_slots if db is not None and write_slots is not None else nullcontext()):
+        return fiscal_reports.publish(reports, company_id, periodos, db=db, data_dir=DATA_DIR)
+
+def run_summary(company_id, incremental, rows_read, rows_written, loaded, timer, writer=None, conceptos=0, periodos=0):
+    """Outcome of one pipeline run, consumed by the multi-tenant runner."""
+    summary = {
+        "company_id": company_id,
+        "mode": "incremental" if incremental else "full",
+        "rows_read": int(rows_read),
+        "rows_written": int(rows_written),
+        "conceptos_written": int(conceptos),
+        "fiscal_periodos": int(periodos),
+        "loaded": loaded,
+        "stages": timer.stats,
+        "mongo": writer.stats if writer is not None else None,
+    }
+    return record_run(summary)
+
+def profile_baseline(company_id):
+    """The tenant's baseline report: PROFILE_BASELINE in DATA_DIR, named after the company."""
+    if not PROFILE_BASELINE:
+        return None
+    root, ext = os.path.splitext(os.path.join(DATA_DIR, PROFILE_BASELINE))
+    return f"{root}_{company_id}{ext or '.json'}"
+
+def record_run(summary):
+    """
+    Writes the JSON run report next to the output and, when the tenant's baseline
+    holds an earlier report, lists the stages that regressed past it in the summary.
+    A missing baseline file is created from this run.
+    """
+    report_path = os.path.join(DATA_DIR, RUN_REPORT_FILE)
+    baseline_path = profile_baseline(summary["company_id"])
+    summary["regressions"] = []
+    if baseline_path and os.path.exists(baseline_path):
+        try:
+            baseline = run_profile.load_report(baseline_path)
+            summary["regressions"] = run_profile.compare_baseline(summary["stages"], baseline, PROFILE_TOLERANCE, PROFILE_MIN_SECONDS)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Baseline {baseline_path} unreadable, regression check skipped: {e}")
+        for r in summary["regressions"]:
+            logging.error(f"Stage regression: {r['stage']} {r['metric']} {r['current']:.2f} vs baseline {r['baseline']:.2f}")
+    try:
+        run_profile.write_report(summary, report_path)
+        logging.info(f"Run report written to {report_path}")
+        if baseline_path and not os.path.exists(baseline_path):
+            shutil.copyfile(report_path, baseline_path)
+            logging.info(f"Baseline {baseline_path} created from this run")
+    except OSError as e:
+        logging.warning(f"Run report not written: {e}")
+    return summary
+
+def select_changed(cfdis, impuestos, traslados, retenciones, changed_ids):
+    """The CFDIs of an incremental run and their tax rows; everything on a full run."""
+    if changed_ids is None:
+        return cfdis, impuestos, traslados, retenciones
+    cfdis = cfdis[cfdis['id'].isin(changed_ids)]
+    if impuestos is not None:
+        impuestos = impuestos[impuestos['cfdi_id'].isin(changed_ids)]
+        if traslados is not None:
+            traslados = traslados[traslados['cfdi_comprobante_impuestos_id'].isin(impuestos['id'])]
+        if retenciones is not None:
+            retenciones = retenciones[retenciones['cfdi_comprobante_impuestos_id'].isin(impuestos['id'])]
+    return cfdis, impuestos, traslados, retenciones
+
+def flag_near_duplicates(cfdis, near_partners):
+    """near_duplicate and near_duplicate_of (the nearest partner's uuid) per CFDI."""
+    cfdis['near_duplicate_of'] = cfdis['id'].map(near_partners)
+    cfdis['near_duplicate'] = cfdis['near_duplicate_of'].notna()
+    return cfdis
+
+def forensics(cfdis, dup_hashes, near_partners):
+    """
+    Duplicate and near-duplicate flags and the emission period. Returns the frame, the
+    duplicate alerts and its monthly rollup for the alert rules. dup_hashes are the
+    triad hashes the duplicate index holds more than once; near_partners maps CFDI ids
+    to their nearest near-duplicate.
+    """
+    alerts = []
+    cfdis = cfdis.copy(deep=False)
+
+    # Check for Duplicates (Tríada: RFC + Monto + Fecha), against the tenant's whole history
+    group_cols = duplicate_key_cols(cfdis.columns)
+    cfdis['is_duplicate'] = np.isin(duplicate_index.triad_hash(cfdis), dup_hashes)
+    if cfdis['is_duplicate'].any():
+        alerts.append(f"Posibles Duplicados Detectados:\n{cfdis.loc[cfdis['is_duplicate'], group_cols].head(10).to_string()}")
+
+    # Same emisor, almost the same amount, a few days apart
+    cfdis = flag_near_duplicates(cfdis, near_partners)
+    if cfdis['near_duplicate'].any():
+        alerts.append(f"Posibles Casi-Duplicados Detectados:\n{cfdis.loc[cfdis['near_duplicate'], group_cols + ['near_duplicate_of']].head(10).to_string()}")
+
+    cfdis = add_period(cfdis)
+
+    # Convert period to string for serialization
+    cfdis['month_year'] = cfdis['month_year'].astype(str)
+    return cfdis, alerts, alert_rules.monthly_rollup(cfdis)
+
+def pipeline_graph(company_id, watermark, chunksize, timer, dup_index, use_cache=True):
+    """
+    The batch pipeline as named stages with declared inputs (see stage_cache).
+    Stages work on shallow copies: their inputs are shared through the cache.
+    """
+    graph = StageGraph(StageCache(DATA_DIR, enabled=use_cache, code_files=PIPELINE_SOURCES), timer)
+    for name, filename in EXPORT_TABLES.items():
+        graph.add(f"load_{name}", partial(load_csv, filename), files=[filename])
+    loads = [f"load_{name}" for name in EXPORT_TABLES]
+
+    graph.add("stamps", lambda *tables: (max_timestamp(list(tables)), len(tables[0])), deps=loads)
+    graph.add("payments", lambda: payment_documents(chunksize, watermark), files=PAYMENT_FILES, params={"watermark": watermark})
+    graph.add("concept_taxes", lambda: concept_tax_state(chunksize), files=CONCEPT_FILES)
+
+    def changes(cfdis, impuestos, traslados, retenciones, receptors, emisors, payments):
+        _, paid_touched = payment_state(payments[0])
+        return changed_cfdi_ids(watermark, cfdis, impuestos, traslados, retenciones, emisors, receptors) | paid_touched
+    if watermark is None:
+        # Full run: no selection, so nothing downstream depends on the catalogs through it
+        graph.add("changes", lambda: None, persist=False)
+    else:
+        graph.add("changes", changes, deps=loads + ["payments"], params={"watermark": watermark}, persist=False)
+
+    # The batch's triad hashes against the duplicate index
+    replace_history = replaces_duplicate_history(watermark)
+    def duplicates(cfdis, emisors, changed_ids):
+        batch = cfdis if changed_ids is None else cfdis[cfdis['id'].isin(changed_ids)]
+        keys, hashes = duplicate_keys(batch), duplicate_index.triad_hash(with_emisor_rfc(batch, emisors))
+        dup_hashes, peers = duplicate_index.check_batch(dup_index, keys, hashes, history=not replace_history)
+        return keys, hashes, dup_hashes, peers
+    graph.add("duplicates", duplicates, deps=["load_cfdis", "load_emisors", "changes"],
+              params={"history": None if replace_history else dup_index.version()}, persist=False)
+
+    graph.add("near_duplicates", lambda cfdis, emisors, receptors, changed_ids: near_duplicate_partners(
+        cfdis['id'].to_numpy(), duplicate_keys(cfdis), near_duplicates.invoice_arrays(cfdis, emisors, receptors), changed_ids),
+        deps=["load_cfdis", "load_emisors", "load_receptors", "changes"], persist=False,
+        # The thresholds decide the pairs: changing one must invalidate forensics and the publish marker
+        params={"days": near_duplicates.NEAR_DUP_DAYS, "tolerance": near_duplicates.NEAR_DUP_AMOUNT_TOLERANCE,
+                "abs_tolerance": near_duplicates.NEAR_DUP_AMOUNT_ABS, "max_window": near_duplicates.NEAR_DUP_MAX_WINDOW})
+
+    def select(cfdis, impuestos, traslados, retenciones, changed_ids, duplicates, near_partners):
+        # Earlier CFDIs whose duplicate flag flips, that pair with the batch, or that were
+        # stored as near duplicates of it (their partner may be gone) are reprocessed with it
+        if changed_ids is not None:
+            keys = duplicate_keys(cfdis)
+            stale = stored_near_duplicates(company_id, keys[cfdis['id'].isin(changed_ids).to_numpy()],
+                                           'uuid' if 'uuid' in cfdis.columns else 'id')
+            changed_ids = changed_ids | set(near_partners.index) | set(cfdis.loc[np.isin(keys, list(stale)), 'id'])
+            if len(duplicates[3]):
+                changed_ids = changed_ids | set(cfdis.loc[np.isin(keys, duplicates[3]['key']), 'id'])
+        return select_changed(cfdis, impuestos, traslados, retenciones, changed_ids)
+    graph.add("select", select, deps=["load_cfdis", "load_impuestos", "load_traslados", "load_retenciones", "changes",
+                                      "duplicates", "near_duplicates"], persist=False)
+
+    # Cleaning & pre-processing
+    graph.add("clean", lambda selected: clean_cfdis(selected[0].copy(deep=False)), deps=["select"], persist=False)
+
+    # Taxes aggregates per CFDI, from the comprobante and the concept tax tables
+    # Logic: cfdis.id -> impuestos.cfdi_id (impuestos.id) -> traslados/retenciones.cfdi_comprobante_impuestos_id
+    def taxes(cfdis, selected, concept_taxes):
+        cfdis = tax_engine.aggregate_taxes(cfdis.copy(deep=False), *selected[1:])
+        return tax_engine.join_tax_totals(cfdis, concept_taxes[2], columns=CONCEPT_TOTAL_COLUMNS)
+    graph.add("taxes", taxes, deps=["clean", "select", "concept_taxes"])
+
+    # Saldo insoluto per PPD invoice from the applied REP payments
+    graph.add("apply_payments", lambda cfdis, payments: apply_payments(cfdis.copy(deep=False), payment_state(payments[0])[0]),
+              deps=["taxes", "payments"], persist=False)
+
+    # Names and financial calculations
+    def enrich(cfdis, emisors, receptors):
+        cfdis = enrich_names(cfdis.assign(company_id=company_id), emisors, receptors)
+        return add_financials(cfdis)
+    graph.add("enrich", enrich, deps=["apply_payments", "load_emisors", "load_receptors"], params={"company_id": company_id}, persist=False)
+
+    graph.add("forensics", lambda cfdis, duplicates, near_partners: forensics(cfdis, duplicates[2], near_partners),
+              deps=["enrich", "duplicates", "near_duplicates"])
+
+    # Never computed: its key tells whether this exact output was already published
+    graph.add("publish", None, files=["cfdi_relacionados.csv"], deps=["forensics", "payments", "concept_taxes"])
+    return graph
+
+def main(full=False, chunksize=None, company_id=None, write_slots=None, use_cache=None, evaluate_alerts=True):
+    """
+    Runs the pipeline for one tenant and returns a run summary.
+    write_slots is an optional semaphore that bounds concurrent MongoDB writers.
+    use_cache (default STAGE_CACHE) reuses stage outputs whose inputs did not change.
+    evaluate_alerts=False leaves the alert rules to the caller (tenant_runner evaluates
+    every tenant's rollup in one pass after ingest).
+    """
+    if chunksize:
+        return main_streaming(full=full, chunksize=chunksize, company_id=company_id, write_slots=write_slots,
+                              evaluate_alerts=evaluate_alerts)
+
+    logging.info("Starting Migration Pipeline...")
+    timer = StageTimer(trace_memory=PROFILE_MEMORY)
+
+    if not os.path.exists(os.path.join(DATA_DIR, "cfdis.csv")):
+        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
+        return
+
+    # --- NEW: Inject Company ID for Multi-tenancy ---
+    # Default to a value from ENV or argument
+    COMPANY_ID = company_id or os.getenv("COMPANY_ID", "DEFAULT_TENANT")
+    logging.info(f"Targeting Company ID: {COMPANY_ID}")
+
+    # 1. Incremental Mode: keep only CFDIs changed since the last successful run
+    gold_missing = tenant_gold_missing(COMPANY_ID)
+    watermark = None if full or gold_missing else load_watermark(COMPANY_ID)
+    incremental = watermark is not None
+    dup_index = open_duplicate_index(COMPANY_ID)
+    graph = pipeline_graph(COMPANY_ID, watermark, chunksize or CHUNK_SIZE, timer, dup_index, STAGE_CACHE if use_cache is None else use_cache)
+
+    new_watermark, rows_read = graph.get("stamps")
+    # REP payments are always aggregated in full; incremental runs only recompute the invoices they touch
+    payment_docs, payments_stamp = graph.get("payments")
+    new_watermark = max([ts for ts in [new_watermark, payments_stamp] if pd.notnull(ts)], default=None)
+
+    if incremental:
+        changed_ids = graph.get("changes")
+        logging.info(f"Incremental run since {watermark}: {len(changed_ids)} of {rows_read} CFDIs changed.")
+        if not changed_ids:
+            logging.info("Nothing to do. Use --full to force a complete rebuild.")
+            return run_summary(COMPANY_ID, incremental, rows_read, 0, True, timer)
+    else:
+        logging.info("Full rebuild: processing every CFDI.")
+
+    # 2-6. Clean -> taxes -> payments -> enrich -> forensics, reusing every unchanged stage
+    cfdis, alerts, rollup = graph.get("forensics")
+    logging.info(f"Processed {len(cfdis)} records.")
+
+    # For simplicity, we define 'uuid' as unique index if it exists, else 'id'
+    unique_field = 'uuid' if 'uuid' in cfdis.columns else 'id'
+
+    rows_written = len(cfdis)
+    publish_key = graph.key("publish")
+    # The marker is only trusted while the targets still hold the tenant (a dropped collection is republished)
+    if graph.cache.is_marked("publish", publish_key) and not gold_missing and \
+            fiscal_reports.has_reports(COMPANY_ID, db=mongo_db(fiscal_reports.FISCAL_DB_NAME), data_dir=DATA_DIR):
+        logging.info("Gold, gold_conceptos and fiscal_reports already hold this exact output. Load skipped.")
+        timer.report()
+        # Nothing was published: the run that published this output already sent its alerts
+        save_watermark(COMPANY_ID, new_watermark)
+        return run_summary(COMPANY_ID, incremental, rows_read, 0, True, timer)
+
+    # Months the batch touches in the alert rollup and the local store, including where its CFDIs were before
+    rollup_months = set(rollup['month_year']) | gold_months(COMPANY_ID, cfdis[unique_field], unique_field) if incremental else None
 
     # 7. MongoDB Load
+    loaded = False
+    writer = None
+    with timer.stage("load_gold", len(cfdis)):
+        if not MONGO_URI:
+            logging.warning("No MongoDB URI provided. Skipping DB upload.")
+            # Local partitioned store; incremental runs only rewrite the touched months
+            gold_store.write_gold(cfdis, gold_store_root(), COMPANY_ID, unique_field, full=not incremental, months=rollup_months)
+            logging.info(f"Data saved locally to {gold_store.tenant_dir(gold_store_root(), COMPANY_ID)}")
+            loaded = True
+        else:
+            try:
+                with write_slots or nullcontext():
+                    writer = gold_writer(unique_field)
+                    writer.write(cfdis)
+                writer.report()
+                loaded = True
+            except Exception as e:
+                logging.error(f"MongoDB Error: {e}")
+
+    # 7b. gold_conceptos for the same CFDIs
+    conceptos_written = 0
+    if loaded and 'uuid' in cfdis.columns:
+        with timer.stage("load_conceptos") as st:
+            try:
+                concept_totals, concept_rates, _ = graph.get("concept_taxes")
+                chunks = build_conceptos(cfdi_keys(cfdis), concept_totals, concept_rates, chunksize or CHUNK_SIZE)
+                conceptos_written, _ = write_conceptos(chunks, COMPANY_ID, incremental, write_slots, rollup_months)
+                st["rows"] = conceptos_written
+            except Exception as e:
+                loaded = False
+                logging.error(f"gold_conceptos load failed: {e}")
+
+    # 7c. fiscal_reports partitions of the periods this run touched
+    periodos_published = 0
+    if loaded:
+        with timer.stage("fiscal_reports") as st:
+            try:
+                periodos_published = load_fiscal_reports(COMPANY_ID, set(cfdis['id']), payment_docs, incremental, write_slots)
+                st["rows"] = periodos_published
+            except Exception as e:
+                loaded = False
+                logging.error(f"fiscal_reports build failed: {e}")
+
+    timer.report()
+
+    # 8. Record the batch in the duplicate index and advance the watermark only after a successful load
+    if loaded:
+        keys, hashes, _, peers = graph.get("duplicates")
+        with timer.stage("duplicate_index", len(keys)):
+            dup_index.commit(keys, hashes, replace=replaces_duplicate_history(watermark))
+            patch_duplicate_flags(peers, duplicate_keys(cfdis), unique_field)
+        with timer.stage("alert_rollup", len(rollup)):
+            update_alert_rollup(COMPANY_ID, rollup, rollup_months)
+        graph.cache.mark("publish", publish_key)
+        save_watermark(COMPANY_ID, new_watermark)
+    send_run_alerts(COMPANY_ID, alerts, evaluate_alerts and loaded)
+    return run_summary(COMPANY_ID, incremental, rows_read, rows_written, loaded, timer, writer, conceptos_written, periodos_published)
+
+def main_streaming(full=False, chunksize=CHUNK_SIZE, company_id=None, write_slots=None, evaluate_alerts=True):
+    """
+    Bounded-memory variant of main() for multi-GB exports.
+
+    cfdis.csv and the tax tables are read in fixed-size chunks. Across chunks the
+    pipeline only keeps compact per-CFDI state (ids, foreign keys, change timestamps,
+    duplicate-key hashes and tax totals) plus the concept-level tax totals; every
+    cfdis and cfdi_conceptos chunk is cleaned, joined, enriched and written on its
+    own, so the wide rows never accumulate.
+    """
+    logging.info(f"Starting Migration Pipeline (streaming, {chunksize:,} rows per chunk)...")
+    timer = StageTimer(trace_memory=PROFILE_MEMORY)
+
+    if not os.path.exists(os.path.join(DATA_DIR, "cfdis.csv")):
+        logging.critical("CRITICAL: cfdis.csv missing. Aborting.")
+        return
+
+    COMPANY_ID = company_id or os.getenv("COMPANY_ID", "DEFAULT_TENANT")
+    logging.info(f"Targeting Company ID: {COMPANY_ID}")
+
+    # Catalogs are small, load them whole
+    receptors = load_csv("cfdi_receptors.csv")
+    emisors = load_csv("cfdi_emisors.csv")
+
+    watermark = None if full or tenant_gold_missing(COMPANY_ID) else load_watermark(COMPANY_ID)
+    incremental = watermark is not None
+    stamps = [max_timestamp([receptors, emisors])]
+    ts_cols = ['created_at', 'updated_at']
+
+    # Duplicate triad uses the emisor RFC when the catalog provides it
+    rfc_col = None
+    if emisors is not None:
+        rfc_col = next((c for c in emisors.columns if 'rfc' in c.lower()), None)
+    group_cols = duplicate_key_cols(['emisor_rfc'] if rfc_col else [])
+
+    # Pass 1: compact index of cfdis.csv
+    index_parts = []
+    key_field = 'id'
+    index_cols = ['id', 'uuid', 'emisor_id', 'receptor_id', 'total', 'fecha_emision', 'tipo', 'estatus']
+    for chunk in iter_csv("cfdis.csv", chunksize, usecols=index_cols + ts_cols):
+        with timer.stage("index", len(chunk)):
+            ts = row_timestamps(chunk)
+            stamps.append(ts.max())
+            groups, seconds, cents, eligible = near_duplicates.invoice_arrays(chunk, emisors, receptors)
+            key_field = 'uuid' if 'uuid' in chunk.columns else 'id'
+            index_parts.append(pd.DataFrame({
+                'id': chunk['id'],
+                'emisor_id': chunk['emisor_id'],
+                'receptor_id': chunk['receptor_id'],
+                'updated_at': ts,
+                # Arrow-backed strings: a few bytes per uuid instead of a Python object
+                'key': pd.array(duplicate_keys(chunk), dtype='string[pyarrow]'),
+                'dup_hash': duplicate_index.triad_hash(with_emisor_rfc(chunk, emisors)),
+                'near_group': groups,
+                'seconds': seconds,
+                'cents': cents,
+                'near_eligible': eligible,
+            }))
+    index = pd.concat(index_parts, ignore_index=True)
+    rows_read = len(index)
+    del index_parts
+
+    # Pass 2: impuestos -> cfdi map
+    imp_parts = []
+    for chunk in iter_csv("cfdi_comprobante_impuestos.csv", chunksize, usecols=['id', 'cfdi_id'] + ts_cols):
+        ts = row_timestamps(chunk)
+        stamps.append(ts.max())
+        imp_parts.append(pd.DataFrame({'id': chunk['id'], 'cfdi_id': chunk['cfdi_id'], 'updated_at': ts}))
+    impuestos = pd.concat(imp_parts, ignore_index=True) if imp_parts else None
+    imp_to_cfdi = impuestos.set_index('id')['cfdi_id'] if impuestos is not None else None
+
+    # Pass 3: tax tables reduced to per-CFDI totals chunk by chunk
+    tax_parts = []
+    changed_children = {'traslados': None, 'retenciones': None}
+    tax_files = {'traslados': "cfdi_comprobante_traslados.csv", 'retenciones': "cfdi_comprobante_retenciones.csv"}
+    for kind, filename in tax_files.items():
+        if imp_to_cfdi is None or not os.path.exists(os.path.join(DATA_DIR, filename)):
+            continue
+        changed_rows = []
+        for chunk in iter_csv(filename, chunksize, usecols=['cfdi_comprobante_impuestos_id', 'impuesto', 'importe'] + ts_cols):
+            with timer.stage("taxes", len(chunk)):
+                ts = row_timestamps(chunk)
+                stamps.append(ts.max())
+                if incremental:
+                    changed_mask = ts.isna() | (ts > watermark)
+                    changed_rows.append(pd.DataFrame({
+                        'cfdi_comprobante_impuestos_id': chunk.loc[changed_mask, 'cfdi_comprobante_impuestos_id'],
+                        'updated_at': ts[changed_mask],
+                    }))
+                rows = tax_engine.tax_rows(imp_to_cfdi, **{kind: chunk})
+                tax_parts.append(tax_engine.tax_totals(rows))
+                # Re-reduce so the partials stay proportional to the number of CFDIs
+                if sum(len(p) for p in tax_parts) > 4 * chunksize:
+                    tax_parts = [tax_engine.combine_totals(tax_parts)]
+        if changed_rows:
+            changed_children[kind] = pd.concat(changed_rows, ignore_index=True)
+    tax_totals = tax_engine.combine_totals(tax_parts)
+    del tax_parts
+
+    with timer.stage("payments"):
+        payment_docs, payments_stamp = payment_documents(chunksize, watermark)
+        payments, paid_touched = payment_state(payment_docs)
+    stamps.append(payments_stamp)
+
+    stamps = [ts for ts in stamps if pd.notnull(ts)]
+    new_watermark = max(stamps) if stamps else None
+
+    # Incremental Mode: restrict the index to changed CFDIs
+    if incremental:
+        changed_ids = changed_cfdi_ids(watermark, index, impuestos, changed_children['traslados'], changed_children['retenciones'], emisors, receptors) | paid_touched
+        logging.info(f"Incremental run since {watermark}: {len(changed_ids)} of {len(index)} CFDIs changed.")
+        if not changed_ids:
+            logging.info("Nothing to do. Use --full to force a complete rebuild.")
+            timer.report()
+            return run_summary(COMPANY_ID, incremental, rows_read, 0, True, timer)
+    else:
+        changed_ids = None
+        logging.info("Full rebuild: processing every CFDI.")
+
+    # Near duplicates over the whole export; the batch's earlier partners are reprocessed with it
+    with timer.stage("near_duplicates", len(index)):
+        near_arrays = tuple(index[col].to_numpy() for col in ['near_group', 'seconds', 'cents', 'near_eligible'])
+        near_partners = near_duplicate_partners(index['id'].to_numpy(), index['key'], near_arrays, changed_ids)
+        if changed_ids is not None:
+            # Plus the earlier CFDIs stored as near duplicates of the batch: their partner may be gone
+            stale = stored_near_duplicates(COMPANY_ID, index.loc[index['id'].isin(changed_ids), 'key'], key_field)
+            changed_ids = changed_ids | set(near_partners.index) | set(index.loc[index['key'].isin(stale), 'id'])
+        del near_arrays
+
+    # Duplicate triad hashes of the batch against the tenant's history
+    with timer.stage("duplicates", len(index)):
+        dup_index = open_duplicate_index(COMPANY_ID)
+        replace_history = replaces_duplicate_history(watermark)
+        batch = index if changed_ids is None else index[index['id'].isin(changed_ids)]
+        dup_hashes, peers = duplicate_index.check_batch(dup_index, batch['key'], batch['dup_hash'], history=not replace_history)
+        batch_keys, batch_hashes = batch['key'].to_numpy(), batch['dup_hash'].to_numpy()
+        if changed_ids is not None:
+            # Earlier CFDIs whose duplicate flag flips are reprocessed with the batch
+            changed_ids = changed_ids | set(index.loc[index['key'].isin(peers['key']), 'id'])
+            reloaded_keys = index.loc[index['id'].isin(changed_ids), 'key'].to_numpy()
+            stored_months = gold_months(COMPANY_ID, reloaded_keys, key_field)
+        else:
+            reloaded_keys = batch_keys
+    del index, batch, impuestos, imp_to_cfdi
+
+    # Pass 4: per-chunk clean -> taxes -> enrich -> write
+    rollup_parts = []
+    duplicate_sample = []
+    near_sample = []
+    processed = 0
+    loaded = True
+    unique_field = None
+    writer = None
+    staging = None
+    key_parts = []
+
+    with timer.stage("concept_taxes"):
+        concept_totals, concept_rates, concept_per_cfdi = concept_tax_state(chunksize)
     if not MONGO_URI:
         logging.warning("No MongoDB URI provided. Skipping DB upload.")
-        # Save to JSON locally for verification/demo purposes
-        output_file = os.path.join(DATA_DIR, "gold_cfdi_processed.json")
-        # Convert period to string for JSON serialization
-        if 'month_year' in cfdis.columns:
-            cfdis['month_year'] = cfdis['month_year'].astype(str)
-        cfdis.to_json(output_file, orient='records', date_format='iso')
-        logging.info(f"Data saved locally to {output_file}")
-    else:
-        try:
-            client = pymongo.MongoClient(MONGO_URI)
-            db = client[DB_NAME]
-            collection = db[COLLECTION_NAME]
-            
-            # Convert to dict
-            records = cfdis.to_dict(orient='records')
-            
-            # Batch Insert/Upsert
-            # For simplicity, we define 'uuid' as unique index if it exists, else 'id'
-            unique_field = 'uuid' if 'uuid' in cfdis.columns else 'id'
-            
-            # Create Unique Index to prevent duplicates
-            collection.create_index([(unique_field, pymongo.ASCENDING)], unique=True)
-            
-            operations = []
-            for record in records:
-                # Filter out NaN values for Mongo
-                clean_record = {k: v for k, v in record.items() if pd.notnull(v)}
-                operations.append(
-                    pymongo.UpdateOne(
-                        {unique_field: clean_record[unique_field]},
-                        {'$set': clean_record},
-                        upsert=True
-                    )
-                )
-            
-            if operations:
-                result = collection.bulk_write(operations)
-                logging.info(f"MongoDB Write: {result.upserted_count} upserted, {result.modified_count} modified.")
-                
-        except Exception as e:
-            logging.error(f"MongoDB Error: {e}")
+
+    try:
+        for chunk in iter_csv("cfdis.csv", chunksize):
+            if changed_ids is not None:
+                chunk = chunk[chunk['id'].isin(changed_ids)]
+                if chunk.empty:
+                    continue
+
+            with timer.stage("clean", len(chunk)):
+                chunk = clean_cfdis(chunk)
+
+            with timer.stage("taxes", len(chunk)):
+                chunk = tax_engine.join_tax_totals(chunk, tax_totals)
+                chunk = tax_engine.join_tax_totals(chunk, concept_per_cfdi, columns=CONCEPT_TOTAL_COLUMNS)
+
+            with timer.stage("payments", len(chunk)):
+                chunk = apply_payments(chunk, payments)
+
+            chunk['company_id'] = COMPANY_ID
+
+            with timer.stage("enrich", len(chunk)):
+                chunk = enrich_names(chunk, emisors, receptors)
+                chunk = add_financials(chunk)
+
+            with timer.stage("forensics", len(chunk)):
+                chunk['is_duplicate'] = np.isin(duplicate_index.triad_hash(chunk), dup_hashes)
+                if len(duplicate_sample) < 10 and chunk['is_duplicate'].any():
+                    duplicate_sample.append(chunk.loc[chunk['is_duplicate'], group_cols].head(10))
+                chunk = flag_near_duplicates(chunk, near_partners)
+                if len(near_sample) < 10 and chunk['near_duplicate'].any():
+                    near_sample.append(chunk.loc[chunk['near_duplicate'], group_cols + ['near_duplicate_of']].head(10))
+                chunk = add_period(chunk)
+                chunk['month_year'] = chunk['month_year'].astype(str)
+                rollup_parts.append(alert_rules.monthly_rollup(chunk))
+            if 'uuid' in chunk.columns:
+                key_parts.append(chunk[['id', 'uuid', 'company_id', 'month_year']])
+
+            with timer.stage("load_gold", len(chunk)):
+                if unique_field is None:
+                    unique_field = 'uuid' if 'uuid' in chunk.columns else 'id'
+                if not MONGO_URI:
+                    if staging is None:
+                        os.makedirs(gold_store_root(), exist_ok=True)
+                        staging = gold_store.new_staging(gold_store_root(), COMPANY_ID)
+                    gold_store.write_staging(chunk, staging)
+                else:
+                    with write_slots or nullcontext():
+                        if writer is None:
+                            writer = gold_writer(unique_field)
+                        writer.write(chunk)
+            processed += len(chunk)
+
+        if staging is not None:
+            # Publish the staged months; incremental runs merge into the touched partitions only
+            gold_store.commit_staging(staging, gold_store_root(), COMPANY_ID, unique_field, full=not incremental,
+                                      months=stored_months if incremental else None)
+            staging = None
+            logging.info(f"Data saved locally to {gold_store.tenant_dir(gold_store_root(), COMPANY_ID)}")
+    except Exception as e:
+        loaded = False
+        logging.error(f"Streaming load failed: {e}")
+    finally:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    logging.info(f"Processed {processed} records.")
+    if writer is not None:
+        writer.report()
+
+    conceptos_written = 0
+    if loaded and key_parts:
+        with timer.stage("load_conceptos") as st:
+            try:
+                chunks = build_conceptos(cfdi_keys(pd.concat(key_parts, ignore_index=True)), concept_totals, concept_rates, chunksize)
+                conceptos_written, _ = write_conceptos(chunks, COMPANY_ID, incremental, write_slots,
+                                                       stored_months if incremental else None)
+                st["rows"] = conceptos_written
+            except Exception as e:
+                loaded = False
+                logging.error(f"gold_conceptos load failed: {e}")
+
+    periodos_published = 0
+    if loaded and key_parts:
+        with timer.stage("fiscal_reports") as st:
+            try:
+                processed_ids = set(pd.concat([part['id'] for part in key_parts], ignore_index=True))
+                periodos_published = load_fiscal_reports(COMPANY_ID, processed_ids, payment_docs, incremental, write_slots)
+                st["rows"] = periodos_published
+            except Exception as e:
+                loaded = False
+                logging.error(f"fiscal_reports build failed: {e}")
+
+    # Forensics & Alerts over the accumulated state
+    alerts = []
+    if duplicate_sample:
+        alerts.append(f"Posibles Duplicados Detectados:\n{pd.concat(duplicate_sample).head(10).to_string()}")
+    if near_sample:
+        alerts.append(f"Posibles Casi-Duplicados Detectados:\n{pd.concat(near_sample).head(10).to_string()}")
+
+    if loaded:
+        with timer.stage("duplicate_index", len(batch_keys)):
+            dup_index.commit(batch_keys, batch_hashes, replace=replace_history)
+            patch_duplicate_flags(peers, reloaded_keys, unique_field or 'uuid')
+        with timer.stage("alert_rollup"):
+            rollup = alert_rules.combine_rollups(rollup_parts)
+            update_alert_rollup(COMPANY_ID, rollup, set(rollup['month_year']) | stored_months if incremental else None)
+    timer.report()
+    send_run_alerts(COMPANY_ID, alerts, evaluate_alerts and loaded)
+
+    if loaded:
+        save_watermark(COMPANY_ID, new_watermark)
+    return run_summary(COMPANY_ID, incremental, rows_read, processed, loaded, timer, writer, conceptos_written, periodos_published)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="CFDI Gold Migration Pipeline")
+    parser.add_argument("--full", action="store_true", help="Ignore the watermark and rebuild every CFDI")
+    parser.add_argument("--stream", action="store_true", help="Bounded-memory chunked ingestion for very large exports")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE, help="Rows per chunk in --stream mode")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute every stage instead of reusing cached outputs")
+    parser.add_argument("--profile-memory", action="store_true", help="Trace the peak memory allocated by every stage (slower)")
+    parser.add_argument("--report", help=f"JSON run report path (default {RUN_REPORT_FILE} in DATA_DIR)")
+    parser.add_argument("--baseline", help="Earlier run report (the tenant's <name>_<company_id>.json, relative to DATA_DIR); "
+                                               "exit with an error when a stage regresses past it")
+    args = parser.parse_args()
+    PROFILE_MEMORY = PROFILE_MEMORY or args.profile_memory
+    RUN_REPORT_FILE = args.report or RUN_REPORT_FILE
+    PROFILE_BASELINE = args.baseline or PROFILE_BASELINE
+    summary = main(full=args.full, chunksize=args.chunksize if args.stream else None, use_cache=False if args.no_cache else None)
+    if summary and summary["regressions"]:
+        sys.exit(1)
@@ -0,0 +1,110 @@
+"""
+One pooled MongoClient per process, shared by every Streamlit session and rerun.
+
+MongoClient is thread-safe and keeps its own connection pool, so the app needs a
+single instance (MONGO_MAX_POOL_SIZE sockets at most) instead of a new client per
+cache miss or login. The module is imported once per process, so shared() survives
+Streamlit reruns the same way st.cache_resource would.
+
+available() decides whether a request should use MongoDB at all:
+- the first call of the process pings the server (bounded by MONGO_SERVER_SELECTION_MS);
+- while healthy, a ping older than MONGO_HEALTH_INTERVAL is refreshed in the background;
+- once a ping or a query fails (mark_failed), requests go straight to the local gold
+  store, and a background ping every MONGO_RETRY_SECONDS brings MongoDB back.
+So an unreachable server costs one timeout per retry period, not one per rerun.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+
+import pymongo
+
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", 300000))
+MONGO_SERVER_SELECTION_MS = int(os.getenv("MONGO_SERVER_SELECTION_MS", 2000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 2000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000))
+MONGO_HEALTH_INTERVAL = float(os.getenv("MONGO_HEALTH_INTERVAL", 30))
+MONGO_RETRY_SECONDS = float(os.getenv("MONGO_RETRY_SECONDS", 30))
+
+
+class MongoPool:
+    """A pooled MongoClient plus the health state that decides when to fall back."""
+
+    def __init__(self, uri, max_pool_size=MONGO_MAX_POOL_SIZE, min_pool_size=MONGO_MIN_POOL_SIZE,
+                 server_selection_ms=MONGO_SERVER_SELECTION_MS, connect_timeout_ms=MONGO_CONNECT_TIMEOUT_MS,
+                 socket_timeout_ms=MONGO_SOCKET_TIMEOUT_MS, health_interval=MONGO_HEALTH_INTERVAL,
+                 retry_seconds=MONGO_RETRY_SECONDS):
+        # The constructor does not block: servers are discovered in the background
+        self.client = pymongo.MongoClient(
+            uri, maxPoolSize=max_pool_size, minPoolSize=min_pool_size, maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+            serverSelectionTimeoutMS=server_selection_ms, connectTimeoutMS=connect_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms,
+        )
+        self.health_interval = health_interval
+        self.retry_seconds = retry_seconds
+        self._healthy = None
+        self._checked_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def database(self, name):
+        return self.client[name]
+
+    def check(self):
+        """Pings the server now and records the result."""
+        try:
+            self.client.admin.command('ping')
+            healthy = True
+        except pymongo.errors.PyMongoError as e:
+            healthy = False
+            if self._healthy is not False:
+                logging.warning(f"MongoDB unreachable, using the local gold store: {e}")
+        with self._lock:
+            if healthy and self._healthy is False:
+                logging.info("MongoDB reachable again.")
+            self._healthy, self._checked_at, self._probing = healthy, time.monotonic(), False
+        return healthy
+
+    def available(self):
+        """Whether to query MongoDB for this request. Only the first call of the process waits on a ping."""
+        with self._lock:
+            healthy, age, probing = self._healthy, time.monotonic() - self._checked_at, self._probing
+            stale = age > (self.health_interval if healthy else self.retry_seconds)
+            if healthy is not None and stale and not probing:
+                self._probing = True
+                threading.Thread(target=self.check, name="mongo-health", daemon=True).start()
+        if healthy is None:
+            return self.check()
+        return healthy
+
+    def mark_failed(self, error):
+        """A query failed on the connection: fall back until the next successful ping."""
+        with self._lock:
+            was_healthy = self._healthy
+            self._healthy, self._checked_at = False, time.monotonic()
+        if was_healthy is not False:
+            logging.warning(f"MongoDB query failed, using the local gold store for {self.retry_seconds:g}s: {error}")
+
+    def close(self):
+        self.client.close()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared(uri=None):
+    """The process-wide pool for MONGO_URI (None when it is not configured)."""
+    global _shared
+    uri = uri or os.getenv("MONGO_URI")
+    if not uri:
+        return None
+    with _shared_lock:
+        if _shared is None:
+            _shared = MongoPool(uri)
+            atexit.register(_shared.close)
+        return _shared
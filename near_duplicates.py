@@ -0,0 +1,182 @@
+"""
+Near-duplicate invoice detection: the same emisor RFC billing the same receptor RFC
+almost the same amount a few days apart. The receptor is part of the key: a tenant's
+own issued invoices all share its emisor RFC, and similar amounts billed to different
+clients within a few days are ordinary business.
+
+Invoices are sorted by (emisor and receptor, amount band, fecha_emision) and each one
+is compared only with the invoices inside a sliding window of NEAR_DUP_DAYS, in its
+own amount band and the next one up. Bands are one tolerance wide, so a busy pair's window
+only holds invoices of a similar amount. The window is swept one offset at a time
+over the whole sorted arrays (offset k compares every invoice with its k-th
+neighbour), so the work is vectorized and proportional to the number of in-window
+candidates instead of n². NEAR_DUP_MAX_WINDOW caps the offsets for pairs that
+bill hundreds of similar amounts within the window.
+
+Two invoices are a candidate pair when their totals differ by at most
+max(NEAR_DUP_AMOUNT_ABS, NEAR_DUP_AMOUNT_TOLERANCE * larger total). Exact triad
+matches (same amount and second) are left to the duplicate index.
+"""
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+NEAR_DUP_DAYS = float(os.getenv("NEAR_DUP_DAYS", 5))
+NEAR_DUP_AMOUNT_TOLERANCE = float(os.getenv("NEAR_DUP_AMOUNT_TOLERANCE", 0.01))
+NEAR_DUP_AMOUNT_ABS = float(os.getenv("NEAR_DUP_AMOUNT_ABS", 1.0))
+NEAR_DUP_MAX_WINDOW = int(os.getenv("NEAR_DUP_MAX_WINDOW", 256))
+
+# Only issued, current income invoices can be billed twice
+ELIGIBLE_TIPOS = {'i'}
+CANCELLED_STATUSES = {'cancelado'}
+
+
+def rfc_codes(ids, catalog):
+    """
+    Integer code per catalog RFC of ids (the id itself when the catalog has no RFC),
+    -1 when the id is not in the catalog. Codes only depend on the catalog, so chunks
+    of one export get the same codes.
+    """
+    ids = pd.Series(ids)
+    rfc_col = next((c for c in catalog.columns if 'rfc' in c.lower()), None) if catalog is not None else None
+    if rfc_col is None:
+        return pd.to_numeric(ids, errors='coerce').fillna(-1).astype('int64').to_numpy()
+    codes, _ = pd.factorize(catalog[rfc_col].astype('string').str.strip().str.upper())
+    return ids.map(pd.Series(codes, index=catalog['id'].to_numpy())).fillna(-1).astype('int64').to_numpy()
+
+
+def party_groups(emisor_ids, receptor_ids, emisors, receptors):
+    """
+    Integer group per (emisor RFC, receptor RFC): the receptor code in the low 32 bits.
+    Without receptor ids the group is the emisor alone.
+    """
+    emisor = rfc_codes(emisor_ids, emisors)
+    if receptor_ids is None:
+        return emisor
+    receptor = np.minimum(rfc_codes(receptor_ids, receptors) + 1, (1 << 32) - 1)
+    return (emisor << 32) + receptor
+
+
+def invoice_arrays(df, emisors, receptors=None):
+    """
+    (groups, seconds, cents, eligible) per row of raw export rows or gold frames:
+    the inputs of candidate_pairs.
+    """
+    fecha = pd.to_datetime(df['fecha_emision'], errors='coerce')
+    total = pd.to_numeric(df['total'], errors='coerce')
+    eligible = fecha.notna().to_numpy() & (total > 0).to_numpy()
+    if 'tipo' in df.columns:
+        eligible &= df['tipo'].astype('string').str.strip().str.lower().isin(ELIGIBLE_TIPOS).to_numpy()
+    if 'estatus' in df.columns:
+        eligible &= ~df['estatus'].astype('string').str.strip().str.lower().isin(CANCELLED_STATUSES).to_numpy()
+    return (
+        party_groups(df['emisor_id'], df['receptor_id'] if 'receptor_id' in df.columns else None, emisors, receptors),
+        fecha.to_numpy(dtype='datetime64[s]').astype('int64'),
+        np.round(total.fillna(0).to_numpy() * 100).astype('int64'),
+        eligible,
+    )
+
+
+def amount_bands(cents, tolerance=NEAR_DUP_AMOUNT_TOLERANCE, abs_tolerance=NEAR_DUP_AMOUNT_ABS):
+    """
+    Log-scale amount bands one tolerance wide: two totals within tolerance of each
+    other are in the same or in adjacent bands. Below abs_tolerance / tolerance the
+    absolute tolerance rules, so those totals share the lowest band.
+    """
+    abs_cents = max(abs_tolerance * 100, 1.0)
+    if tolerance <= 0:
+        return (np.abs(cents) // abs_cents).astype(np.int64)
+    width = -np.log1p(-min(tolerance, 0.5))
+    return np.floor(np.log(np.maximum(np.abs(cents), abs_cents / tolerance)) / width).astype(np.int64)
+
+
+def _sort_order(groups, bands, seconds):
+    """
+    Order by (group, band, seconds): one argsort of a packed int64 key when the three
+    fit in 63 bits (several times faster than lexsort), lexsort otherwise.
+    """
+    g, b, s = groups - groups.min(), bands - bands.min(), seconds - seconds.min()
+    bits = [int(x.max()).bit_length() for x in (g, b, s)]
+    if sum(bits) > 63:
+        return np.lexsort((seconds, bands, groups))
+    return np.argsort((((g << bits[1]) + b) << bits[2]) + s)
+
+
+def _sweep(partner, a, lo, hi, c, s, tolerance, abs_cents, max_window):
+    """
+    Compares every invoice a with the sorted positions lo..hi-1, one offset at a time,
+    and records the first match of each side in partner. Returns how many invoices had
+    more candidates than max_window.
+    """
+    for k in range(max_window):
+        keep = lo + k < hi
+        a, lo, hi = a[keep], lo[keep], hi[keep]
+        if not len(a):
+            break
+        j = lo + k
+        ca, cj = c[a], c[j]
+        diff = np.abs(cj - ca)
+        match = diff <= np.maximum(abs_cents, tolerance * np.maximum(np.abs(cj), np.abs(ca)))
+        # Same amount and second: an exact triad duplicate, left to the duplicate index
+        exact = match & (diff == 0)
+        match[exact] = s[j[exact]] != s[a[exact]]
+        left, right = a[match], j[match]
+        free = partner[left] < 0
+        partner[left[free]] = right[free]
+        free = partner[right] < 0
+        partner[right[free]] = left[free]
+    return int((hi - lo > max_window).sum())
+
+
+def find_partners(groups, seconds, cents, eligible=None, days=NEAR_DUP_DAYS, tolerance=NEAR_DUP_AMOUNT_TOLERANCE,
+                  abs_tolerance=NEAR_DUP_AMOUNT_ABS, max_window=NEAR_DUP_MAX_WINDOW):
+    """
+    Position of a near-duplicate partner per invoice, -1 for none.
+
+    Invoices are sorted by (group, amount band, fecha_emision). Each one is compared
+    with the later invoices of its band inside the day window (closest first), then
+    with the invoices of the next band up within the window on either side. Every
+    pair is compared, but only the first partner found per invoice is kept, so
+    memory stays O(n) however many pairs a busy group produces.
+    """
+    partner = np.full(len(groups), -1, dtype=np.int64)
+    rows = np.arange(len(groups)) if eligible is None else np.flatnonzero(eligible)
+    if not len(rows):
+        return partner
+    band = amount_bands(cents[rows], tolerance, abs_tolerance)
+    sort = _sort_order(groups[rows], band, seconds[rows])
+    order, b = rows[sort], band[sort]
+    g, s, c = groups[order], seconds[order], cents[order]
+
+    # One sortable key per invoice (rank of its group and band, then seconds), so every
+    # window boundary is one binary search
+    new = np.concatenate([[True], (g[1:] != g[:-1]) | (b[1:] != b[:-1])])
+    rank = np.cumsum(new) - 1
+    offset = np.minimum(s - s.min(), (1 << 32) - 1)
+    t = (rank << 32) + offset
+    window = int(days * 86400)
+    abs_cents = abs_tolerance * 100
+    positions = np.arange(len(order))
+    found = np.full(len(order), -1, dtype=np.int64)
+
+    # Same band: the later invoices of the window
+    end = np.searchsorted(t, t + window, 'right')
+    truncated = _sweep(found, positions, positions + 1, end, c, s, tolerance, abs_cents, max_window)
+
+    # Next band up of the same group, on both sides in time
+    starts = np.flatnonzero(new)
+    adjacent = np.concatenate([(g[starts[1:]] == g[starts[:-1]]) & (b[starts[1:]] == b[starts[:-1]] + 1), [False]])
+    a = positions[adjacent[rank]]
+    next_rank = (rank[a] + 1) << 32
+    lo = np.searchsorted(t, next_rank + np.maximum(offset[a] - window, 0), 'left')
+    hi = np.searchsorted(t, next_rank + np.minimum(offset[a] + window, (1 << 32) - 1), 'right')
+    truncated += _sweep(found, a, lo, hi, c, s, tolerance, abs_cents, 2 * max_window)
+
+    if truncated:
+        logging.warning(f"Near duplicates: {truncated:,} invoices have more than {max_window} similar invoices of the same "
+                        f"emisor and receptor within {days:g} days; the farther ones were not compared (NEAR_DUP_MAX_WINDOW).")
+    paired = found >= 0
+    partner[order[paired]] = order[found[paired]]
+    return partner
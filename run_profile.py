@@ -0,0 +1,165 @@
+"""
+Per-stage profiling for the migration pipeline.
+
+StageTimer records, per named stage: calls, rows, wall seconds, CPU seconds, the
+process RSS high-water mark when the stage ended and, when memory tracing is on,
+the peak memory allocated inside the stage (tracemalloc, which also sees numpy and
+pandas buffers). write_report() dumps a run summary plus those stats as JSON, and
+compare_baseline() flags the stages that got slower (or hungrier) than a stored
+report by more than a tolerance.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import platform
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+MB = 1024 * 1024
+
+
+def rss_peak_mb():
+    """Process RSS high-water mark so far, or None where getrusage is unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (MB if sys.platform == "darwin" else 1024), 1)
+
+
+class StageTimer:
+    """
+    Accumulates rows, wall/CPU time and memory per pipeline stage.
+
+    Stages may nest (the outer stage's memory peak includes the inner ones) and may
+    repeat, e.g. once per chunk: times and rows add up, memory keeps the maximum.
+    trace_memory turns tracemalloc on for the duration of the outermost stage.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.stats = {}
+        self.trace_memory = trace_memory
+        self._open = []
+        self._owns_trace = False
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """Times a block; rows can also be set on the yielded dict once known."""
+        counter = {"rows": rows}
+        frame = self._enter()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield counter
+        finally:
+            seconds, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            peak = self._exit(frame)
+            entry = self.stats.setdefault(name, {"calls": 0, "rows": 0, "seconds": 0.0, "cpu_seconds": 0.0})
+            entry["calls"] += 1
+            entry["rows"] += int(counter["rows"] or 0)
+            entry["seconds"] += seconds
+            entry["cpu_seconds"] += cpu
+            rss = rss_peak_mb()
+            if rss is not None:
+                entry["rss_peak_mb"] = max(entry.get("rss_peak_mb", 0.0), rss)
+            if peak is not None:
+                entry["peak_mb"] = max(entry.get("peak_mb", 0.0), round(peak / MB, 1))
+
+    def _enter(self):
+        if not self.trace_memory:
+            return None
+        if not self._open and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_trace = True
+        if self._open:
+            # Resetting the peak for the inner stage would hide the outer stage's peak so far
+            self._open[-1]["peak"] = max(self._open[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        frame = {"base": current, "peak": current}
+        self._open.append(frame)
+        return frame
+
+    def _exit(self, frame):
+        if frame is None:
+            return None
+        self._open.pop()
+        peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+        if self._open:
+            self._open[-1]["peak"] = max(self._open[-1]["peak"], peak)
+        elif self._owns_trace:
+            tracemalloc.stop()
+            self._owns_trace = False
+        return peak - frame["base"]
+
+    def report(self):
+        for name, entry in self.stats.items():
+            rate = entry["rows"] / entry["seconds"] if entry["seconds"] > 0 else 0
+            memory = f", peak {entry['peak_mb']:,.1f} MB" if "peak_mb" in entry else ""
+            logging.info(f"Stage {name}: {entry['rows']:,} rows in {entry['seconds']:.2f}s ({rate:,.0f} rows/s), "
+                         f"cpu {entry['cpu_seconds']:.2f}s{memory}")
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_report(summary, path):
+    """Writes the run summary (with its stage stats) as JSON, atomically. Returns the report."""
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "rss_peak_mb": rss_peak_mb(),
+        **summary,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f".{os.path.basename(path)}.{uuid.uuid4().hex}")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+    os.replace(tmp, path)
+    return report
+
+
+def load_report(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_baseline(stages, baseline, tolerance=0.25, min_seconds=0.5, min_mb=32.0):
+    """
+    Stages slower than the baseline's by more than tolerance (a fraction) and by at
+    least min_seconds, or whose traced peak memory grew the same way (min_mb).
+    Stages missing from either side are not compared.
+    """
+    regressions = []
+    for name, base in (baseline.get("stages") or {}).items():
+        entry = stages.get(name)
+        if entry is None:
+            continue
+        checks = [("seconds", min_seconds), ("peak_mb", min_mb)]
+        for metric, floor in checks:
+            if metric not in entry or metric not in base:
+                continue
+            current, previous = float(entry[metric]), float(base[metric])
+            if current > previous * (1 + tolerance) and current - previous >= floor:
+                regressions.append({"stage": name, "metric": metric, "baseline": previous, "current": current,
+                                    "ratio": round(current / previous, 2) if previous > 0 else None})
+    return regressions
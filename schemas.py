@@ -0,0 +1,207 @@
+"""
+Column types of the Laravel export tables, declared once for every loader.
+
+Kinds:
+    int       integer ids and counts (int64, nullable Int64 when the column has gaps)
+    category  low-cardinality codes: SAT catalogs, tipo, moneda, estatus...
+    str       free text and unique strings (uuid, RFC, folio, names, paths)
+    money     decimal amounts, may carry '$' or thousands separators
+    float     rates, quantities and exchange rates
+    datetime  Laravel timestamps and dates
+    bool      flags computed by the pipeline (COLLECTIONS only)
+
+Codes such as impuesto '002' or forma_pago '04' are read as text, so the
+leading zeros survive instead of being inferred as numbers.
+Columns not listed here keep pandas' inference.
+
+COLLECTIONS declares the MongoDB collections the dashboard reads back, in the same
+kinds, for mongo_columnar (the API image declares its own in app/core/columnar.py).
+"""
+import pandas as pd
+
+TIMESTAMPS = {'created_at': 'datetime', 'updated_at': 'datetime'}
+
+SCHEMAS = {
+    'cfdis': {
+        'id': 'int', 'company_id': 'int', 'uuid': 'str', 'direccion': 'category', 'tipo': 'category',
+        'serie': 'category', 'folio': 'str', 'fecha_emision': 'datetime', 'version': 'category',
+        'subtotal': 'money', 'descuento': 'money', 'total': 'money', 'moneda': 'category',
+        'tipo_cambio': 'float', 'forma_pago': 'category', 'metodo_pago': 'category',
+        'exportacion': 'category', 'lugar_expedicion': 'category', 'confirmacion': 'str',
+        'emisor_id': 'int', 'receptor_id': 'int', 'receptor_uso_cfdi': 'category',
+        'xml_path': 'str', 'pdf_path': 'str', 'xml_filename': 'str', 'xml_hash': 'str', 'xml_size': 'int',
+        'cancelado': 'category', 'fecha_cancelacion': 'datetime', 'motivo_cancelacion': 'category',
+        'estatus': 'category', 'metadata': 'str', 'deleted_at': 'datetime', 'source': 'category',
+        **TIMESTAMPS,
+    },
+    'cfdi_conceptos': {
+        'id': 'int', 'cfdi_id': 'int', 'clave_prod_serv': 'category', 'no_identificacion': 'str',
+        'cantidad': 'float', 'clave_unidad': 'category', 'unidad': 'category', 'descripcion': 'str',
+        'valor_unitario': 'money', 'importe': 'money', 'descuento': 'money',
+        'objeto_impuesto': 'category', 'metadata': 'str',
+        **TIMESTAMPS,
+    },
+    'cfdi_emisors': {
+        'id': 'int', 'rfc': 'str', 'nombre': 'str', 'regimen_fiscal': 'category', 'curp': 'str',
+        'num_reg_id_trib': 'str', 'residencia_fiscal': 'category', 'metadata': 'str',
+        **TIMESTAMPS,
+    },
+    'cfdi_receptors': {
+        'id': 'int', 'rfc': 'str', 'nombre': 'str', 'domicilio_fiscal_cp': 'str',
+        'regimen_fiscal': 'category', 'curp': 'str', 'num_reg_id_trib': 'str',
+        'residencia_fiscal': 'category', 'uso_cfdi_preferido': 'category', 'metadata': 'str',
+        **TIMESTAMPS,
+    },
+    'cfdi_comprobante_impuestos': {
+        'id': 'int', 'cfdi_id': 'int',
+        'total_impuestos_trasladados': 'money', 'total_impuestos_retenidos': 'money',
+        **TIMESTAMPS,
+    },
+    'cfdi_comprobante_traslados': {
+        'id': 'int', 'cfdi_comprobante_impuestos_id': 'int', 'impuesto': 'category',
+        'tipo_factor': 'category', 'tasa_o_cuota': 'float', 'base': 'money', 'importe': 'money',
+        **TIMESTAMPS,
+    },
+    'cfdi_comprobante_retenciones': {
+        'id': 'int', 'cfdi_comprobante_impuestos_id': 'int', 'impuesto': 'category', 'importe': 'money',
+        **TIMESTAMPS,
+    },
+    'cfdi_concepto_impuestos': {
+        'id': 'int', 'cfdi_concepto_id': 'int',
+        **TIMESTAMPS,
+    },
+    'cfdi_concepto_traslados': {
+        'id': 'int', 'cfdi_concepto_impuestos_id': 'int', 'base': 'money', 'impuesto': 'category',
+        'tipo_factor': 'category', 'tasa_o_cuota': 'float', 'importe': 'money',
+        **TIMESTAMPS,
+    },
+    'cfdi_concepto_retenciones': {
+        'id': 'int', 'cfdi_concepto_impuestos_id': 'int', 'base': 'money', 'impuesto': 'category',
+        'tipo_factor': 'category', 'tasa_o_cuota': 'float', 'importe': 'money',
+        **TIMESTAMPS,
+    },
+    'cfdi_relacionados': {
+        'id': 'int', 'cfdi_id': 'int', 'tipo_relacion': 'category', 'uuid_relacionado': 'str',
+        'cfdi_relacionado_id': 'int',
+        **TIMESTAMPS,
+    },
+    'cfdi_pagos': {
+        'id': 'int', 'cfdi_id': 'int', 'version': 'category',
+        **TIMESTAMPS,
+    },
+    'cfdi_pago_detalles': {
+        'id': 'int', 'cfdi_pago_id': 'int', 'fecha_pago': 'datetime', 'forma_pago_p': 'category',
+        'moneda_p': 'category', 'tipo_cambio_p': 'float', 'monto': 'money', 'num_operacion': 'str',
+        'rfc_emisor_cta_ord': 'str', 'nom_banco_ord_ext': 'str', 'cta_ordenante': 'str',
+        'rfc_emisor_cta_ben': 'str', 'cta_beneficiario': 'str', 'tipo_cad_pago': 'category',
+        'cert_pago': 'str', 'cad_pago': 'str', 'sello_pago': 'str',
+        **TIMESTAMPS,
+    },
+    'cfdi_pago_documentos_relacionados': {
+        'id': 'int', 'cfdi_pago_detalle_id': 'int', 'id_documento': 'str', 'cfdi_relacionado_id': 'int',
+        'serie': 'category', 'folio': 'str', 'moneda_dr': 'category', 'equivalencia_dr': 'float',
+        'num_parcialidad': 'int', 'imp_saldo_ant': 'money', 'imp_pagado': 'money',
+        'imp_saldo_insoluto': 'money', 'objeto_imp_dr': 'category',
+        **TIMESTAMPS,
+    },
+    'cfdi_pago_dr_impuestos': {
+        'id': 'int', 'cfdi_pago_documento_relacionado_id': 'int', 'base_dr': 'money',
+        'impuesto_dr': 'category', 'tipo_factor_dr': 'category', 'tasa_o_cuota_dr': 'float',
+        'importe_dr': 'money', 'tipo': 'category',
+        **TIMESTAMPS,
+    },
+    'cfdi_pago_totales': {
+        'id': 'int', 'cfdi_pago_id': 'int',
+        'total_retenciones_iva': 'money', 'total_retenciones_isr': 'money', 'total_retenciones_ieps': 'money',
+        'total_traslados_base_iva16': 'money', 'total_traslados_impuesto_iva16': 'money',
+        'total_traslados_base_iva8': 'money', 'total_traslados_impuesto_iva8': 'money',
+        'total_traslados_base_iva0': 'money', 'total_traslados_impuesto_iva0': 'money',
+        'total_traslados_base_iva_exento': 'money', 'monto_total_pagos': 'money',
+        **TIMESTAMPS,
+    },
+}
+
+# Gold columns the pipeline adds to cfdis (tax_engine, catalog joins, REP, forensics, gold_derived)
+GOLD_COLUMNS = {
+    'company_id': 'str', 'month_year': 'str', 'fecha_dt': 'datetime',
+    'calc_traslados': 'money', 'calc_iva': 'money', 'calc_ieps': 'money', 'calc_retenciones': 'money',
+    'calc_ret_isr': 'money', 'calc_ret_iva': 'money',
+    'conceptos_calc_traslados': 'money', 'conceptos_calc_iva': 'money', 'conceptos_calc_ieps': 'money',
+    'conceptos_calc_retenciones': 'money', 'conceptos_calc_ret_isr': 'money', 'conceptos_calc_ret_iva': 'money',
+    'rep_pagado': 'money', 'rep_iva_pagado': 'money', 'rep_saldo_insoluto': 'money', 'rep_parcialidades': 'float',
+    'rep_ultimo_pago': 'datetime',
+    'id_rec': 'int', 'receptor_nombre': 'str', 'receptor_rfc': 'str',
+    'id_emi': 'int', 'emisor_nombre': 'str', 'emisor_rfc': 'str',
+    'ventas_brutas': 'money', 'ventas_netas': 'money',
+    'year': 'int', 'week': 'str', 'ventas_netas_calc': 'money',
+    'is_duplicate': 'bool', 'near_duplicate': 'bool', 'near_duplicate_of': 'str',
+}
+
+COLLECTIONS = {
+    'gold_cfdi': {**SCHEMAS['cfdis'], **GOLD_COLUMNS},
+    # fiscal_reports database; company_id is left to inference (numeric only when the tenant id is)
+    'matriz_resumen': {'periodo': 'str', 'segmento': 'str', 'concepto': 'str', 'monto': 'money', 'orden': 'int',
+                       'total': 'money', 'tipo_comprobante': 'str'},
+    'dim_tiempo': {
+        'periodo': 'str', 'anio': 'int', 'mes': 'int', 'nombre_mes_es': 'str', 'trimestre': 'int', 'semestre': 'int',
+        'dias_mes': 'int', 'fecha_inicio': 'str', 'fecha_fin': 'str',
+    },
+}
+
+
+def table_name(filename):
+    """'cfdis.csv' -> 'cfdis'."""
+    return filename[:-4] if filename.endswith('.csv') else filename
+
+
+def schema_for(table):
+    return SCHEMAS.get(table_name(table), {})
+
+
+def csv_dtypes(table):
+    """dtype= argument for read_csv: text and category columns are never inferred."""
+    return {col: ('category' if kind == 'category' else str)
+            for col, kind in schema_for(table).items() if kind in ('category', 'str')}
+
+
+def parse_money(series):
+    """Money column to float64; only text columns pay for the '$' / ',' cleanup."""
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype('float64')
+    return pd.to_numeric(series.astype(str).str.replace(r'[$,]', '', regex=True), errors='coerce')
+
+
+def parse_int(series):
+    values = pd.to_numeric(series, errors='coerce')
+    return values.astype('int64') if not values.isna().any() else values.astype('Int64')
+
+
+def apply_schema(df, table):
+    """Casts the numeric and datetime columns of a loaded frame (or chunk) to their declared types."""
+    for col, kind in schema_for(table).items():
+        if col not in df.columns:
+            continue
+        if kind == 'money':
+            df[col] = parse_money(df[col])
+        elif kind == 'float':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+        elif kind == 'int':
+            df[col] = parse_int(df[col])
+        elif kind == 'datetime' and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors='coerce', format='ISO8601')
+    return df
+
+
+def read_export(path, table, encoding='utf-8', **kwargs):
+    """read_csv with the registry types applied. Not for chunksize=, use apply_schema per chunk."""
+    df = pd.read_csv(path, encoding=encoding, dtype=csv_dtypes(table), **kwargs)
+    return apply_schema(df, table)
+
+
+def normalize_text(series):
+    """Lower-cased, stripped text; categoricals are normalized on their categories only."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories.astype(str).str.lower().str.strip()
+        return series.cat.rename_categories(categories) if categories.is_unique \
+            else series.astype(str).str.lower().str.strip().astype('category')
+    return series.astype(str).str.lower().str.strip()
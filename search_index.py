@@ -0,0 +1,234 @@
+"""
+Substring search over the invoice identity fields (the audit "FILTRO GLOBAL FORENSE").
+
+Built once per tenant data version (for_frame) instead of lowercasing six columns
+and running a regex contains over them on every keystroke:
+
+- values are lowercased and accent-folded ('Ñ' -> 'n', 'é' -> 'e'), and so is the term;
+- the vocabulary is the distinct folded values of all the fields, each row keeps one
+  integer code per field into it (names and RFCs repeat a lot, so the vocabulary is
+  mostly the uuids and folios);
+- every vocabulary value is split into trigrams, stored as sorted postings
+  (trigram -> sorted value ids) in flat numpy arrays.
+
+A term of 3+ characters intersects the postings of its trigrams, smallest first, and
+checks the surviving values with a plain substring test (a trigram match does not
+imply the substring). Shorter terms scan the vocabulary. Matching values become rows
+through the per-field codes.
+
+Prefix fields: a term shaped like the start of an RFC (3-4 letters and a digit) or of
+a UUID (8+ hex digits with a dash or a letter, so numeric folios are not UUIDs) only
+matches the RFC / uuid fields at the start of their values. The other fields (names,
+folios) are still searched by substring.
+"""
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+SEARCH_FIELDS = ['emisor_rfc', 'emisor_nombre', 'receptor_rfc', 'receptor_nombre', 'folio', 'uuid']
+RFC_FIELDS = ['emisor_rfc', 'receptor_rfc']
+UUID_FIELDS = ['uuid']
+SEARCH_INDEX_ENTRIES = int(os.getenv("SEARCH_INDEX_ENTRIES", 4))
+
+RFC_PREFIX = re.compile(r'^[a-z&]{3,4}(\d{1,5}|\d{6}[a-z0-9]{0,3})$')
+UUID_PREFIX = re.compile(r'^[0-9a-f]{8}(-[0-9a-f]{0,4}(-[0-9a-f]{0,4}(-[0-9a-f]{0,4}(-[0-9a-f]{0,12})?)?)?)?$')
+UUID_HEX_LETTER = re.compile(r'[a-f-]')
+# Trigram keys use dense ranks of the characters present, so (key, value id) packs into one int64
+UNICODE_SIZE = 0x110000
+BUILD_CHUNK = int(os.getenv("SEARCH_INDEX_BUILD_CHUNK", 500000))
+
+
+def fold_text(text):
+    """Lowercased and accent-folded ('Ñúñez' -> 'nunez')."""
+    text = text.lower()
+    if text.isascii():
+        return text
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+
+def fold(values):
+    """fold_text of every (non-missing) value."""
+    return [fold_text(str(v)) for v in values]
+
+
+def fold_term(term):
+    return fold_text(str(term)).strip()
+
+
+def codepoints(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+class SearchIndex:
+    """Trigram postings over the distinct folded values of SEARCH_FIELDS, with row codes per field."""
+
+    def __init__(self, df, fields=SEARCH_FIELDS):
+        self.n_rows = len(df)
+        self.fields = [f for f in fields if f in df.columns]
+
+        # Distinct raw values per field (missing ones excluded), folded once, then one
+        # vocabulary for all fields
+        field_codes, folded = {}, []
+        offset = 0
+        for field in self.fields:
+            codes, uniques = pd.factorize(df[field])
+            field_codes[field] = (codes, offset)
+            folded.extend(fold(uniques))
+            offset += len(uniques)
+        value_ids, vocab = pd.factorize(np.asarray(folded, dtype=object))
+        self.vocab = np.asarray(vocab, dtype=object)
+        # Per field: the vocabulary id of each row, len(vocab) for missing values
+        self.codes = {}
+        for field, (codes, offset) in field_codes.items():
+            ids = np.full(len(codes), len(self.vocab), dtype=np.int32)
+            present = codes >= 0
+            ids[present] = value_ids[offset + codes[present]]
+            self.codes[field] = ids
+
+        self._build_postings()
+
+    def _chunks(self):
+        for lo in range(0, len(self.vocab), BUILD_CHUNK):
+            values = self.vocab[lo:lo + BUILD_CHUNK]
+            lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+            yield lo, lengths, codepoints(''.join(values))
+
+    def _trigrams(self, ranks):
+        ranks = ranks.astype(np.int64)
+        width = len(self.alphabet)
+        return (ranks[:-2] * width + ranks[1:-1]) * width + ranks[2:]
+
+    def _build_postings(self):
+        present = np.zeros(UNICODE_SIZE, dtype=bool)
+        for _, _, points in self._chunks():
+            present[points] = True
+        self.alphabet = np.flatnonzero(present)
+        rank_of = np.cumsum(present, dtype=np.int32) - 1
+        n_values = max(len(self.vocab), 1)
+
+        # (trigram key, value id) pairs packed as key * n_values + id: one sort orders
+        # them by trigram then value, and equal neighbours are repeats within a value
+        packed = []
+        for lo, lengths, points in self._chunks():
+            if len(points) < 3:
+                continue
+            owner = np.repeat(np.arange(lo, lo + len(lengths), dtype=np.int64), lengths)
+            # A trigram belongs to a value when its three characters do
+            inside = owner[:-2] == owner[2:]
+            packed.append(self._trigrams(rank_of[points])[inside] * n_values + owner[:-2][inside])
+        packed = np.concatenate(packed) if packed else np.array([], dtype=np.int64)
+        packed.sort()
+        if len(packed):
+            packed = packed[np.r_[True, packed[1:] != packed[:-1]]]
+        self.postings = (packed % n_values).astype(np.int32)
+        np.floor_divide(packed, n_values, out=packed)
+        new_key = np.flatnonzero(np.r_[True, packed[1:] != packed[:-1]]) if len(packed) else np.array([], dtype=np.int64)
+        self.keys = packed[new_key]
+        self.starts = np.r_[new_key, len(packed)]
+
+    def term_trigrams(self, term):
+        """Distinct trigram keys of a folded term (None when it has a character no value has)."""
+        points = codepoints(term)
+        ranks = np.searchsorted(self.alphabet, points)
+        if (ranks >= len(self.alphabet)).any() or (self.alphabet[ranks.clip(max=len(self.alphabet) - 1)] != points).any():
+            return None
+        return np.unique(self._trigrams(ranks))
+
+    @property
+    def nbytes(self):
+        return (self.keys.nbytes + self.starts.nbytes + self.postings.nbytes + self.vocab.nbytes
+                + self.alphabet.nbytes + sum(codes.nbytes for codes in self.codes.values()))
+
+    def _posting(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self.postings[self.starts[i]:self.starts[i + 1]]
+
+    def matching_values(self, term):
+        """Vocabulary ids of the values containing the folded term."""
+        if len(term) < 3:
+            return np.flatnonzero(np.fromiter((term in v for v in self.vocab), dtype=bool, count=len(self.vocab)))
+        keys = self.term_trigrams(term)
+        if keys is None:
+            return np.array([], dtype=np.int32)
+        lists = []
+        for key in keys:
+            posting = self._posting(key)
+            if posting is None:
+                return np.array([], dtype=np.int32)
+            lists.append(posting)
+        lists.sort(key=len)
+        candidates = lists[0]
+        for posting in lists[1:]:
+            if not len(candidates):
+                break
+            at = np.searchsorted(posting, candidates).clip(max=len(posting) - 1)
+            candidates = candidates[posting[at] == candidates]
+        return np.array([i for i in candidates if term in self.vocab[i]], dtype=np.int32)
+
+    def _rows(self, value_ids, fields):
+        # One slot per vocabulary value plus a last, always False, slot for missing values
+        wanted = np.zeros(len(self.vocab) + 1, dtype=bool)
+        wanted[value_ids] = True
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for field in fields:
+            mask |= wanted[self.codes[field]]
+        return mask
+
+    def prefix_fields(self, term):
+        """The fields a term is matched against by prefix only (None: substring search on all of them)."""
+        if RFC_PREFIX.match(term):
+            fields = [f for f in RFC_FIELDS if f in self.codes]
+        elif UUID_PREFIX.match(term) and UUID_HEX_LETTER.search(term):
+            fields = [f for f in UUID_FIELDS if f in self.codes]
+        else:
+            return None
+        return fields or None
+
+    def search_mask(self, term):
+        """Boolean mask over the frame's rows matching term (all True for an empty term)."""
+        term = fold_term(term)
+        if not term:
+            return np.ones(self.n_rows, dtype=bool)
+        value_ids = self.matching_values(term)
+        prefix_fields = self.prefix_fields(term)
+        if prefix_fields is None:
+            return self._rows(value_ids, self.fields)
+        # The substring matches include the prefix ones: one postings lookup serves both
+        starting = value_ids[np.fromiter((self.vocab[i].startswith(term) for i in value_ids), dtype=bool, count=len(value_ids))]
+        others = [f for f in self.fields if f not in prefix_fields]
+        return self._rows(starting, prefix_fields) | self._rows(value_ids, others)
+
+    def search(self, term):
+        """Row positions (ascending) of the frame's rows matching term."""
+        return np.flatnonzero(self.search_mask(term))
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def for_frame(df):
+    """
+    The SearchIndex of a frame, kept for the last SEARCH_INDEX_ENTRIES data versions
+    (df.attrs['data_version'], set by app.load_enriched). Unversioned frames are not kept.
+    """
+    version = df.attrs.get('data_version')
+    if version is not None:
+        with _lock:
+            if version in _indexes:
+                _indexes.move_to_end(version)
+                return _indexes[version]
+    index = SearchIndex(df)
+    if version is not None:
+        with _lock:
+            _indexes[version] = index
+            while len(_indexes) > SEARCH_INDEX_ENTRIES:
+                _indexes.popitem(last=False)
+    return index
@@ -0,0 +1,194 @@
+"""
+Content-addressed cache for the batch pipeline stages.
+
+A stage declares the export files it reads, its parameters and the upstream stages
+it consumes. Its key hashes the content of those files, the parameters, the upstream
+keys and the pipeline source, so editing one CSV only invalidates the stages
+downstream of it. Outputs are pickled under <DATA_DIR>/.stage_cache/<stage>/<key>.pkl.
+
+Stages are resolved lazily from the one that is asked for: when its key is cached
+nothing upstream is loaded or computed at all.
+"""
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import logging
+from contextlib import nullcontext
+
+CACHE_DIRNAME = ".stage_cache"
+DIGESTS_FILE = "digests.json"
+STAGE_CACHE_KEEP = int(os.getenv("STAGE_CACHE_KEEP", 1))
+HASH_BLOCK = 1024 * 1024
+
+
+def digest(value):
+    payload = json.dumps(value, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def file_content_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def output_rows(output):
+    """Rows of a frame output, or of the first frame of a tuple output, for the stage timer."""
+    if isinstance(output, tuple):
+        output = next((o for o in output if hasattr(o, 'columns')), None)
+    return len(output) if hasattr(output, 'columns') else 0
+
+
+class StageCache:
+    """Pickled stage outputs keyed by content hash, one directory per stage."""
+
+    def __init__(self, data_dir, enabled=True, code_files=()):
+        self.data_dir = data_dir
+        self.root = os.path.join(data_dir, CACHE_DIRNAME)
+        self.enabled = enabled
+        self._digests = self._load_digests() if enabled else {}
+        self.code_version = digest([file_content_digest(p) for p in code_files])
+
+    def _load_digests(self):
+        try:
+            with open(os.path.join(self.root, DIGESTS_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def file_digest(self, filename):
+        """Content hash of an export; only re-read when its size or mtime changed."""
+        path = os.path.join(self.data_dir, filename)
+        if not os.path.exists(path):
+            return "missing"
+        st = os.stat(path)
+        known = self._digests.get(filename)
+        if known and known["size"] == st.st_size and known["mtime_ns"] == st.st_mtime_ns:
+            return known["digest"]
+        value = file_content_digest(path)
+        self._digests[filename] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digest": value}
+        if self.enabled:
+            self._write_json(DIGESTS_FILE, self._digests)
+        return value
+
+    def _write_json(self, name, value):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, f".{name}.{uuid.uuid4().hex}")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp, os.path.join(self.root, name))
+
+    def _path(self, stage, key, suffix=".pkl"):
+        return os.path.join(self.root, stage, f"{key}{suffix}")
+
+    def has(self, stage, key):
+        return self.enabled and os.path.exists(self._path(stage, key))
+
+    def load(self, stage, key):
+        """(True, output) on a hit, (False, None) otherwise. Unreadable entries count as misses."""
+        if not self.enabled:
+            return False, None
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return False, None
+        try:
+            with open(path, 'rb') as f:
+                return True, pickle.load(f)
+        except Exception as e:
+            logging.warning(f"Stage cache: dropping unreadable entry {path}: {e}")
+            os.remove(path)
+            return False, None
+
+    def store(self, stage, key, value):
+        if not self.enabled:
+            return
+        path = self._path(stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self._prune(stage, keep=path)
+
+    def _prune(self, stage, keep):
+        """Keeps the newest STAGE_CACHE_KEEP entries of a stage."""
+        directory = os.path.join(self.root, stage)
+        entries = [os.path.join(directory, n) for n in os.listdir(directory) if not n.endswith(".tmp")]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in [e for e in entries if e != keep][max(0, STAGE_CACHE_KEEP - 1):]:
+            os.remove(path)
+
+    def is_marked(self, stage, key):
+        return self.enabled and os.path.exists(self._path(stage, key, ".done"))
+
+    def mark(self, stage, key):
+        """Records a side-effect stage (e.g. the gold load) as done for this key."""
+        if not self.enabled:
+            return
+        path = self._path(stage, key, ".done")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        self._prune(stage, keep=path)
+
+
+class StageGraph:
+    """
+    Named pipeline stages with declared inputs, evaluated through a StageCache.
+
+    fn receives the outputs of deps, in order. persist=False stages still get a key
+    (so downstream keys stay content-addressed) but are cheap enough to recompute.
+    Stage outputs are shared between dependents: stages must not mutate their inputs.
+    """
+
+    def __init__(self, cache, timer=None):
+        self.cache = cache
+        self.timer = timer
+        self.stages = {}
+        self._keys = {}
+        self._outputs = {}
+
+    def add(self, name, fn, files=(), params=None, deps=(), persist=True):
+        self.stages[name] = {"fn": fn, "files": list(files), "params": params or {}, "deps": list(deps), "persist": persist}
+
+    def key(self, name):
+        if name not in self._keys:
+            stage = self.stages[name]
+            self._keys[name] = digest({
+                "stage": name,
+                "code": self.cache.code_version,
+                "params": stage["params"],
+                "files": {f: self.cache.file_digest(f) for f in stage["files"]},
+                "deps": [self.key(d) for d in stage["deps"]],
+            })
+        return self._keys[name]
+
+    def get(self, name):
+        """The stage output: memoized, else from the cache, else computed (resolving its deps)."""
+        if name in self._outputs:
+            return self._outputs[name]
+        stage = self.stages[name]
+        key = self.key(name)
+
+        if stage["persist"] and self.cache.has(name, key):
+            with self.timer.stage(f"{name} (cached)") if self.timer else nullcontext() as st:
+                hit, output = self.cache.load(name, key)
+                if st is not None:
+                    st["rows"] = output_rows(output)
+            if hit:
+                self._outputs[name] = output
+                return output
+
+        inputs = [self.get(d) for d in stage["deps"]]
+        with self.timer.stage(name) if self.timer else nullcontext() as st:
+            output = stage["fn"](*inputs)
+            if st is not None:
+                st["rows"] = output_rows(output)
+        if stage["persist"]:
+            self.cache.store(name, key, output)
+        self._outputs[name] = output
+        return output
+
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+# SAT impuesto codes (c_Impuesto). Older exports may carry the names instead.
+ISR, IVA, IEPS = 1, 2, 3
+IMPUESTO_NAMES = {'ISR': ISR, 'IVA': IVA, 'IEPS': IEPS}
+
+KINDS = ['traslado', 'retencion']
+SLOTS_PER_KIND = 4  # 0 = other code, 1 = ISR, 2 = IVA, 3 = IEPS
+
+# Output column -> (kind, impuesto code); None sums every code of that kind
+TAX_COLUMNS = {
+    'calc_traslados': ('traslado', None),
+    'calc_iva': ('traslado', IVA),
+    'calc_ieps': ('traslado', IEPS),
+    'calc_retenciones': ('retencion', None),
+    'calc_ret_isr': ('retencion', ISR),
+    'calc_ret_iva': ('retencion', IVA),
+}
+
+# Rate / factor columns per tax: <prefix>_<name> -> (kind, impuesto code)
+RATE_TAXES = {
+    'iva': ('traslado', IVA),
+    'ieps': ('traslado', IEPS),
+    'ret_isr': ('retencion', ISR),
+    'ret_iva': ('retencion', IVA),
+}
+RATE_COLUMNS = [f'{prefix}_{name}' for name in RATE_TAXES for prefix in ('tasa', 'tipo_factor')]
+
+
+def impuesto_codes(series):
+    """
+    Normalizes the impuesto column to its numeric code (1 ISR, 2 IVA, 3 IEPS, 0 other).
+    Handles '002', 2, 2.0 and 'IVA' alike. Only the distinct values are parsed.
+    """
+    positions, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        return np.zeros(len(series), dtype=np.int8)
+    codes = pd.to_numeric(pd.Series(uniques), errors='coerce')
+    names = pd.Series(uniques).astype(str).str.strip().str.upper().map(IMPUESTO_NAMES)
+    codes = codes.fillna(names).fillna(0)
+    codes = codes.where(codes.isin([ISR, IVA, IEPS]), 0).to_numpy(np.int8)
+    # NaN impuestos factorize to -1 and land in the "other" slot
+    return np.where(positions >= 0, codes[positions], 0).astype(np.int8)
+
+
+def tax_rows(impuestos, traslados=None, retenciones=None, parent_col='cfdi_comprobante_impuestos_id',
+             owner='cfdi_id', rates=False):
+    """
+    Long table (owner, slot, importe) with every traslado and retención row.
+
+    impuestos is the parent impuestos table or an id -> owner Series: the comprobante
+    impuestos (owner cfdi_id) or the concepto impuestos (owner cfdi_concepto_id,
+    parent_col cfdi_concepto_impuestos_id). importe must already be numeric.
+    rates=True also carries tasa_o_cuota and tipo_factor for rate_columns().
+    """
+    if isinstance(impuestos, pd.DataFrame):
+        impuestos = impuestos.set_index('id')[owner]
+    impuesto_ids = impuestos.index
+    impuesto_owners = impuestos.to_numpy()
+
+    parts = []
+    for kind_idx, rows in enumerate([traslados, retenciones]):
+        if rows is None or rows.empty:
+            continue
+        # Positional lookup instead of a merge: rows without a parent impuesto are dropped
+        pos = impuesto_ids.get_indexer(rows[parent_col])
+        found = pos >= 0
+        part = pd.DataFrame({
+            owner: impuesto_owners[pos[found]].astype(np.int64),
+            'slot': (kind_idx * SLOTS_PER_KIND + impuesto_codes(rows['impuesto'])[found]).astype(np.int8),
+            # Null importes count as 0, as the groupby().sum() this replaced skipped them
+            'importe': rows['importe'].fillna(0).to_numpy(np.float64)[found],
+        })
+        if rates:
+            part['tasa_o_cuota'] = rows['tasa_o_cuota'].to_numpy(np.float64)[found] if 'tasa_o_cuota' in rows else np.nan
+            part['tipo_factor'] = rows['tipo_factor'].astype(object).to_numpy()[found] if 'tipo_factor' in rows else None
+        parts.append(part)
+
+    if not parts:
+        empty = {owner: pd.Series(dtype='int64'), 'slot': pd.Series(dtype='int8'), 'importe': pd.Series(dtype='float64')}
+        if rates:
+            empty.update({'tasa_o_cuota': pd.Series(dtype='float64'), 'tipo_factor': pd.Series(dtype=object)})
+        return pd.DataFrame(empty)
+    return pd.concat(parts, ignore_index=True)
+
+
+def tax_totals(rows, owner='cfdi_id'):
+    """Every calc_* column per owner from one pivot over (owner, kind, impuesto)."""
+    n_slots = len(KINDS) * SLOTS_PER_KIND
+    cfdi_pos, cfdi_ids = pd.factorize(rows[owner])
+    # Pivot as a flat weighted bincount over (cfdi position, slot) cells
+    cells = cfdi_pos.astype(np.int64) * n_slots + rows['slot'].to_numpy(np.int64)
+    matrix = np.bincount(cells, weights=rows['importe'].to_numpy(np.float64), minlength=len(cfdi_ids) * n_slots)
+    matrix = matrix.reshape(len(cfdi_ids), n_slots)
+
+    totals = {}
+    for col, (kind, code) in TAX_COLUMNS.items():
+        base = KINDS.index(kind) * SLOTS_PER_KIND
+        if code is None:
+            totals[col] = matrix[:, base:base + SLOTS_PER_KIND].sum(axis=1)
+        else:
+            totals[col] = matrix[:, base + code]
+    return pd.DataFrame(totals, index=pd.Index(cfdi_ids, name=owner))
+
+
+def rate_columns(rows, owner='cfdi_id'):
+    """
+    tasa_* / tipo_factor_* per owner for IVA, IEPS and the ISR/IVA retentions,
+    from tax_rows(..., rates=True). The first row of each tax wins.
+    """
+    firsts = rows.drop_duplicates([owner, 'slot'])
+    index = pd.Index(pd.unique(rows[owner]), name=owner)
+    rates = pd.DataFrame(index=index)
+    for name, (kind, code) in RATE_TAXES.items():
+        sel = firsts[firsts['slot'] == KINDS.index(kind) * SLOTS_PER_KIND + code].set_index(owner)
+        rates[f'tasa_{name}'] = sel['tasa_o_cuota'].reindex(index)
+        rates[f'tipo_factor_{name}'] = sel['tipo_factor'].reindex(index)
+    return rates
+
+
+def combine_totals(parts):
+    """Adds up partial tax_totals() frames, e.g. one per chunk."""
+    parts = [p for p in parts if not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=list(TAX_COLUMNS), dtype='float64')
+    if len(parts) == 1:
+        return parts[0]
+    return pd.concat(parts).groupby(level=0).sum()
+
+
+def join_tax_totals(cfdis, totals, on='id', columns=None):
+    """Joins the tax totals into the CFDI frame with one positional lookup. Missing CFDIs get 0."""
+    columns = list(TAX_COLUMNS) if columns is None else list(columns)
+    stale = [c for c in columns if c in cfdis.columns]
+    if stale:
+        cfdis = cfdis.drop(columns=stale)
+    if totals.empty:
+        for col in columns:
+            cfdis[col] = 0.0
+        return cfdis
+    pos = totals.index.get_indexer(cfdis[on])
+    values = totals[columns].to_numpy()[pos]
+    values[pos < 0] = 0.0
+    for i, col in enumerate(columns):
+        cfdis[col] = values[:, i]
+    return cfdis
+
+
+def aggregate_taxes(cfdis, impuestos, traslados=None, retenciones=None):
+    """Adds the calc_* traslado/retención totals per CFDI in a single pass."""
+    if impuestos is None:
+        return join_tax_totals(cfdis, pd.DataFrame())
+    return join_tax_totals(cfdis, tax_totals(tax_rows(impuestos, traslados, retenciones)))
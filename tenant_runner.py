@@ -0,0 +1,176 @@
+"""
+Runs the migration pipeline for several tenants in parallel.
+
+Each tenant gets its own worker process and its own Laravel export directory.
+A failing tenant is logged and reported, and the others keep running. MongoDB
+writes are gated by a shared semaphore, so only a bounded number of workers
+write to the cluster at the same time. Once every tenant has run, the alert rules
+are evaluated over all the stored monthly rollups in one pass (see alert_rules).
+
+Usage:
+    python tenant_runner.py --tenants tenants.json --workers 4 --mongo-writers 2
+    python tenant_runner.py --root /exports          # one subdirectory per company_id
+
+tenants.json: [{"company_id": "ACME", "data_dir": "/exports/acme"}, ...]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+import migration
+import alert_rules
+import alert_dispatcher
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+
+DEFAULT_WORKERS = int(os.getenv("TENANT_WORKERS", os.cpu_count() or 1))
+DEFAULT_MONGO_WRITERS = int(os.getenv("TENANT_MONGO_WRITERS", 2))
+
+# Set in every worker process by init_worker()
+_write_slots = None
+
+
+def load_tenants(tenants_file=None, root=None):
+    """Tenant list as [{'company_id', 'data_dir'}], from a JSON file or the subdirectories of root."""
+    tenants = []
+    if tenants_file:
+        with open(tenants_file, 'r', encoding='utf-8') as f:
+            tenants = json.load(f)
+    elif root:
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isfile(os.path.join(path, "cfdis.csv")):
+                tenants.append({"company_id": name, "data_dir": path})
+
+    seen = set()
+    for tenant in tenants:
+        if not tenant.get("company_id") or not tenant.get("data_dir"):
+            raise ValueError(f"Tenant entry needs company_id and data_dir: {tenant}")
+        if tenant["company_id"] in seen:
+            raise ValueError(f"Duplicate company_id in tenant list: {tenant['company_id']}")
+        seen.add(tenant["company_id"])
+    return tenants
+
+
+def init_worker(write_slots):
+    global _write_slots
+    _write_slots = write_slots
+
+
+def run_tenant(tenant, full=False, chunksize=None):
+    """Worker entry point: runs one tenant and never raises, failures come back in the summary."""
+    start = time.perf_counter()
+    company_id = tenant["company_id"]
+    # Module globals are per process, so pointing DATA_DIR at this tenant is safe here
+    migration.DATA_DIR = tenant["data_dir"]
+    try:
+        summary = migration.main(full=full, chunksize=chunksize, company_id=company_id, write_slots=_write_slots,
+                                 evaluate_alerts=False)
+        if summary is None:
+            summary = {"company_id": company_id, "status": "failed", "error": "cfdis.csv missing"}
+        else:
+            summary["status"] = "ok" if summary["loaded"] and not summary["regressions"] else "failed"
+            if not summary["loaded"]:
+                summary["error"] = "gold load failed"
+            elif summary["regressions"]:
+                summary["error"] = "stage regression: " + ", ".join(r["stage"] for r in summary["regressions"])
+    except Exception as e:
+        logging.error(f"Tenant {company_id} failed: {e}")
+        summary = {"company_id": company_id, "status": "failed", "error": str(e), "traceback": traceback.format_exc()}
+    summary["seconds"] = time.perf_counter() - start
+    # Worker processes exit without atexit hooks: hand the tenant's alerts to SMTP now
+    alert_dispatcher.close()
+    return summary
+
+
+def run_all(tenants, workers=DEFAULT_WORKERS, mongo_writers=DEFAULT_MONGO_WRITERS, full=False, chunksize=None):
+    """Runs every tenant on a process pool and returns one summary per tenant, in input order."""
+    write_slots = multiprocessing.BoundedSemaphore(max(1, mongo_writers))
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=init_worker, initargs=(write_slots,)) as pool:
+        futures = {pool.submit(run_tenant, t, full, chunksize): t["company_id"] for t in tenants}
+        for future in as_completed(futures):
+            company_id = futures[future]
+            try:
+                results[company_id] = future.result()
+            except BrokenProcessPool as e:
+                # A worker died hard (OOM kill, segfault); the pool can't be reused for this tenant
+                results[company_id] = {"company_id": company_id, "status": "failed", "error": f"worker crashed: {e}"}
+            logging.info(f"Tenant {company_id}: {results[company_id]['status']}")
+    return [results[t["company_id"]] for t in tenants]
+
+
+def evaluate_alert_rules(tenants):
+    """
+    Evaluates the alert rules over every tenant's stored monthly rollup at once and
+    queues each tenant's fired alerts (one digest per recipient). Returns the number
+    of alerts queued.
+    """
+    if migration.MONGO_URI:
+        rollups = alert_rules.read_rollups(migration.rollup_db(), [t["company_id"] for t in tenants])
+    else:
+        rollups = pd.concat([alert_rules.read_rollup(t["company_id"], data_dir=t["data_dir"]) for t in tenants], ignore_index=True)
+    fired = migration.rule_alerts(rollups)
+    for company_id, (messages, chart_to_send) in fired.items():
+        migration.dispatch_alerts(messages, chart_to_send, company_id)
+    logging.info(f"Alert rules evaluated for {len(tenants)} tenants: {len(fired)} with alerts")
+    return sum(len(messages) for messages, _ in fired.values())
+
+
+def print_summary(results, wall_seconds):
+    print(f"\n{'company_id':<24} {'status':<8} {'mode':<12} {'read':>10} {'written':>10} {'seconds':>9}")
+    for r in results:
+        print(f"{r['company_id']:<24} {r['status']:<8} {r.get('mode', '-'):<12} "
+              f"{r.get('rows_read', 0):>10,} {r.get('rows_written', 0):>10,} {r.get('seconds', 0):>9.2f}")
+    failed = [r for r in results if r["status"] != "ok"]
+    total_written = sum(r.get("rows_written", 0) for r in results)
+    print(f"\n{len(results) - len(failed)}/{len(results)} tenants ok, {total_written:,} rows written in {wall_seconds:.2f}s")
+    for r in failed:
+        print(f"  FAILED {r['company_id']}: {r.get('error', '')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--tenants", help="JSON file with [{company_id, data_dir}]")
+    source.add_argument("--root", help="Directory with one export subdirectory per company_id")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parallel tenant processes")
+    parser.add_argument("--mongo-writers", type=int, default=DEFAULT_MONGO_WRITERS, help="Max tenants writing to MongoDB at once")
+    parser.add_argument("--full", action="store_true", help="Ignore the watermarks and rebuild every tenant")
+    parser.add_argument("--stream", action="store_true", help="Use the bounded-memory streaming pipeline")
+    parser.add_argument("--chunksize", type=int, default=None, help="Rows per chunk in --stream mode")
+    parser.add_argument("--summary", help="Also write the consolidated summary to this JSON file")
+    args = parser.parse_args()
+
+    tenants = load_tenants(args.tenants, args.root)
+    if not tenants:
+        logging.critical("No tenants to run.")
+        sys.exit(1)
+
+    chunksize = (args.chunksize or migration.CHUNK_SIZE) if args.stream else None
+    logging.info(f"Running {len(tenants)} tenants with {args.workers} workers, {args.mongo_writers} MongoDB writers")
+    start = time.perf_counter()
+    results = run_all(tenants, args.workers, args.mongo_writers, args.full, chunksize)
+    wall = time.perf_counter() - start
+    evaluate_alert_rules(tenants)
+
+    print_summary(results, wall)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump({"seconds": wall, "tenants": results}, f, indent=2, default=str)
+
+    if any(r["status"] != "ok" for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
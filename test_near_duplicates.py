@@ -0,0 +1,37 @@
+import logging
+
+import pandas as pd
+
+import near_duplicates
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def run_test():
+    logging.info("--- Starting Near Duplicates Test ---")
+    emisors = pd.DataFrame({'id': [1], 'rfc': ['ABC010203XY1']})
+    # Receptors 2 and 3 share an RFC: two catalog rows of one client
+    receptors = pd.DataFrame({'id': [1, 2, 3], 'rfc': ['XAXX010101000', 'ZZZ991231AA0', 'zzz991231aa0 ']})
+    cfdis = pd.DataFrame({
+        'id': [10, 11, 12, 13],
+        'emisor_id': [1, 1, 1, 1],
+        'receptor_id': [1, 2, 3, 1],
+        'fecha_emision': ['2024-03-01 10:00:00', '2024-03-02 10:00:00', '2024-03-03 12:00:00', '2024-04-20 10:00:00'],
+        'total': [1000.0, 1001.0, 1002.0, 1000.0],
+        'tipo': ['I', 'I', 'I', 'I'],
+        'estatus': ['vigente'] * 4,
+    })
+
+    partner = near_duplicates.find_partners(*near_duplicates.invoice_arrays(cfdis, emisors, receptors))
+    logging.info(f"Partners: {partner.tolist()}")
+    # One emisor, about the same amount a day apart, but to two different receptors: not paired
+    assert partner[0] == -1, "Invoices to different receptors were paired"
+    # Same emisor and same receptor RFC (through two catalog ids): paired
+    assert partner[1] == 2 and partner[2] == 1
+    # Same receptor as the first invoice, but outside the day window
+    assert partner[3] == -1
+    logging.info("Near duplicates are keyed by emisor and receptor: OK")
+
+
+if __name__ == "__main__":
+    run_test()
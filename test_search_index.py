@@ -0,0 +1,57 @@
+import logging
+
+import pandas as pd
+
+import search_index
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def contains_search(df, term):
+    """The per-keystroke filter the index replaced: a case-insensitive contains over the fields."""
+    term = search_index.fold_term(term)
+    mask = pd.Series(False, index=df.index)
+    for field in search_index.SEARCH_FIELDS:
+        mask |= df[field].map(lambda v: pd.notna(v) and term in search_index.fold_text(str(v)))
+    return list(mask[mask].index)
+
+
+def run_test():
+    logging.info("--- Starting Search Index Test ---")
+    df = pd.DataFrame({
+        'emisor_rfc': ['ABC010203XY1', 'ZZZ991231AA0', 'ABC010203XY1', None],
+        'emisor_nombre': ['Comercializadora Núñez', 'Servicios ABC1 SA', 'Comercializadora Núñez', 'Sin RFC'],
+        'receptor_rfc': ['XAXX010101000', 'ABC010203XY1', 'XAXX010101000', 'XAXX010101000'],
+        'receptor_nombre': ['Público en general', 'Comercializadora Núñez', 'Público en general', None],
+        # All-digit folios look like the start of a UUID; one folio looks like the start of an RFC
+        'folio': ['20240001', 'FAC123', '20240002', 'A-77'],
+        'uuid': ['3f2a9c10-1b2c-4d5e-8f90-20240001abcd', '9e8d7c6b-5a4f-4e3d-8c2b-1a0f9e8d7c6b',
+                 '12345678-aaaa-4bbb-8ccc-dddddddddddd', None],
+    })
+    index = search_index.SearchIndex(df)
+
+    cases = {
+        '20240001': [0],     # numeric folio (also inside a uuid, which is not its prefix)
+        '2024000': [0, 2],   # folio substring
+        'fac123': [1],       # RFC-shaped folio
+        'abc1': [1],         # RFC-shaped term inside a name; RFCs only match by prefix
+        'abc0102': [0, 1, 2],
+        '3f2a9c10': [0],     # uuid prefix
+        '3f2a9c10-1b': [0],
+        'nunez': [0, 1, 2],  # accent-folded
+        'a-7': [3],
+        '': [0, 1, 2, 3],
+    }
+    for term, expected in cases.items():
+        found = index.search(term).tolist()
+        assert found == expected, f"{term!r}: {found} != {expected}"
+        logging.info(f"{term!r} -> {found}")
+
+    # Outside of RFC and uuid prefixes the index agrees with the contains filter
+    for term in ['20240001', '2024000', 'fac123', 'nunez', 'general', 'xaxx', 'a-7', 'dddd']:
+        assert index.search(term).tolist() == contains_search(df, term), term
+    logging.info("Search index matches: OK")
+
+
+if __name__ == "__main__":
+    run_test()
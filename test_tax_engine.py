@@ -0,0 +1,38 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+import tax_engine
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def run_test():
+    logging.info("--- Starting Tax Engine Test ---")
+    cfdis = pd.DataFrame({'id': [1, 2, 3]})
+    impuestos = pd.DataFrame({'id': [10, 20, 30], 'cfdi_id': [1, 2, 3]})
+    # A null importe (CFDI 1, CFDI 2 only has one) must not turn the totals into NaN
+    traslados = pd.DataFrame({
+        'cfdi_comprobante_impuestos_id': [10, 10, 20, 30],
+        'impuesto': ['002', '002', '002', '003'],
+        'importe': [16.0, np.nan, np.nan, 8.0],
+    })
+    retenciones = pd.DataFrame({
+        'cfdi_comprobante_impuestos_id': [10],
+        'impuesto': ['001'],
+        'importe': [np.nan],
+    })
+
+    result = tax_engine.aggregate_taxes(cfdis, impuestos, traslados, retenciones).set_index('id')
+    logging.info(f"Totals:\n{result}")
+    assert not result.isna().any().any(), "NaN in the tax totals"
+    assert result.loc[1, 'calc_iva'] == 16.0 and result.loc[1, 'calc_traslados'] == 16.0
+    assert result.loc[2, 'calc_iva'] == 0.0
+    assert result.loc[3, 'calc_ieps'] == 8.0 and result.loc[3, 'calc_traslados'] == 8.0
+    assert result.loc[1, 'calc_ret_isr'] == 0.0 and result.loc[1, 'calc_retenciones'] == 0.0
+    logging.info("Null importes are skipped: OK")
+
+
+if __name__ == "__main__":
+    run_test()